@@ -0,0 +1,173 @@
+"""
+Grouping and summary statistics over the results of a query. Works on the
+projected fields returned by ProxyConnection.query_fields so that messages
+never have to be decoded.
+
+Group keys:
+    host, port, tls, method, path (without URL parameters), status
+
+Metrics:
+    count
+    sum(<value>), avg(<value>), min(<value>), max(<value>)
+    p<N>(<value>) for the Nth percentile, ie p50(duration), p95(rsp_len)
+
+Values:
+    req_len, rsp_len (bytes), duration (seconds)
+"""
+
+import math
+import re
+
+from urllib.parse import urlparse
+
+class AggregateError(Exception):
+    pass
+
+def _path_key(fields):
+    if fields["Path"] is None:
+        return None
+    return urlparse(fields["Path"]).path
+
+_group_keys = {
+    "host": ("DestHost", lambda f: f["DestHost"]),
+    "port": ("DestPort", lambda f: f["DestPort"]),
+    "tls": ("UseTLS", lambda f: f["UseTLS"]),
+    "method": ("Method", lambda f: f["Method"]),
+    "path": ("Path", _path_key),
+    "status": ("StatusCode", lambda f: f["StatusCode"]),
+}
+
+def _duration_value(fields):
+    if fields["Duration"] is None:
+        return None
+    return fields["Duration"] / 1000000000
+
+_values = {
+    "req_len": ("ReqLen", lambda f: f["ReqLen"]),
+    "rsp_len": ("RspLen", lambda f: f["RspLen"]),
+    "duration": ("Duration", _duration_value),
+}
+
+_metric_re = re.compile(r"^(sum|avg|min|max|p\d{1,2}(?:\.\d+)?)\((\w+)\)$")
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a sorted list of values
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100 * len(values)))
+    return values[max(rank, 1) - 1]
+
+class _Metric:
+
+    def __init__(self, spec):
+        self.spec = spec
+        if spec == "count":
+            self.func = "count"
+            self.value = None
+            return
+        m = _metric_re.match(spec)
+        if m is None:
+            raise AggregateError("invalid metric: %s" % spec)
+        self.func, self.value = m.groups()
+        if self.value not in _values:
+            raise AggregateError("invalid value %s. Must be one of %s" %
+                                 (self.value, ', '.join(_values.keys())))
+
+    @property
+    def keeps_values(self):
+        return self.func[0] == 'p'
+
+    def result(self, state):
+        if self.func == "count":
+            return state["count"]
+        if self.func == "sum":
+            return state["sums"].get(self.value, 0)
+        if self.func == "avg":
+            n = state["counts"].get(self.value, 0)
+            if n == 0:
+                return None
+            return state["sums"][self.value] / n
+        if self.func == "min":
+            return state["mins"].get(self.value)
+        if self.func == "max":
+            return state["maxs"].get(self.value)
+        vals = sorted(state["values"][self.value])
+        return percentile(vals, float(self.func[1:]))
+
+class Aggregator:
+    """
+    Accumulates projected fields into groups. Only values needed for
+    percentiles are kept, everything else is computed as the results come in.
+    """
+
+    def __init__(self, group_by, metrics):
+        for k in group_by:
+            if k not in _group_keys:
+                raise AggregateError("cannot group by %s. Must be one of %s" %
+                                     (k, ', '.join(_group_keys.keys())))
+        self.group_by = list(group_by)
+        self.metrics = [_Metric(m) for m in metrics]
+        self.groups = {}
+
+        fields = set()
+        for k in self.group_by:
+            fields.add(_group_keys[k][0])
+        self.value_names = set()
+        self.kept_values = set()
+        for m in self.metrics:
+            if m.value is not None:
+                fields.add(_values[m.value][0])
+                self.value_names.add(m.value)
+                if m.keeps_values:
+                    self.kept_values.add(m.value)
+        self.fields = sorted(fields)
+
+    def _new_state(self):
+        return {
+            "count": 0,
+            "counts": {},
+            "sums": {},
+            "mins": {},
+            "maxs": {},
+            "values": {v: [] for v in self.kept_values},
+        }
+
+    def add(self, fields):
+        key = tuple(_group_keys[k][1](fields) for k in self.group_by)
+        try:
+            state = self.groups[key]
+        except KeyError:
+            state = self._new_state()
+            self.groups[key] = state
+        state["count"] += 1
+        for name in self.value_names:
+            v = _values[name][1](fields)
+            if v is None:
+                continue
+            state["counts"][name] = state["counts"].get(name, 0) + 1
+            state["sums"][name] = state["sums"].get(name, 0) + v
+            if name not in state["mins"] or v < state["mins"][name]:
+                state["mins"][name] = v
+            if name not in state["maxs"] or v > state["maxs"][name]:
+                state["maxs"][name] = v
+            if name in self.kept_values:
+                state["values"][name].append(v)
+
+    def add_all(self, field_list):
+        for fields in field_list:
+            self.add(fields)
+
+    def rows(self):
+        def kfunc(key):
+            return tuple((v is None, str(v)) for v in key)
+        ret = []
+        for key in sorted(self.groups.keys(), key=kfunc):
+            row = {}
+            for k, v in zip(self.group_by, key):
+                row[k] = v
+            for m in self.metrics:
+                row[m.spec] = m.result(self.groups[key])
+            ret.append(row)
+        return ret
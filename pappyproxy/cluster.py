@@ -0,0 +1,251 @@
+"""
+Clustering responses to find the few that are different. Each response is
+fingerprinted by its status code, a bucket of its normalized length, the set of header names it
+has and a 64 bit SimHash of its body. Before the body is hashed, tokens that
+change between otherwise identical responses (numbers, hex strings, UUIDs,
+timestamps, long random looking tokens and values reflected from the
+request) are replaced with placeholders.
+
+Responses with the same status, length bucket and header set whose SimHashes
+differ in at most ``distance`` bits are put in the same cluster. The SimHash
+is split into distance+1 bands and clusters are indexed by each band, so a
+response only has to be compared with the clusters that share a band with it
+rather than with every cluster.
+"""
+
+import math
+import re
+
+from collections import namedtuple
+
+class ClusterError(Exception):
+    pass
+
+Fingerprint = namedtuple("Fingerprint", ["status", "length_bucket", "headers", "simhash"])
+
+# headers that come and go or change on every response
+_volatile_headers = {
+    "date", "expires", "last-modified", "etag", "age", "content-length",
+    "x-request-id", "x-runtime", "x-amzn-requestid", "x-amz-cf-id", "cf-ray",
+    "x-served-by", "x-cache", "x-timer", "server-timing",
+}
+
+# one pass over the body, the first alternative that matches at a position wins
+_dynamic_patterns = [
+    (rb"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?", b" TIME "),
+    (rb"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", b" UUID "),
+    (rb"\b[0-9a-fA-F]{16,}\b", b" HEX "),
+    (rb"[A-Za-z0-9+/_-]{24,}={0,2}", b" TOKEN "),
+    (rb"\d+", b"0"),
+]
+_dynamic_re = re.compile(b"|".join(b"(" + p + b")" for p, _ in _dynamic_patterns))
+_dynamic_repl = [None] + [r for _, r in _dynamic_patterns]
+
+_token_re = re.compile(rb"\w+|[^\w\s]")
+
+def normalize_body(body, reflected=None):
+    """
+    Replace the parts of a body that are likely to be different every time
+    it is requested. ``reflected`` is a list of strings from the request
+    that are removed if they appear in the body.
+    """
+    # numbers are replaced below anyway and short values would match too much
+    vals = [v for v in (reflected or []) if len(v) >= 3 and not v.isdigit() and v in body]
+    if vals:
+        alts = b"|".join(re.escape(v) for v in sorted(set(vals), key=len, reverse=True))
+        body = re.sub(rb"(?<![A-Za-z0-9])(?:" + alts + rb")(?![A-Za-z0-9])", b" REFLECTED ", body)
+    return _dynamic_re.sub(lambda m: _dynamic_repl[m.lastindex], body)
+
+_MASK64 = (1 << 64) - 1
+_LANE = 24 # bits per counter when summing the bits of every shingle hash
+_MAX_SHINGLES = (1 << (_LANE - 1)) - 1
+
+def _spread_table(shift):
+    # maps a byte to an int with each of its bits at the bottom of a lane
+    table = []
+    for b in range(256):
+        v = 0
+        for i in range(8):
+            if b & (1 << i):
+                v |= 1 << ((shift + i) * _LANE)
+        table.append(v)
+    return table
+
+_spread = [_spread_table(8 * i) for i in range(8)]
+
+def simhash(tokens, shingle=3):
+    """
+    A 64 bit SimHash of the shingles of a list of tokens. The bit counts of
+    every shingle's hash are summed at once by spreading each hash out so
+    every bit has its own lane in one big integer.
+    """
+    if len(tokens) < shingle:
+        shingles = [tuple(tokens)]
+    else:
+        shingles = zip(*[tokens[i:] for i in range(shingle)])
+    hashes = set(hash(s) & _MASK64 for s in shingles)
+    if len(hashes) > _MAX_SHINGLES:
+        hashes = set(sorted(hashes)[:_MAX_SHINGLES])
+    s0, s1, s2, s3, s4, s5, s6, s7 = _spread
+    acc = 0
+    for h in hashes:
+        acc += (s0[h & 255] | s1[(h >> 8) & 255] | s2[(h >> 16) & 255] | s3[(h >> 24) & 255] |
+                s4[(h >> 32) & 255] | s5[(h >> 40) & 255] | s6[(h >> 48) & 255] | s7[h >> 56])
+    half = len(hashes) / 2
+    lane_mask = (1 << _LANE) - 1
+    ret = 0
+    for i in range(64):
+        if ((acc >> (i * _LANE)) & lane_mask) > half:
+            ret |= 1 << i
+    return ret
+
+def length_bucket(n):
+    # lengths within about 20% of each other usually share a bucket
+    if n <= 0:
+        return 0
+    return 1 + int(math.log(n, 1.2))
+
+def _reflected_values(req):
+    vals = []
+    for _, v in req.url.param_iter():
+        vals.append(v)
+    for _, v in req.param_iter():
+        vals.append(v)
+    for _, v in req.cookie_iter():
+        vals.append(v)
+    return [v.encode() if isinstance(v, str) else v for v in vals]
+
+def fingerprint(req):
+    """
+    Fingerprint the response of a request. Returns None if it has no response
+    """
+    rsp = req.response
+    if rsp is None:
+        return None
+    headers = frozenset(k.lower() for k, _ in rsp.headers.pairs()
+                        if k.lower() not in _volatile_headers)
+    body = normalize_body(rsp.body, _reflected_values(req))
+    # bucket the normalized length so reflected payloads don't change it
+    return Fingerprint(rsp.status_code, length_bucket(len(body)), headers,
+                       simhash(_token_re.findall(body)))
+
+class Cluster:
+    """
+    A group of similar responses. ``reqids`` are the ids of the requests in
+    it and the first one is used as the representative.
+    """
+
+    def __init__(self, fp, reqid, length):
+        self.fingerprint = fp
+        self.reqids = [reqid]
+        self.min_len = length
+        self.max_len = length
+
+    def __len__(self):
+        return len(self.reqids)
+
+    def __repr__(self):
+        return "<Cluster status=%s size=%d sample=%s>" % (self.status, len(self), self.sample)
+
+    @property
+    def status(self):
+        return self.fingerprint.status
+
+    @property
+    def sample(self):
+        return self.reqids[0]
+
+    def add(self, reqid, length):
+        self.reqids.append(reqid)
+        self.min_len = min(self.min_len, length)
+        self.max_len = max(self.max_len, length)
+
+class Clusterer:
+    """
+    Puts fingerprints into clusters as they are added.
+    """
+
+    def __init__(self, distance=3):
+        if distance < 0 or distance > 31:
+            raise ClusterError("distance must be between 0 and 31")
+        self.distance = distance
+        self.clusters = []
+        self.no_response = []
+        # split the 64 bits into distance+1 bands. Two hashes that differ in
+        # at most distance bits must have at least one identical band
+        nbands = distance + 1
+        width = 64 // nbands
+        self._bands = []
+        for i in range(nbands):
+            start = i * width
+            end = 64 if i == nbands - 1 else start + width
+            self._bands.append((start, (1 << (end - start)) - 1))
+        self._index = {} # (coarse key, band number, band value) -> clusters
+
+    def _band_keys(self, coarse, h):
+        return [(coarse, i, (h >> start) & mask) for i, (start, mask) in enumerate(self._bands)]
+
+    def add(self, reqid, req):
+        """
+        Add a request to a cluster and return the cluster, or None if it has
+        no response
+        """
+        fp = fingerprint(req)
+        if fp is None:
+            self.no_response.append(reqid)
+            return None
+        length = len(req.response.body)
+        coarse = (fp.status, fp.length_bucket, fp.headers)
+        keys = self._band_keys(coarse, fp.simhash)
+        for key in keys:
+            for c in self._index.get(key, ()):
+                if bin(c.fingerprint.simhash ^ fp.simhash).count('1') <= self.distance:
+                    c.add(reqid, length)
+                    return c
+        c = Cluster(fp, reqid, length)
+        self.clusters.append(c)
+        for key in keys:
+            self._index.setdefault(key, []).append(c)
+        return c
+
+    def sorted_clusters(self):
+        """
+        The clusters, biggest first
+        """
+        return sorted(self.clusters, key=lambda c: len(c), reverse=True)
+
+    def outliers(self, max_size=None):
+        """
+        Clusters with at most max_size responses. By default this is 1% of the
+        responses (at least 1). The biggest cluster is never an outlier.
+        """
+        total = sum(len(c) for c in self.clusters)
+        if max_size is None:
+            max_size = max(1, total // 100)
+        clusters = self.sorted_clusters()
+        return [c for c in clusters[1:] if len(c) <= max_size]
+
+def cluster_requests(client, q, storage=None, distance=3, batch_size=100, progress=None):
+    """
+    Cluster the responses of every request matching a query. Requests are
+    fetched batch_size at a time and only their ids are kept. If given,
+    progress(done) is called after every batch. Returns a Clusterer.
+    """
+    clusterer = Clusterer(distance=distance)
+    done = 0
+    for reqs in client.request_batches(q, storage=storage, batch_size=batch_size):
+        for req in reqs:
+            clusterer.add(client.get_reqid(req), req)
+        done += len(reqs)
+        if progress is not None:
+            progress(done)
+    return clusterer
+
+def tag_clusters(client, clusters, tag):
+    """
+    Add a tag to every request in a list of clusters made by cluster_requests
+    """
+    for c in clusters:
+        for reqid in c.reqids:
+            storage, db_id = client.parse_reqid(reqid)
+            client.add_tag(db_id, tag, storage=storage.storage_id)
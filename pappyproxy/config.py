@@ -14,6 +14,10 @@ class ProxyConfig:
     def __init__(self):
         self._listeners = [('127.0.0.1', 8080, None)]
         self._proxy = {'use_proxy': False, 'host': '', 'port': 0, 'is_socks': False}
+        self._retention = {}
+        self._intercept = {}
+        self._rules = []
+        self._throttle = {}
         
     def load(self, fname):
         try:
@@ -31,6 +35,18 @@ class ProxyConfig:
         if 'proxy' in config_info:
             self._proxy = config_info['proxy']
 
+        if 'retention' in config_info:
+            self._retention = config_info['retention']
+
+        if 'intercept' in config_info:
+            self._intercept = config_info['intercept']
+
+        if 'rules' in config_info:
+            self._rules = config_info['rules']
+
+        if 'throttle' in config_info:
+            self._throttle = config_info['throttle']
+
     def _parse_listeners(self, listeners):
         self._listeners = []
         for info in listeners:
@@ -127,3 +143,64 @@ class ProxyConfig:
                 return True
         return False
 
+    @property
+    def retention_policies(self):
+        # dict of storage prefix -> policy settings. ie:
+        # {"m": {"max_requests": 10000, "max_bytes": 0, "max_age": 3600, "evict": "untagged", "rollover": ["n"]}}
+        if 'storages' in self._retention:
+            return copy.deepcopy(self._retention['storages'])
+        return {}
+
+    @property
+    def retention_interval(self):
+        if 'interval' in self._retention:
+            return self._retention['interval']
+        return 60
+
+    @property
+    def intercept_workers(self):
+        # number of threads that run intercepting macros
+        if 'workers' in self._intercept:
+            return self._intercept['workers']
+        return 8
+
+    @property
+    def intercept_queue_size(self):
+        if 'queue_size' in self._intercept:
+            return self._intercept['queue_size']
+        return 100
+
+    @property
+    def intercept_overflow(self):
+        # what to do with messages when the queue is full. One of "block",
+        # "forward" or "drop"
+        if 'overflow' in self._intercept:
+            return self._intercept['overflow']
+        return "block"
+
+    @property
+    def intercept_async_limit(self):
+        # maximum number of async mangle calls in flight at once
+        if 'async_limit' in self._intercept:
+            return self._intercept['async_limit']
+        return 1000
+
+    @property
+    def intercept_edit_timeout(self):
+        # seconds before a message waiting in the interceptor is forwarded
+        # unmodified. None to wait forever
+        if 'edit_timeout' in self._intercept:
+            return self._intercept['edit_timeout'] or None
+        return None
+
+    @property
+    def rules(self):
+        # list of match and replace rules for the built-in rules macro. ie:
+        # [{"type": "literal", "where": "response", "find": "foo", "replace": "bar"}]
+        return copy.deepcopy(self._rules)
+
+    @property
+    def throttle(self):
+        # per-host limits for submitted requests. ie:
+        # {"rate": 10, "burst": 5, "concurrency": 4, "hosts": {"*.target.org": {"rate": 2}}}
+        return copy.deepcopy(self._throttle)
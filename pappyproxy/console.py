@@ -32,7 +32,7 @@ def interface_loop(client):
     cons.cmdloop()
     
 def load_interface(cons):
-    from .interface import test, view, decode, misc, context, mangle, macros, tags
+    from .interface import test, view, decode, misc, context, mangle, macros, tags, storage, intruder, replay, loadtest, mockserver, timing
     test.load_cmds(cons)
     view.load_cmds(cons)
     decode.load_cmds(cons)
@@ -41,6 +41,12 @@ def load_interface(cons):
     mangle.load_cmds(cons)
     macros.load_cmds(cons)
     tags.load_cmds(cons)
+    storage.load_cmds(cons)
+    intruder.load_cmds(cons)
+    replay.load_cmds(cons)
+    loadtest.load_cmds(cons)
+    mockserver.load_cmds(cons)
+    timing.load_cmds(cons)
 
 ##########
 ## Classes
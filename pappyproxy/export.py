@@ -0,0 +1,252 @@
+"""
+Streaming export of requests to HAR 1.2 or JSON Lines. Requests are fetched
+from storage in batches and encoded in worker threads/processes while the next
+batch is being fetched, so memory use depends on the batch size and not on the
+number of requests being exported.
+"""
+
+import base64
+import gzip
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .proxy import encode_req
+
+class ExportError(Exception):
+    pass
+
+def default_workers():
+    # leave a core for fetching batches and writing the file
+    return max(2, min(4, (os.cpu_count() or 1) - 1))
+
+def request_url(req):
+    # The full URL of a request including the scheme, host and port
+    if req.use_tls:
+        scheme = 'https'
+        default_port = 443
+    else:
+        scheme = 'http'
+        default_port = 80
+    host = req.dest_host
+    if req.dest_port != default_port:
+        host = '{}:{}'.format(host, req.dest_port)
+    return '{}://{}{}'.format(scheme, host, req.url.geturl())
+
+def _har_time(t):
+    if t is None:
+        return "1970-01-01T00:00:00.000Z"
+    return t.isoformat(timespec='milliseconds') + 'Z'
+
+def _name_values(pairs):
+    return [{"name": k, "value": v} for k, v in pairs]
+
+def _mime_type(msg):
+    if 'content-type' in msg.headers:
+        return msg.headers.get('content-type')
+    return ''
+
+def _har_text(body):
+    # Returns (text, encoding) for a message body
+    try:
+        return body.decode(), None
+    except UnicodeDecodeError:
+        return base64.b64encode(body).decode(), 'base64'
+
+def har_entry(req):
+    """
+    Convert a request and its response to a HAR 1.2 entry
+    """
+    req_http_version = "HTTP/{}.{}".format(req.proto_major, req.proto_minor)
+    request = {
+        "method": req.method,
+        "url": request_url(req),
+        "httpVersion": req_http_version,
+        "cookies": _name_values(req.cookie_iter()),
+        "headers": _name_values(req.headers.pairs()),
+        "queryString": _name_values(req.url.param_iter()),
+        "headersSize": -1,
+        "bodySize": len(req.body),
+    }
+    if req.body:
+        text, encoding = _har_text(req.body)
+        request["postData"] = {
+            "mimeType": _mime_type(req),
+            "params": _name_values(req.param_iter()),
+            "text": text,
+        }
+        if encoding is not None:
+            request["postData"]["encoding"] = encoding
+
+    rsp = req.response
+    if rsp is not None:
+        text, encoding = _har_text(rsp.body)
+        content = {
+            "size": len(rsp.body),
+            "mimeType": _mime_type(rsp),
+            "text": text,
+        }
+        if encoding is not None:
+            content["encoding"] = encoding
+        redirect = ''
+        if 'location' in rsp.headers:
+            redirect = rsp.headers.get('location')
+        response = {
+            "status": rsp.status_code,
+            "statusText": rsp.reason,
+            "httpVersion": "HTTP/{}.{}".format(rsp.proto_major, rsp.proto_minor),
+            "cookies": _name_values(rsp.cookie_iter()),
+            "headers": _name_values(rsp.headers.pairs()),
+            "content": content,
+            "redirectURL": redirect,
+            "headersSize": -1,
+            "bodySize": len(rsp.body),
+        }
+    else:
+        response = {
+            "status": 0,
+            "statusText": "",
+            "httpVersion": req_http_version,
+            "cookies": [],
+            "headers": [],
+            "content": {"size": 0, "mimeType": ""},
+            "redirectURL": "",
+            "headersSize": -1,
+            "bodySize": -1,
+        }
+
+    total_time = 0
+    if req.time_start is not None and req.time_end is not None:
+        total_time = (req.time_end - req.time_start).total_seconds() * 1000
+    return {
+        "startedDateTime": _har_time(req.time_start),
+        "time": total_time,
+        "request": request,
+        "response": response,
+        "cache": {},
+        "timings": {"send": 0, "wait": total_time, "receive": 0},
+        "_pappyId": req.db_id,
+        "_pappyTags": sorted(req.tags),
+    }
+
+def jsonl_entry(req):
+    """
+    Convert a request to the message format used by the backend. This keeps
+    everything including the unmangled versions and websocket messages.
+    """
+    ret = encode_req(req)
+    ret["DbId"] = req.db_id
+    return ret
+
+_entry_funcs = {
+    "har": har_entry,
+    "jsonl": jsonl_entry,
+}
+
+def encode_entries(fmt, reqs):
+    # module level so that it can be run in a worker process
+    f = _entry_funcs[fmt]
+    return [json.dumps(f(req)) for req in reqs]
+
+class HARWriter:
+
+    def __init__(self, f):
+        self.f = f
+        self.first = True
+
+    def start(self):
+        self.f.write('{"log": {"version": "1.2", ')
+        self.f.write('"creator": {"name": "Pappy Proxy", "version": "0.3.1"}, ')
+        self.f.write('"pages": [], "entries": [\n')
+
+    def write(self, line):
+        if not self.first:
+            self.f.write(',\n')
+        self.first = False
+        self.f.write(line)
+
+    def finish(self):
+        self.f.write('\n]}}\n')
+
+class JSONLWriter:
+
+    def __init__(self, f):
+        self.f = f
+
+    def start(self):
+        pass
+
+    def write(self, line):
+        self.f.write(line)
+        self.f.write('\n')
+
+    def finish(self):
+        pass
+
+_writers = {
+    "har": HARWriter,
+    "jsonl": JSONLWriter,
+}
+
+def export_formats():
+    return sorted(_writers.keys())
+
+def open_export_file(fname, compress=None):
+    """
+    Open a file for writing text. If compress is None the file is gzipped
+    if its name ends in .gz
+    """
+    if compress is None:
+        compress = fname.endswith('.gz')
+    if compress:
+        return gzip.open(fname, 'wt', encoding='utf-8')
+    return open(fname, 'w', encoding='utf-8')
+
+def export_requests(client, q, f, fmt="har", storage=None, batch_size=100,
+                    workers=None, progress=None):
+    """
+    Write the requests matching a query to a file object in the given format.
+    Each batch is split between a pool of ``workers`` processes (see
+    default_workers) while the next batch is fetched. With workers=1 entries
+    are encoded in a single thread instead.
+    If given, progress(exported) is called after each batch. Returns the
+    number of exported requests.
+    """
+    if fmt not in _writers:
+        raise ExportError("invalid format %s. Must be one of %s" %
+                          (fmt, ', '.join(export_formats())))
+    writer = _writers[fmt](f)
+    if workers is None:
+        workers = default_workers()
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = ThreadPoolExecutor(max_workers=1)
+    chunk_size = max(1, batch_size // max(workers, 1))
+
+    def write_pending(futures):
+        n = 0
+        for fut in futures:
+            for line in fut.result():
+                writer.write(line)
+                n += 1
+        return n
+
+    exported = 0
+    writer.start()
+    try:
+        pending = []
+        for batch in client.request_batches(q, storage=storage, batch_size=batch_size):
+            futures = [pool.submit(encode_entries, fmt, batch[i:i+chunk_size])
+                       for i in range(0, len(batch), chunk_size)]
+            # write the previous batch while this one is encoded
+            exported += write_pending(pending)
+            pending = futures
+            if progress is not None:
+                progress(exported)
+        exported += write_pending(pending)
+    finally:
+        pool.shutdown()
+    writer.finish()
+    return exported
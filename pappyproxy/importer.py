@@ -0,0 +1,352 @@
+"""
+Importing captures from other tools. HAR, Burp XML, JSON Lines (as written
+by the export command) and pcap/pcapng files are parsed incrementally, the raw
+entries are converted to requests in a pool of worker processes and the
+requests are saved to storage in batches.
+"""
+
+import base64
+import datetime
+import gzip
+import json
+import re
+import time
+import xml.etree.ElementTree as ET
+
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from .pcap import PcapError, read_pcap
+from .proxy import (HTTPRequest, HTTPResponse, MessageError, decode_req,
+                    parse_request, parse_response, _clear_db_ids)
+from .wire import HTTPParseError, MessageParser, response_from_parsed
+
+ImportResult = namedtuple("ImportResult", ["imported", "errors", "seconds"])
+
+class ImporterError(Exception):
+    pass
+
+def _open_text(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rt', encoding='utf-8')
+    return open(fname, 'r', encoding='utf-8')
+
+def _utc(t):
+    if t.tzinfo is not None:
+        t = (t - t.utcoffset()).replace(tzinfo=None)
+    return t
+
+##########
+## Readers
+# Readers yield raw entries that can be sent to a worker process
+
+_skip_re = re.compile(r'[\s,]*')
+
+def iter_json_array(f, key, chunk_size=1024*1024):
+    """
+    Yield each element of the first JSON array with the given key in a file
+    without loading the whole document. Only one element has to fit in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        data = f.read(chunk_size)
+        if not data:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+
+    # find the start of the array
+    marker = '"%s"' % key
+    while True:
+        idx = buf.find(marker)
+        if idx >= 0:
+            bracket = buf.find('[', idx)
+            if bracket >= 0:
+                pos = bracket + 1
+                break
+        if eof:
+            raise ImporterError('could not find "%s" in file' % key)
+        read_more()
+
+    while True:
+        pos = _skip_re.match(buf, pos).end()
+        if pos >= len(buf):
+            if eof:
+                raise ImporterError("unexpected end of file")
+            read_more()
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise ImporterError("invalid JSON in file")
+            read_more()
+            continue
+        pos = end
+        yield obj
+
+def read_har(fname):
+    with _open_text(fname) as f:
+        for entry in iter_json_array(f, "entries"):
+            yield entry
+
+def read_jsonl(fname):
+    with _open_text(fname) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def read_burp(fname):
+    # iterparse lets us throw away each item once it has been read
+    source = fname
+    if fname.endswith('.gz'):
+        source = gzip.open(fname, 'rb')
+    context = ET.iterparse(source, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event != "end" or elem.tag != "item":
+            continue
+        item = {}
+        for child in elem:
+            item[child.tag] = (child.text or '', dict(child.attrib))
+        yield item
+        root.clear()
+
+def read_pcap_file(fname):
+    # TCP reassembly has to happen in order, so the requests come out of the
+    # reader already decoded
+    try:
+        yield from read_pcap(fname)
+    except PcapError as e:
+        raise ImporterError("could not read %s: %s" % (fname, e))
+
+###########
+## Decoders
+# Decoders turn raw entries into HTTPRequests and are run in worker processes
+
+def _har_version(s):
+    try:
+        major, minor = s.split('/', 1)[1].split('.', 1)
+        return int(major), int(minor)
+    except (IndexError, ValueError):
+        return 1, 1
+
+def _har_body(obj):
+    if obj is None or 'text' not in obj:
+        return b''
+    if obj.get('encoding') == 'base64':
+        return base64.b64decode(obj['text'])
+    return obj['text'].encode()
+
+def _har_headers(hlist, skip=()):
+    headers = {}
+    for h in hlist:
+        if h['name'].startswith(':') or h['name'].lower() in skip:
+            continue
+        headers.setdefault(h['name'], []).append(h['value'])
+    return headers
+
+def _har_time(s):
+    if s.endswith('Z'):
+        s = s[:-1] + '+00:00'
+    try:
+        return _utc(datetime.datetime.fromisoformat(s))
+    except ValueError:
+        return None
+
+def decode_har_entry(entry):
+    hreq = entry['request']
+    url = urlparse(hreq['url'])
+    use_tls = url.scheme == 'https'
+    port = url.port or (443 if use_tls else 80)
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    pmajor, pminor = _har_version(hreq.get('httpVersion', ''))
+    time_start = _har_time(entry.get('startedDateTime', ''))
+    time_end = None
+    if time_start is not None and isinstance(entry.get('time'), (int, float)) and entry['time'] >= 0:
+        time_end = time_start + datetime.timedelta(milliseconds=entry['time'])
+    req = HTTPRequest(
+        method=hreq['method'],
+        path=path,
+        proto_major=pmajor,
+        proto_minor=pminor,
+        headers=_har_headers(hreq.get('headers', []), skip=('content-length',)),
+        body=_har_body(hreq.get('postData')),
+        dest_host=url.hostname or '',
+        dest_port=port,
+        use_tls=use_tls,
+        time_start=time_start,
+        time_end=time_end,
+        tags=entry.get('_pappyTags'),
+    )
+
+    hrsp = entry.get('response')
+    if hrsp is not None and hrsp.get('status', 0) > 0:
+        pmajor, pminor = _har_version(hrsp.get('httpVersion', ''))
+        # HAR content is stored decoded, so the encoding headers no longer apply
+        skip = ('content-length', 'content-encoding', 'transfer-encoding')
+        req.response = HTTPResponse(
+            status_code=hrsp['status'],
+            reason=hrsp.get('statusText', ''),
+            proto_major=pmajor,
+            proto_minor=pminor,
+            headers=_har_headers(hrsp.get('headers', []), skip=skip),
+            body=_har_body(hrsp.get('content')),
+        )
+    return req
+
+def _burp_data(item, key):
+    text, attrib = item.get(key, ('', {}))
+    if attrib.get('base64') == 'true':
+        return base64.b64decode(text)
+    return text.encode()
+
+def _burp_time(s):
+    for fmt in ("%a %b %d %H:%M:%S %Z %Y", "%a %b %d %H:%M:%S %Y"):
+        try:
+            return datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+    return None
+
+def _burp_response(data, method):
+    rsp = parse_response(data)
+    if "chunked" not in ",".join(v for _, v in rsp.headers.pairs("transfer-encoding")).lower():
+        return rsp
+    # Burp stores the raw response, so chunked bodies still have their framing
+    parser = MessageParser(is_response=True)
+    parser.expect(method)
+    try:
+        msgs = parser.feed(data) + parser.close()
+    except HTTPParseError:
+        return rsp
+    if not msgs:
+        return rsp
+    return response_from_parsed(msgs[-1])
+
+def decode_burp_item(item):
+    use_tls = item.get('protocol', ('http', {}))[0] == 'https'
+    try:
+        port = int(item.get('port', ('', {}))[0])
+    except ValueError:
+        port = 443 if use_tls else 80
+    req = parse_request(_burp_data(item, 'request'),
+                        dest_host=item.get('host', ('', {}))[0],
+                        dest_port=port, use_tls=use_tls)
+    req.time_start = _burp_time(item.get('time', ('', {}))[0])
+    rsp_data = _burp_data(item, 'response')
+    if rsp_data:
+        req.response = _burp_response(rsp_data, req.method)
+    return req
+
+def decode_jsonl_entry(entry):
+    req = decode_req(entry)
+    _clear_db_ids(req)
+    return req
+
+def decode_pcap_request(req):
+    return req
+
+_formats = {
+    "har": (read_har, decode_har_entry),
+    "burp": (read_burp, decode_burp_item),
+    "jsonl": (read_jsonl, decode_jsonl_entry),
+    "pcap": (read_pcap_file, decode_pcap_request),
+}
+
+def import_formats():
+    return sorted(_formats.keys())
+
+def guess_format(fname):
+    name = fname.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.har'):
+        return 'har'
+    if name.endswith('.xml'):
+        return 'burp'
+    if name.endswith('.jsonl') or name.endswith('.json'):
+        return 'jsonl'
+    if name.endswith('.pcap') or name.endswith('.pcapng') or name.endswith('.cap'):
+        return 'pcap'
+    raise ImporterError("could not guess the format of %s" % fname)
+
+def decode_entries(fmt, entries):
+    # module level so that it can be run in a worker process. Returns a list of
+    # (request, error) tuples
+    decode = _formats[fmt][1]
+    ret = []
+    for entry in entries:
+        try:
+            ret.append((decode(entry), None))
+        except (KeyError, ValueError, TypeError, AttributeError, MessageError) as e:
+            ret.append((None, "%s: %s" % (type(e).__name__, e)))
+    return ret
+
+def import_file(client, fname, fmt=None, storage=None, batch_size=100,
+                workers=1, progress=None):
+    """
+    Import the requests from a file into a storage (the proxy storage by
+    default). Entries are decoded batch_size at a time in a thread, or in a
+    pool of processes if workers > 1, while the file is read and earlier
+    batches are saved. If given, progress(imported, errors) is called after
+    every saved batch. Returns an ImportResult.
+    """
+    if fmt is None:
+        fmt = guess_format(fname)
+    if fmt not in _formats:
+        raise ImporterError("invalid format %s. Must be one of %s" %
+                            (fmt, ', '.join(import_formats())))
+    read = _formats[fmt][0]
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = ThreadPoolExecutor(max_workers=1)
+    max_pending = max(workers, 1) * 2
+
+    start = time.time()
+    imported = 0
+    errors = 0
+    pending = deque()
+
+    def save_next():
+        nonlocal imported, errors
+        reqs = []
+        for req, err in pending.popleft().result():
+            if err is None:
+                reqs.append(req)
+            else:
+                errors += 1
+        if reqs:
+            client.save_new_batch(reqs, storage=storage)
+            imported += len(reqs)
+        if progress is not None:
+            progress(imported, errors)
+
+    try:
+        batch = []
+        for entry in read(fname):
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                pending.append(pool.submit(decode_entries, fmt, batch))
+                batch = []
+                if len(pending) > max_pending:
+                    save_next()
+        if batch:
+            pending.append(pool.submit(decode_entries, fmt, batch))
+        while pending:
+            save_next()
+    finally:
+        pool.shutdown()
+    return ImportResult(imported, errors, time.time() - start)
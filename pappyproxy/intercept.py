@@ -0,0 +1,1018 @@
+"""
+Running intercepting macros. Messages read from an intercepting connection are
+put on a bounded queue and mangled by a fixed number of worker threads. If the
+queue is full, the overflow policy decides whether the reader waits for room
+("block"), the message is sent on unmodified ("forward") or it is dropped
+("drop"). Running macros are chained in an InterceptPipeline so that every
+message is only sent and decoded once no matter how many macros are running.
+
+Macros with a prefilter are only given the messages that pass it. Prefilters
+are checked against the raw message in the reader thread, so messages that no
+macro wants are forwarded straight away without being queued or decoded.
+
+Macros can define their mangle functions with ``async def``. Coroutines are run
+on an event loop in a separate thread so that a worker is only busy while a
+message is decoded and not while the macro is waiting on something else.
+
+CPU-bound macros can be run in a pool of processes with a ProcessMacroPool.
+Messages are pickled without their bodies and bodies over a size threshold
+are copied through shared memory instead of the pipe. The parent unlinks
+every segment: the ones it creates for arguments when the call ends however
+it ends, and the ones a worker creates for the result as soon as the result
+arrives, whether or not anything is still waiting for it. The workers share
+the parent's multiprocessing resource tracker and exit if the parent dies,
+so any segments that haven't been unlinked are removed by the tracker.
+
+Every call a pipeline makes to a macro is timed in a MacroStats for that
+macro, and a macro can be profiled with cProfile for a number of calls with a
+MacroProfiler.
+"""
+
+import asyncio
+import cProfile
+import copy
+import imp
+import inspect
+import io
+import os
+import pstats
+import queue
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from .aggregate import percentile
+from .proxy import (Headers, HTTPRequest, InterceptMacro, ProxyClient,
+                    SocketClosed, WSMessage, decode_req, decode_rsp, decode_ws,
+                    encode_req, encode_rsp, encode_ws)
+from .util import log_error
+
+class InterceptError(Exception):
+    pass
+
+overflow_policies = ("block", "forward", "drop")
+
+_msg_keys = {
+    "httprequest": "Request",
+    "httpresponse": "Response",
+    "wstoserver": "WSMessage",
+    "wstoclient": "WSMessage",
+}
+
+def forward_reply(msg):
+    # Reply to an intercepted message with the message as we received it
+    try:
+        key = _msg_keys[msg["Type"]]
+    except KeyError:
+        raise InterceptError("Unknown message type: " + msg["Type"])
+    return {
+        "Id": msg["Id"],
+        "Dropped": False,
+        key: msg[key],
+    }
+
+def drop_reply(msg):
+    return {
+        "Id": msg["Id"],
+        "Dropped": True,
+    }
+
+_type_flags = {
+    "httprequest": "intercept_requests",
+    "httpresponse": "intercept_responses",
+    "wstoserver": "intercept_ws",
+    "wstoclient": "intercept_ws",
+}
+
+def _passes(macro, msg):
+    # Whether a macro wants a raw message from the proxy
+    if not getattr(macro, _type_flags.get(msg["Type"], ""), False):
+        return False
+    prefilter = getattr(macro, 'prefilter', None)
+    if prefilter is None:
+        return True
+    try:
+        return prefilter.match(msg)
+    except Exception as e:
+        log_error("error in prefilter for %s: %s" % (macro.name, e))
+        return True
+
+def select_macro(macro, msg):
+    """
+    Returns the macro that should mangle a raw message from the proxy, or None
+    if the message should be forwarded without being decoded
+    """
+    if isinstance(macro, MacroChain):
+        return macro.for_message(msg)
+    if _passes(macro, msg):
+        return macro
+    return None
+
+def _own_copy(m):
+    # Copy a decoded request or response without sharing anything a macro
+    # could modify. Bodies and the URL's parts are immutable so they are shared
+    if m is None:
+        return None
+    ret = copy.copy(m)
+    ret.headers = Headers()
+    ret.headers.headers = {k: list(v) for k, v in m.headers.headers.items()}
+    ret.unmangled = _own_copy(m.unmangled)
+    if isinstance(m, HTTPRequest):
+        ret.url = copy.copy(m.url)
+        ret.tags = set(m.tags)
+        ret.response = _own_copy(m.response)
+        ret.ws_messages = [copy.copy(w) for w in m.ws_messages]
+    return ret
+
+class HandshakeCache:
+    """
+    An LRU cache of decoded websocket handshakes. The proxy sends the upgrade
+    request and response with every intercepted websocket message, so they
+    only need to be decoded for the first message of each session. Each
+    message gets its own copy of the cached objects so that a macro that
+    modifies them doesn't change them for the rest of the session or for the
+    other workers.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def session_key(reqd):
+        # Sec-WebSocket-Key is unique per handshake. Fall back to the id and
+        # start time if it's missing.
+        for k, vs in (reqd.get("Headers") or {}).items():
+            if k.lower() == "sec-websocket-key" and vs:
+                return (reqd.get("DestHost"), reqd.get("DestPort"), vs[0])
+        return (reqd.get("DestHost"), reqd.get("DestPort"), reqd.get("Path"),
+                reqd.get("DbId"), reqd.get("StartTime"))
+
+    def get(self, msg):
+        """
+        Returns the decoded (request, response) for a websocket message. The
+        caller owns the returned objects.
+        """
+        key = self.session_key(msg["Request"])
+        with self._lock:
+            handshake = self._cache.get(key)
+            if handshake is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+            else:
+                self.misses += 1
+        if handshake is None:
+            handshake = (decode_req(msg["Request"]), decode_rsp(msg["Response"]))
+            with self._lock:
+                self._cache[key] = handshake
+                if len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+        # the cached objects are never handed out so they can't be changed
+        return _own_copy(handshake[0]), _own_copy(handshake[1])
+
+def _then(result, make_reply):
+    # Call make_reply with the result of a mangle function. If the macro
+    # returned an awaitable, return a coroutine that awaits it first.
+    if inspect.isawaitable(result):
+        async def finish():
+            return make_reply(await result)
+        return finish()
+    return make_reply(result)
+
+def mangle_message(macro, msg, ws_cache=None):
+    """
+    Decode an intercepted message, pass it to the macro and return the reply
+    to send to the proxy. If the macro is asynchronous, returns a coroutine
+    that returns the reply. If a HandshakeCache is given, it is used to decode
+    the handshakes of websocket messages.
+    """
+    if msg["Type"] == "httprequest":
+        req = decode_req(msg["Request"])
+        def request_reply(newReq):
+            if newReq is None:
+                return drop_reply(msg)
+            newReq.unmangled = None
+            newReq.response = None
+            newReq.ws_messages = []
+            return {
+                "Id": msg["Id"],
+                "Dropped": False,
+                "Request": encode_req(newReq),
+            }
+        return _then(macro.mangle_request(req), request_reply)
+    elif msg["Type"] == "httpresponse":
+        req = decode_req(msg["Request"])
+        rsp = decode_rsp(msg["Response"])
+        def response_reply(newRsp):
+            if newRsp is None:
+                return drop_reply(msg)
+            newRsp.unmangled = None
+            return {
+                "Id": msg["Id"],
+                "Dropped": False,
+                "Response": encode_rsp(newRsp),
+            }
+        return _then(macro.mangle_response(req, rsp), response_reply)
+    elif msg["Type"] == "wstoserver" or msg["Type"] == "wstoclient":
+        if ws_cache is not None:
+            req, rsp = ws_cache.get(msg)
+        else:
+            req = decode_req(msg["Request"])
+            rsp = decode_rsp(msg["Response"])
+        wsm = decode_ws(msg["WSMessage"])
+        def ws_reply(newWsm):
+            if newWsm is None:
+                return drop_reply(msg)
+            newWsm.unmangled = None
+            return {
+                "Id": msg["Id"],
+                "Dropped": False,
+                "WSMessage": encode_ws(newWsm),
+            }
+        return _then(macro.mangle_websocket(req, rsp, wsm), ws_reply)
+    raise InterceptError("Unknown message type: " + msg["Type"])
+
+class AsyncRunner:
+    """
+    Runs coroutines on an event loop in its own thread. At most ``limit``
+    coroutines are in flight at once and submit() blocks until one finishes
+    if the limit has been reached.
+    """
+
+    def __init__(self, limit=1000):
+        self.limit = limit
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro, callback):
+        """
+        Run a coroutine and call callback(result, exception) from the loop's
+        thread when it is done
+        """
+        self._slots.acquire()
+        with self._lock:
+            self.in_flight += 1
+        fut = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        def done(f):
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+            try:
+                result, exc = f.result(), None
+            except Exception as e:
+                result, exc = None, e
+            callback(result, exc)
+        fut.add_done_callback(done)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class InterceptMetrics:
+    """
+    Counters for an InterceptPool. Latency is measured from when a message is
+    read from the proxy to when the reply is sent and the most recent
+    ``sample_size`` latencies are kept.
+    """
+
+    def __init__(self, sample_size=1000):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.completed = 0
+        self.skipped = 0 # forwarded without decoding because of a prefilter
+        self.forwarded = 0 # forwarded unmodified because the queue was full
+        self.dropped = 0 # dropped because the queue was full
+        self.errors = 0
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=sample_size)
+
+    def message_received(self, depth):
+        with self.lock:
+            self.received += 1
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+
+    def message_done(self, start, error=False):
+        with self.lock:
+            self.completed += 1
+            if error:
+                self.errors += 1
+            self.latencies.append(time.time() - start)
+
+    def message_skipped(self):
+        with self.lock:
+            self.skipped += 1
+
+    def overflowed(self, policy):
+        with self.lock:
+            if policy == "forward":
+                self.forwarded += 1
+            else:
+                self.dropped += 1
+
+    def snapshot(self):
+        """
+        Return the counters as a dict. Latencies are in seconds.
+        """
+        with self.lock:
+            lats = sorted(self.latencies)
+            ret = {
+                "received": self.received,
+                "completed": self.completed,
+                "skipped": self.skipped,
+                "forwarded": self.forwarded,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "max_queue_depth": self.max_queue_depth,
+            }
+        for pct in (50, 95, 99):
+            ret["p%d" % pct] = percentile(lats, pct)
+        ret["max"] = max(lats) if lats else None
+        return ret
+
+class MacroProfiler:
+    """
+    Runs a macro's calls under cProfile until ``count`` calls have finished,
+    then writes the stats to ``fname``. Calls are profiled one at a time since
+    a profiler can only be active in one thread. Coroutines are profiled each
+    time they are resumed so that time spent waiting isn't counted.
+    """
+
+    def __init__(self, count, fname):
+        self.count = count
+        self.remaining = count
+        self.fname = fname
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.summary = ''
+
+    def run(self, func):
+        with self.lock:
+            if self.remaining <= 0:
+                # calls that were in flight when the profile finished
+                return func()
+            self.profile.enable()
+            try:
+                return func()
+            finally:
+                self.profile.disable()
+
+    def wrap(self, awaitable):
+        return _ProfiledAwaitable(awaitable, self)
+
+    def call_done(self):
+        """
+        Count a finished call. Returns True when the last call is done and the
+        stats have been written
+        """
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            if self.remaining > 0:
+                return False
+            out = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=out)
+            stats.sort_stats('cumulative')
+            stats.dump_stats(self.fname)
+            stats.print_stats(20)
+            self.summary = out.getvalue()
+        return True
+
+class _ProfiledAwaitable:
+    # Steps through an awaitable with a profiler enabled only while it runs
+
+    def __init__(self, awaitable, profiler):
+        self.awaitable = awaitable
+        self.profiler = profiler
+
+    def __await__(self):
+        it = self.awaitable.__await__()
+        send, exc = None, None
+        while True:
+            try:
+                if exc is not None:
+                    yielded = self.profiler.run(lambda: it.throw(exc))
+                else:
+                    yielded = self.profiler.run(lambda: it.send(send))
+            except StopIteration as e:
+                return e.value
+            try:
+                send, exc = (yield yielded), None
+            except BaseException as e:
+                send, exc = None, e
+
+hooks = ("request", "response", "websocket")
+
+class MacroStats:
+    """
+    Call counts, drops, errors and latency of one macro in a pipeline, kept
+    separately for each mangle function. The most recent ``sample_size``
+    latencies of each hook are kept. Set ``profiler`` to a MacroProfiler to
+    profile the next calls.
+    """
+
+    def __init__(self, name, sample_size=1000):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {h: 0 for h in hooks}
+        self.drops = {h: 0 for h in hooks}
+        self.errors = {h: 0 for h in hooks}
+        self.latencies = {h: deque(maxlen=sample_size) for h in hooks}
+        self.profiler = None
+
+    def call(self, hook, func):
+        """
+        Call func, which calls one of the macro's mangle functions, and record
+        how long it took. Awaitables are timed until they finish.
+        """
+        start = time.time()
+        profiler = self.profiler
+        try:
+            if profiler is not None:
+                ret = profiler.run(func)
+            else:
+                ret = func()
+        except Exception:
+            self.record(hook, start, profiler, error=True)
+            raise
+        if inspect.isawaitable(ret):
+            if profiler is not None:
+                ret = profiler.wrap(ret)
+            return self._timed(hook, start, profiler, ret)
+        self.record(hook, start, profiler, dropped=(ret is None))
+        return ret
+
+    async def _timed(self, hook, start, profiler, awaitable):
+        try:
+            ret = await awaitable
+        except Exception:
+            self.record(hook, start, profiler, error=True)
+            raise
+        self.record(hook, start, profiler, dropped=(ret is None))
+        return ret
+
+    def record(self, hook, start, profiler=None, dropped=False, error=False):
+        with self.lock:
+            self.calls[hook] += 1
+            if dropped:
+                self.drops[hook] += 1
+            if error:
+                self.errors[hook] += 1
+            self.latencies[hook].append(time.time() - start)
+        if profiler is not None and profiler.call_done():
+            if self.profiler is profiler:
+                self.profiler = None
+            log_error("Profile of %s written to %s\n%s" % (self.name, profiler.fname, profiler.summary))
+
+    def snapshot(self, hook=None):
+        """
+        Return the counters for a hook, or for all hooks combined, as a dict.
+        Latencies are in seconds.
+        """
+        hs = [hook] if hook is not None else hooks
+        with self.lock:
+            ret = {
+                "calls": sum(self.calls[h] for h in hs),
+                "drops": sum(self.drops[h] for h in hs),
+                "errors": sum(self.errors[h] for h in hs),
+            }
+            lats = sorted(l for h in hs for l in self.latencies[h])
+        for pct in (50, 95, 99):
+            ret["p%d" % pct] = percentile(lats, pct)
+        ret["max"] = max(lats) if lats else None
+        return ret
+
+class InterceptPool:
+    """
+    A fixed set of worker threads that handle intercepted messages. handler
+    takes a message from the proxy and the value given to put() with it and
+    returns the reply, or a coroutine that
+    returns the reply which is then run by an AsyncRunner with at most
+    async_limit coroutines in flight. If handler raises an exception the error
+    is logged and the message is forwarded unmodified.
+    """
+
+    def __init__(self, workers=8, queue_size=100, overflow="block", async_limit=1000):
+        if overflow not in overflow_policies:
+            raise InterceptError("invalid overflow policy %s. Must be one of %s" %
+                                 (overflow, ', '.join(overflow_policies)))
+        if workers < 1:
+            raise InterceptError("an intercept pool needs at least one worker")
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.metrics = InterceptMetrics()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.async_limit = async_limit
+        self.async_runner = None
+        self.handler = None
+        self.reply = None
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._unfinished = 0 # messages put on the queue that haven't been replied to
+        self._done = threading.Condition()
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    @property
+    def in_flight(self):
+        # number of coroutines waiting to finish
+        if self.async_runner is None:
+            return 0
+        return self.async_runner.in_flight
+
+    def _get_async_runner(self):
+        with self._lock:
+            if self.async_runner is None:
+                self.async_runner = AsyncRunner(self.async_limit)
+            return self.async_runner
+
+    def start(self, handler, reply):
+        self.handler = handler
+        self.reply = reply
+        for _ in range(self.workers):
+            t = threading.Thread(target=self._work, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def put(self, msg, arg=None):
+        """
+        Queue a message from the proxy, applying the overflow policy if the
+        queue is full. arg is passed to the handler with the message.
+        """
+        item = (time.time(), msg, arg)
+        with self._done:
+            self._unfinished += 1
+        if self.overflow == "block":
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self._message_finished()
+                self.metrics.overflowed(self.overflow)
+                if self.overflow == "forward":
+                    self.reply(forward_reply(msg))
+                else:
+                    self.reply(drop_reply(msg))
+                return
+        self.metrics.message_received(self.queue.qsize())
+
+    def skip(self, msg):
+        """
+        Forward a message unmodified without queueing it
+        """
+        self.metrics.message_skipped()
+        self.reply(forward_reply(msg))
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                start, msg, arg = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                ret = self.handler(msg, arg)
+            except Exception as e:
+                ret = e
+            if inspect.isawaitable(ret):
+                def callback(result, exc, start=start, msg=msg):
+                    self._finish(start, msg, exc if exc is not None else result)
+                self._get_async_runner().submit(ret, callback)
+            elif not self._finish(start, msg, ret):
+                return
+
+    def _finish(self, start, msg, ret):
+        # Send the reply for a message. Returns False if the connection is closed
+        error = False
+        if isinstance(ret, Exception):
+            log_error("error in intercepting macro: %s" % ret)
+            ret = forward_reply(msg)
+            error = True
+        try:
+            if ret is not None:
+                self.reply(ret)
+        except (SocketClosed, OSError):
+            return False
+        finally:
+            self.metrics.message_done(start, error=error)
+            self._message_finished()
+        return True
+
+    def _message_finished(self):
+        with self._done:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._done.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        Wait until every queued message has been replied to. Returns False if
+        there were still messages in the pool after timeout seconds.
+        """
+        with self._done:
+            return self._done.wait_for(lambda: self._unfinished <= 0, timeout)
+
+    def shutdown(self):
+        self._stop.set()
+        if self.async_runner is not None:
+            self.async_runner.stop()
+
+class MacroChain(InterceptMacro):
+    """
+    Passes messages through a list of macros in order. The chain ends at the
+    first macro that drops the message.
+    """
+
+    def __init__(self, stages=None, stats=None):
+        InterceptMacro.__init__(self)
+        self.name = 'chain'
+        self.stages = stages or []
+        # macro name -> MacroStats for the macros that should be timed
+        self.stats = stats if stats is not None else {}
+
+    @property
+    def names(self):
+        return [m.name for m in self.stages]
+
+    def for_message(self, msg):
+        """
+        Returns a chain of the macros whose prefilters pass a raw message or
+        None if there aren't any
+        """
+        stages = [m for m in self.stages if _passes(m, msg)]
+        if not stages:
+            return None
+        if len(stages) == len(self.stages):
+            return self
+        return MacroChain(stages, self.stats)
+
+    def mangle_request(self, request):
+        stages = [m for m in self.stages if m.intercept_requests]
+        return _run_chain(stages, "request", lambda m, r: m.mangle_request(r),
+                          request, self.stats)
+
+    def mangle_response(self, request, response):
+        stages = [m for m in self.stages if m.intercept_responses]
+        return _run_chain(stages, "response", lambda m, r: m.mangle_response(request, r),
+                          response, self.stats)
+
+    def mangle_websocket(self, request, response, message):
+        stages = [m for m in self.stages if m.intercept_ws]
+        return _run_chain(stages, "websocket",
+                          lambda m, w: m.mangle_websocket(request, response, w),
+                          message, self.stats)
+
+class InterceptPipeline(MacroChain):
+    """
+    Runs an ordered chain of intercepting macros on a single connection. Each
+    message is passed to every macro that intercepts its type in order and
+    the first macro to drop it ends the chain. Adding or removing macros only
+    reconnects if the set of message types that need to be intercepted
+    changes. When it does, the old connection forwards the messages it reads
+    once the new one is intercepting, since the new one mangles them. It is
+    kept open until the messages it had already read have been mangled and
+    replied to, or for at most ``drain_timeout`` seconds.
+    """
+
+    def __init__(self, client, pool_factory=InterceptPool, drain_timeout=30):
+        MacroChain.__init__(self)
+        self.name = 'pipeline'
+        self.client = client
+        self.pool_factory = pool_factory
+        self.drain_timeout = drain_timeout
+        self.conn = None
+        self._view = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<InterceptPipeline (%s)>" % ', '.join(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    @property
+    def pool(self):
+        if self.conn is None:
+            return None
+        return self.conn.int_pool
+
+    def add(self, macro):
+        """
+        Add a macro to the end of the chain
+        """
+        with self.lock:
+            if macro.name in self:
+                raise InterceptError("%s is already running" % macro.name)
+            # stages is replaced rather than modified so that workers can
+            # iterate over it without holding the lock
+            self.stages = self.stages + [macro]
+            self.stats[macro.name] = MacroStats(macro.name)
+            old = self._update()
+        self._close_old(old)
+
+    def remove(self, name):
+        with self.lock:
+            if name not in self:
+                raise InterceptError("%s is not running" % name)
+            removed = [m for m in self.stages if m.name == name]
+            self.stages = [m for m in self.stages if m.name != name]
+            self.stats.pop(name, None)
+            old = self._update()
+        self._close_old(old)
+        _stop_macros(removed)
+
+    def clear(self):
+        with self.lock:
+            removed = self.stages
+            self.stages = []
+            self.stats.clear()
+            old = self._update()
+        self._close_old(old)
+        _stop_macros(removed)
+
+    def profile(self, name, count, fname):
+        """
+        Profile the next ``count`` calls to a running macro and write the
+        stats to ``fname``
+        """
+        if name not in self.stats:
+            raise InterceptError("%s is not running" % name)
+        if count < 1:
+            raise InterceptError("must profile at least one call")
+        self.stats[name].profiler = MacroProfiler(count, fname)
+
+    def _update(self):
+        # Reconnect if the message types to intercept changed. Called with the
+        # lock held. Returns the old (connection, pool) to pass to _close_old
+        # once the lock is released
+        flags = (any(m.intercept_requests for m in self.stages),
+                 any(m.intercept_responses for m in self.stages),
+                 any(m.intercept_ws for m in self.stages))
+        current = (self.intercept_requests, self.intercept_responses, self.intercept_ws)
+        if self.conn is not None and flags == current:
+            return None
+        old = (self.conn, self.pool, self._view)
+        self.conn = None
+        self._view = None
+        self.intercept_requests, self.intercept_responses, self.intercept_ws = flags
+        if any(flags):
+            # start the new connection before retiring the old one so that no
+            # messages get through unmangled
+            view = _PipelineView(self)
+            conn = self.client.new_conn()
+            conn.intercept(view, pool=self.pool_factory())
+            self.conn = conn
+            self._view = view
+        if old[2] is not None:
+            # the new connection mangles everything from here on
+            old[2].retired = True
+        return old
+
+    def _close_old(self, old):
+        # Finish the messages the old connection's pool is holding so they
+        # aren't lost and then close it
+        if old is None or old[0] is None:
+            return
+        old_conn, old_pool, _ = old
+        if old_pool is not None and not old_pool.drain(self.drain_timeout):
+            log_error("intercepting macros took longer than %ss to finish; "
+                      "unfinished messages will be lost" % self.drain_timeout)
+        old_conn.close()
+
+class _PipelineView(MacroChain):
+    """
+    What one of a pipeline's connections intercepts with. Once the pipeline
+    has moved to a new connection, messages read from the old one are
+    forwarded without being mangled so they only go through the chain once.
+    """
+
+    def __init__(self, pipeline):
+        MacroChain.__init__(self)
+        self.name = pipeline.name
+        self.pipeline = pipeline
+        self.retired = False
+        self.intercept_requests = pipeline.intercept_requests
+        self.intercept_responses = pipeline.intercept_responses
+        self.intercept_ws = pipeline.intercept_ws
+
+    def for_message(self, msg):
+        if self.retired:
+            return None
+        return self.pipeline.for_message(msg)
+
+def _stop_macros(macros):
+    # let macros with their own resources (ie worker processes) clean up
+    for m in macros:
+        if hasattr(m, 'stop'):
+            m.stop()
+
+def _call_stage(m, hook, call, value, stats):
+    # Call a stage, timing it if it has stats
+    s = stats.get(m.name) if stats else None
+    if s is None:
+        return call(m, value)
+    return s.call(hook, lambda: call(m, value))
+
+def _run_chain(stages, hook, call, value, stats=None):
+    # Pass a value through call(stage, value) for each stage, stopping if it
+    # becomes None. Once a stage returns an awaitable the rest of the chain is
+    # returned as a coroutine.
+    for i, m in enumerate(stages):
+        value = _call_stage(m, hook, call, value, stats)
+        if inspect.isawaitable(value):
+            return _run_chain_async(stages[i+1:], hook, call, value, stats)
+        if value is None:
+            return None
+    return value
+
+async def _run_chain_async(stages, hook, call, pending, stats=None):
+    value = await pending
+    for m in stages:
+        if value is None:
+            return None
+        value = _call_stage(m, hook, call, value, stats)
+        if inspect.isawaitable(value):
+            value = await value
+    return value
+
+################
+## Process pools
+
+SHM_THRESHOLD = 64*1024
+
+def _body_attr(msg):
+    if isinstance(msg, WSMessage):
+        return 'message'
+    return '_body'
+
+def _pack(msg, threshold=SHM_THRESHOLD):
+    # Prepare a message to be sent to another process. Bodies at least
+    # threshold bytes long are copied into shared memory which must be
+    # removed with _unlink once the receiver is done with it
+    if msg is None:
+        return None
+    attr = _body_attr(msg)
+    body = getattr(msg, attr)
+    stripped = copy.copy(msg)
+    setattr(stripped, attr, b'')
+    if len(body) >= threshold:
+        shm = shared_memory.SharedMemory(create=True, size=len(body))
+        shm.buf[:len(body)] = body
+        ref = ("shm", shm.name, len(body))
+        shm.close()
+    else:
+        ref = body
+    return (stripped, attr, ref)
+
+def _unpack(packed):
+    # Copy a packed message out of shared memory. Doesn't unlink it
+    if packed is None:
+        return None
+    msg, attr, ref = packed
+    if isinstance(ref, tuple):
+        _, name, size = ref
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            body = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+    else:
+        body = ref
+    setattr(msg, attr, body)
+    return msg
+
+def _unlink(packed):
+    # Remove the shared memory of a packed message if it has any
+    if packed is None or not isinstance(packed[2], tuple):
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=packed[2][1])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+# state of a worker process
+_worker_source = None
+_worker_client = None
+
+def _watch_parent(parent_pid):
+    # Exit if the parent dies. Workers otherwise wait on the call queue
+    # forever and keep the resource tracker from removing their segments
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(1)
+
+def _worker_init(file_name, args, client_addr, parent_pid=None):
+    global _worker_source, _worker_client
+    if parent_pid is not None:
+        threading.Thread(target=_watch_parent, args=(parent_pid,), daemon=True).start()
+    module_name = os.path.basename(os.path.splitext(file_name)[0])
+    _worker_source = imp.load_source(module_name, file_name)
+    if client_addr is not None:
+        _worker_client = ProxyClient(conn_addr=client_addr)
+        _worker_client.__enter__()
+    if hasattr(_worker_source, 'init'):
+        _worker_source.init(_worker_client, args)
+
+def _worker_mangle(func_name, packed_args, threshold):
+    # the arguments are unlinked by the parent when the call is done
+    args = [_unpack(a) for a in packed_args]
+    result = getattr(_worker_source, func_name)(_worker_client, *args)
+    if inspect.isawaitable(result):
+        result = asyncio.run(result)
+    return _pack(result, threshold)
+
+class ProcessMacroPool:
+    """
+    Loads an intercepting macro file into a number of worker processes and
+    runs its mangle functions there. Each worker gets its own client
+    connected to the proxy at client_addr and the macro's init function is
+    called in every worker.
+    """
+
+    def __init__(self, file_name, args, processes, client_addr=None,
+                 threshold=SHM_THRESHOLD):
+        self.processes = processes
+        self.threshold = threshold
+        # start the resource tracker before the workers so that they inherit
+        # it and the segments they create are cleaned up if the pool dies
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(max_workers=processes,
+                                            initializer=_worker_init,
+                                            initargs=(file_name, args, client_addr, os.getpid()))
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def mangle(self, func_name, *args):
+        """
+        Call a mangle function in a worker. Returns a coroutine that returns
+        the result.
+        """
+        packed = []
+        try:
+            for a in args:
+                packed.append(_pack(a, self.threshold))
+            fut = self.executor.submit(_worker_mangle, func_name, packed, self.threshold)
+        except BaseException:
+            for a in packed:
+                _unlink(a)
+            raise
+        unpacked = {}
+
+        def done(fut):
+            # Runs however the call ends (including when it is cancelled or
+            # the pool breaks) so the shared memory is always removed even
+            # if nothing is waiting for the result any more
+            with self._lock:
+                self._pending.discard(fut)
+            for a in packed:
+                _unlink(a)
+            if fut.cancelled() or fut.exception() is not None:
+                return
+            ret = fut.result()
+            try:
+                unpacked["result"] = _unpack(ret)
+            except Exception as e:
+                unpacked["error"] = e
+            finally:
+                _unlink(ret)
+
+        with self._lock:
+            self._pending.add(fut)
+        fut.add_done_callback(done)
+
+        async def result():
+            await asyncio.wrap_future(fut)
+            if "error" in unpacked:
+                raise unpacked["error"]
+            return unpacked["result"]
+        return result()
+
+    def shutdown(self):
+        # cancel the calls that haven't started so their shared memory is
+        # removed instead of waiting on a pool that is going away
+        with self._lock:
+            pending = list(self._pending)
+        for fut in pending:
+            fut.cancel()
+        self.executor.shutdown(wait=False)
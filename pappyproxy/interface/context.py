@@ -1,6 +1,7 @@
 from itertools import groupby
 
-from ..proxy import InvalidQuery, time_to_nsecs
+from ..proxy import InvalidQuery, ProxyException, time_to_nsecs
+from ..console import CommandError
 from ..colors import Colors, Styles
 
 # class BuiltinFilters(object):
@@ -177,36 +178,35 @@ def delete_query(client, args):
         return
     client.delete_query(args[0])
 
-# @crochet.wait_for(timeout=None)
-# @defer.inlineCallbacks
-# def filter_prune(line):
-#     """
-#     Delete all out of context requests from the data file. 
-#     CANNOT BE UNDONE!! Be careful!
-#     Usage: filter_prune
-#     """
-#     # Delete filtered items from datafile
-#     print ''
-#     print 'Currently active filters:'
-#     for f in pappyproxy.pappy.main_context.active_filters:
-#         print '> %s' % f.filter_string
-
-#     # We copy so that we're not removing items from a set we're iterating over
-#     act_reqs = yield pappyproxy.pappy.main_context.get_reqs()
-#     inact_reqs = set(Request.cache.req_ids()).difference(set(act_reqs))
-#     message = 'This will delete %d/%d requests. You can NOT undo this!! Continue?' % (len(inact_reqs), (len(inact_reqs) + len(act_reqs)))
-#     #print message
-#     if not confirm(message, 'n'):
-#         defer.returnValue(None)
-    
-#     for reqid in inact_reqs:
-#         try:
-#             req = yield pappyproxy.http.Request.load_request(reqid)
-#             yield req.deep_delete()
-#         except PappyException as e:
-#             print e
-#     print 'Deleted %d requests' % len(inact_reqs)
-#     defer.returnValue(None)
+def prune(client, args):
+    """
+    Delete all out of context requests from an in-memory storage.
+    CANNOT BE UNDONE!! Be careful!
+    Usage: prune <storage prefix>
+    """
+    from ..util import confirm, print_query
+    if len(args) != 1:
+        raise CommandError("Usage: prune <storage prefix>")
+    if args[0] not in client.storage_by_prefix:
+        raise CommandError('"%s" is not a storage prefix' % args[0])
+    storage_id = client.storage_by_prefix[args[0]].storage_id
+
+    print('')
+    print('Currently active filters:')
+    print_query(client.context.query)
+
+    all_ids = [f["DbId"] for f in client.query_fields([], ["DbId"], storage=storage_id)]
+    keep = set(f["DbId"] for f in client.query_fields(client.context.query, ["DbId"],
+                                                      storage=storage_id))
+    to_delete = [i for i in all_ids if i not in keep]
+    message = 'This will delete %d/%d requests. You can NOT undo this!! Continue?' % (len(to_delete), len(all_ids))
+    if not confirm(message, 'n'):
+        return
+    try:
+        client.delete_request_ids(to_delete, storage_id)
+    except ProxyException as e:
+        raise CommandError(str(e))
+    print('Deleted %d requests' % len(to_delete))
 
 ###############
 ## Plugin hooks
@@ -223,7 +223,7 @@ def load_cmds(cmd):
         'scope_reset': (scope_reset, None),
         'scope_save': (scope_save, None),
         'list_saved_queries': (list_saved_queries, None),
-        # 'filter_prune': (filter_prune, None),
+        'prune': (prune, None),
         # 'builtin_filter': (builtin_filter, complete_builtin_filter),
         'save_query': (save_query, None),
         'load_query': (load_query, None),
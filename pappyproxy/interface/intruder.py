@@ -0,0 +1,108 @@
+import argparse
+
+from ..console import CommandError
+from ..colors import Colors, scode_color
+from ..intruder import (Attack, IntruderError, PayloadFile, PayloadList, attack_modes,
+                        parse_number_range, parse_point, run_attack)
+
+class _AddPayloadSet(argparse.Action):
+    # Keep every payload set option in the order they were given
+    def __call__(self, parser, namespace, values, option_string=None):
+        sets = getattr(namespace, self.dest) or []
+        sets.append((option_string, values))
+        setattr(namespace, self.dest, sets)
+
+def _payload_set(opt, value):
+    if opt in ('-w', '--wordlist'):
+        return PayloadFile(value)
+    if opt in ('-l', '--list'):
+        return PayloadList(value.split(','))
+    return parse_number_range(value)
+
+_row_fmt = "{:>6}  {:>6}  {:>8}  {:>8}  {:>8}  {}"
+
+def _print_result(client, res):
+    payloads = ', '.join(repr(p.decode('latin-1') if isinstance(p, bytes) else p)
+                         for p in res.payloads if p is not None)
+    req = res.request
+    if res.error is not None:
+        print(_row_fmt.format(res.index, Colors.RED + '{:>6}'.format('ERR') + Colors.ENDC, '', '', '',
+                              "%s (%s)" % (payloads, res.error)))
+        return
+    scode = ''
+    rsplen = ''
+    if req.response is not None:
+        scode = str(req.response.status_code)
+        rsplen = req.response.content_length
+    time_str = '--'
+    if req.time_start and req.time_end:
+        time_str = "%.0f" % ((req.time_end - req.time_start).total_seconds() * 1000)
+    # pad before coloring so the columns line up
+    scode_str = scode_color(scode) + '{:>6}'.format(scode) + Colors.ENDC
+    print(_row_fmt.format(res.index, scode_str, rsplen, time_str,
+                          client.get_reqid(req), payloads))
+
+def intruder(client, cargs):
+    """
+    Send a request many times with payloads put in insertion points. Payload
+    sets are used in the order they are given. Results are printed as they
+    finish and saved to the in-memory storage with the "intruder" tag.
+    Usage: intruder <reqid> -p POINT [-p POINT ...] (-w FILE | -l A,B,C | -n START-STOP[:STEP[:FMT]]) ... [-a MODE] [-j WORKERS] [-r RATE] [-t TAG]
+    """
+    parser = argparse.ArgumentParser(prog="intruder", usage=intruder.__doc__)
+    parser.add_argument('reqid')
+    parser.add_argument('-p', '--point', action='append', default=[],
+                        help='Insertion point: urlparam:NAME, postparam:NAME, cookie:NAME, header:NAME or raw:START-END')
+    parser.add_argument('-w', '--wordlist', dest='payloads', action=_AddPayloadSet,
+                        help='A file with one payload per line')
+    parser.add_argument('-l', '--list', dest='payloads', action=_AddPayloadSet,
+                        help='A comma separated list of payloads')
+    parser.add_argument('-n', '--numbers', dest='payloads', action=_AddPayloadSet,
+                        help='A range of numbers, ie 1-100, 0-1000:10 or 0-ff::%%02x')
+    parser.add_argument('-a', '--attack', choices=attack_modes, default=None,
+                        help='Attack mode. Defaults to sniper for one payload set and cluster_bomb for more')
+    parser.add_argument('-j', '--workers', type=int, default=8, help='Number of requests to send at once')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='Maximum requests per second to the host')
+    parser.add_argument('-t', '--tag', default='intruder', help='Tag to add to the results')
+    args = parser.parse_args(cargs)
+
+    if not args.point:
+        raise CommandError("at least one insertion point is needed")
+    if not args.payloads:
+        raise CommandError("at least one payload set is needed")
+    mode = args.attack
+    if mode is None:
+        mode = "sniper" if len(args.payloads) == 1 else "cluster_bomb"
+
+    base = client.req_by_id(args.reqid)
+    try:
+        points = [parse_point(p) for p in args.point]
+        psets = [_payload_set(opt, v) for opt, v in args.payloads]
+        attack = Attack(base, points, psets, mode=mode)
+    except (IntruderError, ValueError) as e:
+        raise CommandError(str(e))
+
+    total = attack.count()
+    print("Running a %s attack with %s requests" % (mode, total if total is not None else 'an unknown number of'))
+    print(_row_fmt.format('#', 'Status', 'Rsp Len', 'Time ms', 'ID', 'Payloads'))
+    try:
+        result = run_attack(client, attack, workers=args.workers, rate=args.rate,
+                            tag=args.tag, on_result=lambda r: _print_result(client, r))
+    except IntruderError as e:
+        raise CommandError(str(e))
+    rate = 0
+    if result.seconds > 0:
+        rate = result.submitted / result.seconds
+    print("Sent %d requests in %.2fs (%.1f requests/s), %d failed. Use `f tag %s` to view them" %
+          (result.submitted, result.seconds, rate, result.errors, args.tag))
+
+###############
+## Plugin hooks
+
+def load_cmds(cmd):
+    cmd.set_cmds({
+        'intruder': (intruder, None),
+    })
+    cmd.add_aliases([
+        ('intruder', 'fuzz'),
+    ])
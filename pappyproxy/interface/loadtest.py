@@ -0,0 +1,83 @@
+import argparse
+import sys
+
+from ..console import CommandError
+from ..util import print_table
+from ..loadtest import LoadTestError, run_load_test
+
+def _ms(seconds):
+    if seconds is None:
+        return '--'
+    return '%.1f' % (seconds * 1000)
+
+def _stats_row(stats, seconds):
+    rate = stats.requests / seconds if seconds > 0 else 0
+    lat = stats.latency
+    return [stats.name, stats.requests, '%.1f' % rate, stats.errors,
+            '%.1f%%' % (stats.error_rate * 100), _ms(lat.percentile(50)),
+            _ms(lat.percentile(90)), _ms(lat.percentile(99)), _ms(lat.max if lat.count else None)]
+
+def loadtest_cmd(client, cargs):
+    """
+    Send the in-context requests over and over for a while and report the
+    throughput, error rate and latency percentiles of each endpoint. Requests
+    are sent directly from pappy rather than through the proxy.
+    Usage: loadtest [-d DURATION] [-c CONCURRENCY] [-r RPS] [-H HOST] [--keep-host] [-m]
+    """
+    parser = argparse.ArgumentParser(prog="loadtest", usage=loadtest_cmd.__doc__)
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Number of seconds to run the test for')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='Number of requests to send at once. With -r, the most requests that can be in flight')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='Start this many requests per second')
+    parser.add_argument('-H', '--host', help='Send requests to this host instead (host, host:port or http(s)://host[:port])')
+    parser.add_argument('--keep-host', action='store_true', help='Keep the original Host header when -H is given')
+    parser.add_argument('-m', '--inmem', action='store_true',
+                        help='Save every request and response to the in-memory storage with the "loadtest" tag')
+    args = parser.parse_args(cargs)
+
+    reqs = client.in_context_requests()
+    if not reqs:
+        raise CommandError("No requests in context")
+    storage = client.inmem_storage.storage_id if args.inmem else None
+
+    def progress(result):
+        tot = result.total()
+        sys.stdout.write("\r%d requests, %d errors, p50 %sms" %
+                         (tot.requests, tot.errors, _ms(tot.latency.percentile(50))))
+        sys.stdout.flush()
+
+    mode = "%.1f requests/s" % args.rate if args.rate else "%d at once" % args.concurrency
+    print("Sending %d requests for %gs, %s" % (len(reqs), args.duration, mode))
+    try:
+        result = run_load_test(client, reqs, args.duration, rate=args.rate,
+                               concurrency=args.concurrency, target=args.host,
+                               keep_host=args.keep_host, storage=storage, progress=progress)
+    except LoadTestError as e:
+        raise CommandError(str(e))
+    print('')
+
+    cols = [{'name': 'Endpoint', 'width': 50}, {'name': 'Requests'}, {'name': 'Req/s'},
+            {'name': 'Errors'}, {'name': 'Error %'}, {'name': 'p50 ms'}, {'name': 'p90 ms'},
+            {'name': 'p99 ms'}, {'name': 'Max ms'}]
+    endpoints = sorted(result.endpoints.values(), key=lambda s: s.requests, reverse=True)
+    rows = [_stats_row(s, result.seconds) for s in endpoints]
+    total = result.total()
+    rows.append(_stats_row(total, result.seconds))
+    print_table(cols, rows)
+    statuses = ', '.join('%d: %d' % (s, n) for s, n in sorted(total.statuses.items()))
+    print("Statuses: %s" % (statuses or 'none'))
+    if total.failures:
+        print("%d requests got no response" % total.failures)
+    if result.missed:
+        print("%d requests weren't sent because %d were already in flight. Use a higher -c" %
+              (result.missed, args.concurrency))
+    if args.inmem:
+        print('Use `f tag loadtest` to view the saved requests')
+
+###############
+## Plugin hooks
+
+def load_cmds(cmd):
+    cmd.set_cmds({
+        'loadtest': (loadtest_cmd, None),
+    })
@@ -1,10 +1,13 @@
 from ..util import load_reqlist
+from ..console import CommandError
+from ..intercept import InterceptError, InterceptPipeline, InterceptPool, hooks
 from ..macros import macro_from_requests, MacroTemplate, load_macros
+from ..rules import RuleError, RulesMacro, load_rules
 from ..colors import Colors
 
 macro_dict = {}
 int_macro_dict = {}
-int_conns = {}
+int_pipeline = None
 
 def generate_macro(client, args):
     if len(args) == 0:
@@ -69,53 +72,89 @@ def complete_run_int_macro(text, line, begidx, endidx):
     from ..util import autocomplete_starts_with
 
     global int_macro_dict
-    strs = int_macro_dict.keys()
+    strs = list(int_macro_dict.keys()) + list(builtin_int_macros.keys())
     return autocomplete_startswith(text, strs)
 
+def _rules_macro(client):
+    rules = []
+    if client.config is not None:
+        rules = load_rules(client.config.rules)
+    return RulesMacro(rules)
+
+# intercepting macros that don't come from a file. Loaded macros with the same
+# name take precedence
+builtin_int_macros = {
+    'rules': _rules_macro,
+}
+
+def _intercept_pool(client):
+    if client.config is None:
+        return InterceptPool()
+    return InterceptPool(workers=client.config.intercept_workers,
+                         queue_size=client.config.intercept_queue_size,
+                         overflow=client.config.intercept_overflow,
+                         async_limit=client.config.intercept_async_limit)
+
+def _get_pipeline(client):
+    global int_pipeline
+    if int_pipeline is None:
+        int_pipeline = InterceptPipeline(client, pool_factory=lambda: _intercept_pool(client))
+    return int_pipeline
+
 def run_int_macro(client, args):
     global int_macro_dict
-    global int_conns
     if len(args) == 0:
         print("usage: rim [macro name]")
         return
-    if args[0] in int_conns:
+    pipeline = _get_pipeline(client)
+    if args[0] in pipeline:
         print("%s is already running!" % args[0])
         return
-    macro = int_macro_dict[args[0]]
-    macro.init(args[1:])
-    conn = client.new_conn()
-    int_conns[args[0]] = conn
-    conn.intercept(macro)
+    try:
+        if args[0] in int_macro_dict:
+            macro = int_macro_dict[args[0]]
+        elif args[0] in builtin_int_macros:
+            macro = builtin_int_macros[args[0]](client)
+        else:
+            raise CommandError("no intercepting macro named %s" % args[0])
+        macro.init(args[1:])
+        pipeline.add(macro)
+    except (InterceptError, RuleError) as e:
+        raise CommandError(str(e))
     print("Started %s" % args[0])
 
 def complete_stop_int_macro(text, line, begidx, endidx):
     from ..util import autocomplete_starts_with
 
-    global int_conns
-    strs = int_conns.keys()
+    global int_pipeline
+    strs = []
+    if int_pipeline is not None:
+        strs = int_pipeline.names
     return autocomplete_startswith(text, strs)
 
 def stop_int_macro(client, args):
-    global int_conns
     if len(args) > 0:
-        conn = int_conns[args[0]]
-        conn.close()
-        del int_conns[args[0]]
+        try:
+            _get_pipeline(client).remove(args[0])
+        except InterceptError as e:
+            raise CommandError(str(e))
         print("Stopped %s" % args[0])
     else:
         _stop_all_int_macros()
 
 def _stop_all_int_macros():
-    global int_conns
-    for k, conn in int_conns.items():
-        conn.close()
-        del int_conns[k]
+    global int_pipeline
+    if int_pipeline is None:
+        return
+    names = int_pipeline.names
+    int_pipeline.clear()
+    for k in names:
         print("Stopped %s" % k)
 
 def list_macros(client, args):
     global macro_dict
     global int_macro_dict
-    global int_conns
+    global int_pipeline
     if len(macro_dict) > 0:
         print('Loaded Macros:')
     for k, m in macro_dict.items():
@@ -125,10 +164,130 @@ def list_macros(client, args):
         print('Loaded Intercepting Macros:')
         for k, m in int_macro_dict.items():
             pstr = '  '+k
-            if k in int_conns:
-                pstr += ' (' + Colors.GREEN + 'RUNNING' + Colors.ENDC + ')'
+            if m.async_funcs:
+                pstr += ' (async)'
+            if m.processes > 0:
+                pstr += ' (%d processes)' % m.processes
+            if int_pipeline is not None and k in int_pipeline:
+                pstr += _running_str(k)
             print(pstr)
 
+    if int_pipeline is not None:
+        for k in int_pipeline.names:
+            if k in builtin_int_macros and k not in int_macro_dict:
+                print('  %s (built-in)' % k + _running_str(k))
+
+def _running_str(name):
+    # the RUNNING marker and live numbers for a macro in the pipeline
+    global int_pipeline
+    pos = int_pipeline.names.index(name) + 1
+    ret = ' (' + Colors.GREEN + 'RUNNING #%d' % pos + Colors.ENDC + ')'
+    stats = int_pipeline.stats.get(name)
+    if stats is not None:
+        m = stats.snapshot()
+        ret += ' %d calls, p50 %sms, p95 %sms, p99 %sms, %d dropped, %d errors' % \
+            (m['calls'], _fmt_ms(m['p50']), _fmt_ms(m['p95']), _fmt_ms(m['p99']),
+             m['drops'], m['errors'])
+        if stats.profiler is not None:
+            ret += ' (profiling, %d left)' % stats.profiler.remaining
+    return ret
+
+def _fmt_ms(secs):
+    if secs is None:
+        return '-'
+    return '%.1f' % (secs * 1000)
+
+def intercept_stats(client, args):
+    """
+    Show the queue depth, prefilter and overflow counts and latency of the
+    intercepting macro pipeline and the time spent in each macro
+    Usage: intercept_stats
+    """
+    from ..util import print_table
+    global int_pipeline
+    if int_pipeline is None or int_pipeline.pool is None:
+        print("No intercepting macros are running")
+        return
+    cols = [
+        {'name': 'Macros'},
+        {'name': 'Queue'},
+        {'name': 'Max Queue'},
+        {'name': 'Received'},
+        {'name': 'Done'},
+        {'name': 'Skip'},
+        {'name': 'Fwd'},
+        {'name': 'Drop'},
+        {'name': 'Err'},
+        {'name': 'p50 ms'},
+        {'name': 'p95 ms'},
+        {'name': 'p99 ms'},
+        {'name': 'Max ms'},
+    ]
+    pool = int_pipeline.pool
+    m = pool.metrics.snapshot()
+    rows = [[' -> '.join(int_pipeline.names), pool.queue_depth, m['max_queue_depth'],
+             m['received'], m['completed'], m['skipped'], m['forwarded'], m['dropped'], m['errors'],
+             _fmt_ms(m['p50']), _fmt_ms(m['p95']), _fmt_ms(m['p99']), _fmt_ms(m['max'])]]
+    print_table(cols, rows)
+    print('')
+
+    cols = [
+        {'name': 'Macro'},
+        {'name': 'Hook'},
+        {'name': 'Calls'},
+        {'name': 'Drop'},
+        {'name': 'Err'},
+        {'name': 'p50 ms'},
+        {'name': 'p95 ms'},
+        {'name': 'p99 ms'},
+        {'name': 'Max ms'},
+    ]
+    rows = []
+    for name in int_pipeline.names:
+        stats = int_pipeline.stats.get(name)
+        if stats is None:
+            continue
+        for hook in hooks:
+            m = stats.snapshot(hook)
+            if m['calls'] == 0:
+                continue
+            rows.append([name, hook, m['calls'], m['drops'], m['errors'],
+                         _fmt_ms(m['p50']), _fmt_ms(m['p95']), _fmt_ms(m['p99']), _fmt_ms(m['max'])])
+    if rows:
+        print_table(cols, rows)
+    ws_cache = int_pipeline.conn.ws_cache
+    if ws_cache.hits or ws_cache.misses:
+        print("Websocket handshakes: %d decoded, %d reused" % (ws_cache.misses, ws_cache.hits))
+
+def profile_int_macro(client, args):
+    """
+    Profile the next calls to a running intercepting macro with cProfile.
+    The stats are written to a file that can be read with pstats and a
+    summary is printed when the profile is done
+    Usage: profile_int_macro <macro name> [calls] [file]
+    """
+    global int_pipeline
+    if len(args) == 0:
+        print("usage: pim <macro name> [calls] [file]")
+        return
+    name = args[0]
+    count = 100
+    if len(args) > 1:
+        try:
+            count = int(args[1])
+        except ValueError:
+            raise CommandError("calls must be a number")
+    fname = '%s.prof' % name
+    if len(args) > 2:
+        fname = args[2]
+    if int_pipeline is None:
+        raise CommandError("%s is not running" % name)
+    try:
+        int_pipeline.profile(name, count, fname)
+    except InterceptError as e:
+        raise CommandError(str(e))
+    print("Profiling the next %d calls to %s" % (count, name))
+
 def load_cmds(cmd):
     cmd.set_cmds({
         'generate_macro': (generate_macro, None),
@@ -138,6 +297,8 @@ def load_cmds(cmd):
         'run_int_macro': (run_int_macro, complete_run_int_macro),
         'stop_int_macro': (stop_int_macro, complete_stop_int_macro),
         'list_macros': (list_macros, None),
+        'intercept_stats': (intercept_stats, None),
+        'profile_int_macro': (profile_int_macro, complete_stop_int_macro),
     })
     cmd.add_aliases([
         ('generate_macro', 'gma'),
@@ -147,4 +308,6 @@ def load_cmds(cmd):
         ('run_int_macro', 'rim'),
         ('stop_int_macro', 'sim'),
         ('list_macros', 'lsma'),
+        ('intercept_stats', 'ist'),
+        ('profile_int_macro', 'pim'),
     ])
@@ -1,168 +1,292 @@
+import asyncio
+import concurrent.futures
 import curses
+import heapq
+import itertools
 import os
+import select
 import subprocess
+import sys
 import tempfile
 import threading
+import time
 from ..macros import InterceptMacro
 from ..proxy import MessageError, parse_request, parse_response
 from ..colors import url_formatter
 
-edit_queue = []
+class EditItem:
+    """
+    A file waiting to be edited in the interceptor. ``future`` is resolved
+    with True once the editor is closed or False if the item is canceled or
+    auto-forwarded. ``processed`` is set once the macro has read the edited
+    file so the interceptor knows it can move on to the next item.
+    """
+
+    def __init__(self, fname, timeout=None):
+        self.fname = fname
+        self.deadline = None
+        if timeout:
+            self.deadline = time.time() + timeout
+        self.queued = True
+        self.future = concurrent.futures.Future()
+        self.processed = threading.Event()
+
+    def finish(self, edited=True):
+        if not self.future.done():
+            self.future.set_result(edited)
+
+class EditQueue:
+    """
+    A thread safe priority queue of files to edit. Items put at the front are
+    edited first, otherwise items are edited in the order they were added.
+    The queue can be passed to select() and becomes readable whenever its
+    contents change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._count = itertools.count()
+        self._queued = 0
+        self._rfd = None
+        self._wfd = None
+        self.closed = True
+        self.auto_forwarded = 0
+        self.notice = ''
+
+    def __len__(self):
+        return self._queued
+
+    def open(self):
+        with self._lock:
+            self._rfd, self._wfd = os.pipe()
+            os.set_blocking(self._rfd, False)
+            os.set_blocking(self._wfd, False)
+            self.closed = False
+            self.auto_forwarded = 0
+            self.notice = ''
+
+    def close(self):
+        """
+        Cancel every queued item so that they are forwarded unmodified.
+        Returns the canceled items
+        """
+        with self._lock:
+            self.closed = True
+            items = [item for _, _, item in self._heap if item.queued]
+            for item in items:
+                item.queued = False
+            self._heap = []
+            self._queued = 0
+            for fd in (self._rfd, self._wfd):
+                if fd is not None:
+                    os.close(fd)
+            self._rfd = self._wfd = None
+        for item in items:
+            item.finish(False)
+        return items
+
+    def fileno(self):
+        return self._rfd
+
+    def _wake(self):
+        # must hold the lock
+        try:
+            os.write(self._wfd, b'x')
+        except (BlockingIOError, OSError, TypeError):
+            pass
+
+    def drain(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except (BlockingIOError, OSError, TypeError):
+            pass
+
+    def put(self, fname, front=False, timeout=None):
+        item = EditItem(fname, timeout)
+        with self._lock:
+            if self.closed:
+                item.queued = False
+                item.finish(False)
+                return item
+            heapq.heappush(self._heap, (0 if front else 1, next(self._count), item))
+            self._queued += 1
+            self._wake()
+        return item
+
+    def pop(self):
+        """
+        Take the next item to edit or return None if the queue is empty
+        """
+        with self._lock:
+            while self._heap:
+                _, _, item = heapq.heappop(self._heap)
+                if item.queued:
+                    item.queued = False
+                    self._queued -= 1
+                    return item
+        return None
+
+    def remove(self, item):
+        """
+        Remove an item if it is still waiting. Returns False if it has already
+        been taken by the interceptor.
+        """
+        with self._lock:
+            if not item.queued:
+                return False
+            # the entry is skipped when it reaches the top of the heap
+            item.queued = False
+            self._queued -= 1
+            self._wake()
+            return True
+
+    def next_deadline(self):
+        with self._lock:
+            deadlines = [item.deadline for _, _, item in self._heap
+                         if item.queued and item.deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    async def wait(self, item):
+        """
+        Wait for an item to be edited. If the item times out before the
+        interceptor gets to it, it is removed from the queue and False is
+        returned.
+        """
+        fut = asyncio.wrap_future(item.future)
+        if item.deadline is None:
+            return await fut
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), max(0, item.deadline - time.time()))
+        except asyncio.TimeoutError:
+            if self.remove(item):
+                with self._lock:
+                    self.auto_forwarded += 1
+                return False
+            # it's in the editor, wait for the user
+            return await fut
+
+edit_queue = EditQueue()
+
+class _Unmodified:
+    pass
 
 class InterceptorMacro(InterceptMacro):
     """
     A class representing a macro that modifies requests as they pass through the
-    proxy
+    proxy. Messages wait on the intercept pool's event loop rather than a
+    worker thread, so any number of them can be queued. If ``timeout`` is set,
+    messages that aren't opened in the editor within that many seconds are
+    forwarded unmodified.
     """
-    def __init__(self):
+    def __init__(self, timeout=None):
         InterceptMacro.__init__(self)
         self.name = "InterceptorMacro"
+        self.timeout = timeout
 
-    def mangle_request(self, request):
-        # This function gets called to mangle/edit requests passed through the proxy
-
-        # Write original request to the temp file
+    async def _edit(self, data, parse, front=False):
+        # Edit data until parse() accepts it. Returns the parsed message, None
+        # if it was dropped or _Unmodified if it was canceled or timed out
         with tempfile.NamedTemporaryFile(delete=False) as tf:
-            tfName = tf.name
-            tf.write(request.full_message())
-
-        mangled_req = request
-        front = False
-        while True:
-            # Have the console edit the file
-            event = edit_file(tfName, front=front)
-            event.wait()
-            if event.canceled:
-                return request
-
-            # Create new mangled request from edited file
-            with open(tfName, 'rb') as f:
-                text = f.read()
+            fname = tf.name
+            tf.write(data)
 
-            os.remove(tfName)
+        item = None
+        timeout = self.timeout
+        try:
+            while True:
+                next_item = edit_queue.put(fname, front=front, timeout=timeout)
+                if item is not None:
+                    # only let the interceptor move on once the retry is queued
+                    item.processed.set()
+                item = next_item
+                edited = await edit_queue.wait(item)
+                if not edited:
+                    return _Unmodified
+
+                with open(fname, 'rb') as f:
+                    text = f.read()
+
+                # Check if dropped
+                if not text.strip():
+                    return None
+
+                try:
+                    return parse(text)
+                except MessageError as e:
+                    edit_queue.notice = str(e)
+                    # don't time out a message the user is fixing
+                    front = True
+                    timeout = None
+        finally:
+            if item is not None:
+                item.processed.set()
+            os.remove(fname)
 
-            # Check if dropped
-            if text == '':
-                return None
+    async def mangle_request(self, request):
+        # This function gets called to mangle/edit requests passed through the proxy
 
+        def parse(text):
             try:
                 mangled_req = parse_request(text)
             except MessageError as e:
-                print("could not parse request: %s" % str(e))
-                front = True
-                continue
+                raise MessageError("could not parse request: %s" % str(e))
             mangled_req.dest_host = request.dest_host
             mangled_req.dest_port = request.dest_port
             mangled_req.use_tls = request.use_tls
-            break
+            return mangled_req
+
+        mangled_req = await self._edit(request.full_message(), parse)
+        if mangled_req is _Unmodified:
+            return request
         return mangled_req
 
-    def mangle_response(self, request, response):
+    async def mangle_response(self, request, response):
         # This function gets called to mangle/edit respones passed through the proxy
 
-        # Write original response to the temp file
-        with tempfile.NamedTemporaryFile(delete=False) as tf:
-            tfName = tf.name
-            tf.write(response.full_message())
-
-        mangled_rsp = response
-        while True:
-            # Have the console edit the file
-            event = edit_file(tfName, front=True)
-            event.wait()
-            if event.canceled:
-                return response
-
-            # Create new mangled response from edited file
-            with open(tfName, 'rb') as f:
-                text = f.read()
-
-            os.remove(tfName)
-
-            # Check if dropped
-            if text == '':
-                return None
-
+        def parse(text):
             try:
-                mangled_rsp = parse_response(text)
+                return parse_response(text)
             except MessageError as e:
-                print("could not parse response: %s" % str(e))
-                front = True
-                continue
-            break
+                raise MessageError("could not parse response: %s" % str(e))
+
+        mangled_rsp = await self._edit(response.full_message(), parse, front=True)
+        if mangled_rsp is _Unmodified:
+            return response
         return mangled_rsp
 
-    def mangle_websocket(self, request, response, message):
+    async def mangle_websocket(self, request, response, message):
         # This function gets called to mangle/edit respones passed through the proxy
 
-        # Write original response to the temp file
-        with tempfile.NamedTemporaryFile(delete=False) as tf:
-            tfName = tf.name
-            tf.write(b"# ")
-            if message.to_server:
-                tf.write(b"OUTGOING to")
-            else:
-                tf.write(b"INCOMING from")
-            desturl = 'ws' + url_formatter(request)[4:] # replace http:// with ws://
-            tf.write(b' ' + desturl.encode())
-            tf.write(b" -- Note that this line is ignored\n")
-            tf.write(message.message)
-
-        mangled_msg = message
-        while True:
-            # Have the console edit the file
-            event = edit_file(tfName, front=True)
-            event.wait()
-            if event.canceled:
-                return message
-
-            # Create new mangled response from edited file
-            with open(tfName, 'rb') as f:
-                text = f.read()
-            _, text = text.split(b'\n', 1)
-
-            os.remove(tfName)
-
-            # Check if dropped
-            if text == '':
-                return None
-
-            mangled_msg.message = text
-            # if messages can be invalid, check for it here and continue if invalid
-            break
-        return mangled_msg
-
-    
-class EditEvent:
-    
-    def __init__(self):
-        self.e = threading.Event()
-        self.canceled = False
-        
-    def wait(self):
-        self.e.wait()
-        
-    def set(self):
-        self.e.set()
-        
-    def cancel(self):
-        self.canceled = True
-        self.set()
+        if message.to_server:
+            direction = b"OUTGOING to"
+        else:
+            direction = b"INCOMING from"
+        desturl = 'ws' + url_formatter(request)[4:] # replace http:// with ws://
+        data = b"# " + direction + b' ' + desturl.encode() + \
+            b" -- Note that this line is ignored\n" + message.message
+
+        def parse(text):
+            if b'\n' not in text:
+                return b''
+            return text.split(b'\n', 1)[1]
+
+        text = await self._edit(data, parse, front=True)
+        if text is _Unmodified:
+            return message
+        if text is None or text == b'':
+            return None
+        message.message = text
+        return message
 
 ###############
 ## Helper funcs
 
-def edit_file(fname, front=False):
-    global edit_queue
-    # Adds the filename to the edit queue. Returns an event that is set once
-    # the file is edited and the editor is closed
-    #e = threading.Event()
-    e = EditEvent()
-    if front:
-        edit_queue = [(fname, e, threading.current_thread())] + edit_queue
-    else:
-        edit_queue.append((fname, e, threading.current_thread()))
-    return e
+def edit_file(fname, front=False, timeout=None):
+    # Adds the filename to the edit queue. Returns an EditItem whose future is
+    # resolved once the file is edited and the editor is closed
+    return edit_queue.put(fname, front=front, timeout=timeout)
 
 def execute_repeater(client, reqid):
     #script_loc = os.path.join(pappy.session.config.pappy_dir, "plugins", "vim_repeater", "repeater.vim")
@@ -212,18 +336,38 @@ def repeater(client, args):
     req = client.req_by_id(reqid)
     execute_repeater(client, reqid)
 
+def _run_editor(fname):
+    editor = 'vi'
+    if 'EDITOR' in os.environ:
+        editor = os.environ['EDITOR']
+    additional_args = []
+    if editor == 'vim':
+        # prevent adding additional newline
+        additional_args.append('-b')
+    subprocess.call([editor, fname] + additional_args)
+
 def intercept(client, args):
     """
     Intercept requests and/or responses and edit them with before passing them along
-    Usage: intercept <reqid>
+    Usage: intercept [req] [rsp] [ws] [-t timeout]
     """
-    global edit_queue
-
     req_names = ('req', 'request', 'requests')
     rsp_names = ('rsp', 'response', 'responses')
     ws_names = ('ws', 'websocket')
 
-    mangle_macro = InterceptorMacro()
+    timeout = None
+    if client.config is not None:
+        timeout = client.config.intercept_edit_timeout
+    if '-t' in args:
+        i = args.index('-t')
+        try:
+            timeout = float(args[i+1])
+        except (IndexError, ValueError):
+            print("-t needs a number of seconds")
+            return
+        args = args[:i] + args[i+2:]
+
+    mangle_macro = InterceptorMacro(timeout=timeout)
     if any(a in req_names for a in args):
         mangle_macro.intercept_requests = True
     if any(a in rsp_names for a in args):
@@ -249,8 +393,10 @@ def intercept(client, args):
         stdscr = curses.initscr()
         curses.noecho()
         curses.cbreak()
+        # only read keys once select says there are some
         stdscr.nodelay(True)
 
+        edit_queue.open()
         conn = client.new_conn()
         try:
             conn.intercept(mangle_macro)
@@ -258,43 +404,58 @@ def intercept(client, args):
             while True:
                 stdscr.addstr(0, 0, "Currently intercepting: %s" % intercept_str)
                 stdscr.clrtoeol()
-                stdscr.addstr(1, 0, "%d item(s) in queue." % len(edit_queue))
+                status = "%d item(s) in queue." % len(edit_queue)
+                next_deadline = edit_queue.next_deadline()
+                if next_deadline is not None:
+                    status += " Next auto-forward in %ds." % max(0, next_deadline - time.time())
+                if edit_queue.auto_forwarded:
+                    status += " %d auto-forwarded." % edit_queue.auto_forwarded
+                stdscr.addstr(1, 0, status)
                 stdscr.clrtoeol()
                 if editnext:
                     stdscr.addstr(2, 0, "Waiting for next item... Press 'q' to quit or 'b' to quit waiting")
                 else:
                     stdscr.addstr(2, 0, "Press 'n' to edit the next item or 'q' to quit interceptor.")
                 stdscr.clrtoeol()
+                stdscr.addstr(3, 0, edit_queue.notice)
+                stdscr.clrtoeol()
+                stdscr.refresh()
 
+                if editnext:
+                    item = edit_queue.pop()
+                    if item is not None:
+                        editnext = False
+                        edit_queue.notice = ''
+                        _run_editor(item.fname)
+                        stdscr.clear()
+                        item.finish()
+                        # wait for the macro to read the file (and requeue it if
+                        # it doesn't parse) before showing the next item
+                        item.processed.wait()
+                        continue
+
+                # Block until a key is pressed or the queue changes. Wake up
+                # once a second to update the auto-forward countdown
+                wait = 1 if next_deadline is not None else None
+                readable, _, _ = select.select([sys.stdin, edit_queue], [], [], wait)
+                if edit_queue in readable:
+                    edit_queue.drain()
+                if sys.stdin not in readable:
+                    continue
                 c = stdscr.getch()
-                if c == ord('q'):
-                    return
-                elif c == ord('n'):
-                    editnext = True
-                elif c == ord('b'):
-                    editnext = False
-
-                if editnext and edit_queue:
-                    editnext = False
-                    (to_edit, event, t) = edit_queue.pop(0)
-                    editor = 'vi'
-                    if 'EDITOR' in os.environ:
-                        editor = os.environ['EDITOR']
-                    additional_args = []
-                    if editor == 'vim':
-                        # prevent adding additional newline
-                        additional_args.append('-b')
-                    subprocess.call([editor, to_edit] + additional_args)
-                    stdscr.clear()
-                    event.set()
-                    t.join()
+                while c != -1:
+                    if c == ord('q'):
+                        return
+                    elif c == ord('n'):
+                        editnext = True
+                    elif c == ord('b'):
+                        editnext = False
+                    c = stdscr.getch()
         finally:
+            # Forward everything that's still queued before closing the connection
+            for item in edit_queue.close():
+                item.processed.wait(1)
             conn.close()
-            # Now that the connection is closed, make sure the rest of the threads finish/error out
-            while len(edit_queue) > 0:
-                (fname, event, t) = edit_queue.pop(0)
-                event.cancel()
-                t.join()
             curses.nocbreak()
             stdscr.keypad(0)
             curses.echo()
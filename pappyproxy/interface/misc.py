@@ -2,7 +2,7 @@ import argparse
 import sys
 import tempfile
 import subprocess
-from ..util import copy_to_clipboard, confirm, printable_data, Capturing, load_reqlist
+from ..util import copy_to_clipboard, confirm, printable_data, Capturing, load_reqlist, print_table
 from ..console import CommandError
 from ..proxy import InterceptMacro
 from ..colors import url_formatter, verb_color, Colors, scode_color
@@ -76,13 +76,24 @@ def watch(client, args):
         print("Watching requests. Press <Enter> to quit...")
         input()
 
+def _print_submit_progress(prog):
+    width = 30
+    if prog.total:
+        filled = int(width * prog.done / prog.total)
+        bar = '[' + '#' * filled + ' ' * (width - filled) + '] %d/%d' % (prog.done, prog.total)
+    else:
+        bar = '%d' % prog.done
+    sys.stdout.write("\r%s %.1f req/s, %d errors, %d retries" % (bar, prog.rate, prog.errors, prog.retries))
+    sys.stdout.flush()
+
 def submit(client, cargs):
     """
     Resubmit some requests, optionally with modified headers and cookies.
 
-    Usage: submit <reqid(s)> [-h] [-m] [-u] [-p] [-o REQID] [-c [COOKIES [COOKIES ...]]] [-d [HEADERS [HEADERS ...]]]
+    Usage: submit <reqid(s)> [-h] [-m] [-u] [-p] [-o REQID] [-c [COOKIES [COOKIES ...]]] [-d [HEADERS [HEADERS ...]]] [-j WORKERS] [-r RATE] [--retries RETRIES] [--direct]
     """
     #Usage: submit reqids [-h] [-m] [-u] [-p] [-o REQID] [-c [COOKIES [COOKIES ...]]] [-d [HEADERS [HEADERS ...]]]
+    from ..submitter import SubmitError
     
     if len(cargs) == 0:
         raise CommandError("Missing request id(s)")
@@ -95,6 +106,10 @@ def submit(client, cargs):
     parser.add_argument('-c', '--cookies', nargs='*', help='Apply a cookie to requests before submitting')
     parser.add_argument('-d', '--headers', nargs='*', help='Apply a header to requests before submitting')
     parser.add_argument('-o', '--copycookies', help='Copy the cookies used in another request')
+    parser.add_argument('-j', '--workers', type=int, default=8, help='Number of requests to submit at once')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='Maximum requests per second to each host')
+    parser.add_argument('--retries', type=int, default=2, help='Number of times to retry a request that fails')
+    parser.add_argument('--direct', action='store_true', help='Send requests from pappy over keep-alive connections instead of through the proxy')
 
     reqids = cargs[0]
     args = parser.parse_args(cargs[1:])
@@ -136,16 +151,12 @@ def submit(client, cargs):
         for k, v in headers.items():
             req.headers.set(k, v)
 
-    conf_message = "You're about to submit %d requests, continue?" % len(reqs)
-    if not confirm(conf_message):
-        return
-
     # Filter unique paths
     if args.uniquepath or args.unique:
         endpoints = set()
         new_reqs = []
         for r in reqs:
-            if unique_path_and_args:
+            if args.unique:
                 s = r.url.geturl()
             else:
                 s = r.url.geturl(include_params=False)
@@ -155,20 +166,71 @@ def submit(client, cargs):
                 endpoints.add(s)
         reqs = new_reqs
 
+    conf_message = "You're about to submit %d requests, continue?" % len(reqs)
+    if not confirm(conf_message):
+        return
+
     # Tag and send them
-    for req in reqs:
-        req.tags.add('resubmitted')
-        sys.stdout.write(client.get_reqid(req) + " ")
-        sys.stdout.flush()
-        
-        storage = client.disk_storage.storage_id
-        if args.inmem:
-            storage = client.inmem_storage.storage_id
-            
-        client.submit(req, storage=storage)
+    storage = client.disk_storage.storage_id
+    if args.inmem:
+        storage = client.inmem_storage.storage_id
+    try:
+        result = client.submit_many(reqs, storage=storage, workers=args.workers,
+                                    rate=args.rate, retries=args.retries, direct=args.direct,
+                                    tags=['resubmitted'], progress=_print_submit_progress)
+    except SubmitError as e:
+        raise CommandError(str(e))
     sys.stdout.write("\n")
-    sys.stdout.flush()
+    rate = 0
+    if result.seconds > 0:
+        rate = result.submitted / result.seconds
+    print("Submitted %d requests in %.2fs (%.1f requests/s), %d failed" %
+          (result.submitted, result.seconds, rate, result.errors))
+
 
+def _fmt_limit(v):
+    return v if v else 'none'
+
+def throttle(client, cargs):
+    """
+    Show or change the limits on requests submitted to each host and how long
+    requests have waited for them. With -H, the limits apply to hosts matching
+    a glob such as *.target.org. A limit of 0 removes it.
+    Usage: throttle [-r RATE] [-b BURST] [-c CONCURRENCY] [-H HOST] [--remove HOST] [--reset]
+    """
+    parser = argparse.ArgumentParser(prog="throttle", usage=throttle.__doc__)
+    parser.add_argument('-r', '--rate', type=float, help='Requests per second to each host')
+    parser.add_argument('-b', '--burst', type=int, help='Requests that can be sent at once after being idle')
+    parser.add_argument('-c', '--concurrency', type=int, help='Requests that can be in flight to each host at once')
+    parser.add_argument('-H', '--host', help='Change the limits for hosts matching this glob instead of the defaults')
+    parser.add_argument('--remove', metavar='HOST', help='Remove the limits for a host glob')
+    parser.add_argument('--reset', action='store_true', help='Clear the wait statistics')
+    args = parser.parse_args(cargs)
+
+    gov = client.governor
+    if args.remove is not None:
+        if not gov.remove_host(args.remove):
+            raise CommandError("No limits are set for %s" % args.remove)
+    if args.rate is not None or args.burst is not None or args.concurrency is not None:
+        gov.set_limits(rate=args.rate, burst=args.burst, concurrency=args.concurrency, host=args.host)
+    elif args.host is not None:
+        raise CommandError("-H needs -r, -b or -c")
+    if args.reset:
+        gov.reset_stats()
+
+    rows = [['(default)', _fmt_limit(gov.rate), gov.burst, _fmt_limit(gov.concurrency)]]
+    for host, (rate, burst, concurrency) in sorted(gov.host_limits().items()):
+        rows.append([host, _fmt_limit(rate), burst, _fmt_limit(concurrency)])
+    print_table([{'name': 'Host'}, {'name': 'Req/s'}, {'name': 'Burst'}, {'name': 'Concurrency'}], rows)
+    stats = gov.stats()
+    if not stats:
+        return
+    print('')
+    rows = [[s.host, s.requests, s.delayed, '%.1f' % (s.mean_wait * 1000), '%.1f' % (s.max_wait * 1000),
+             s.waiting, s.in_flight] for s in stats]
+    cols = [{'name': 'Host'}, {'name': 'Requests'}, {'name': 'Delayed'}, {'name': 'Mean wait ms'},
+            {'name': 'Max wait ms'}, {'name': 'Waiting'}, {'name': 'In flight'}]
+    print_table(cols, rows)
 
 def run_with_less(client, args):
     with Capturing() as output:
@@ -183,5 +245,6 @@ def load_cmds(cmd):
         'ping': (ping, None),
         'submit': (submit, None),
         'watch': (watch, None),
+        'throttle': (throttle, None),
         'less': (run_with_less, None),
     })
@@ -0,0 +1,66 @@
+import argparse
+import time
+
+from ..console import CommandError
+from ..util import print_table
+from ..mockserver import MockError, MockServer, build_index, fallbacks, match_strategies
+from .storage import storage_from_arg
+
+def mock_cmd(client, cargs):
+    """
+    Serve the responses of the in-context requests from a local HTTP server.
+    Requests are matched by method, host, path, query parameters and body,
+    falling back to looser matches in the order given with -m. Requests that
+    don't match get a 404 or are forwarded through the proxy with --fallback forward.
+    Usage: mock [-p PORT] [-i IFACE] [-s STORAGE] [-m STRATEGY...] [-x PARAM...] [--any-host] [--fallback 404|forward] [-o STORAGE]
+    """
+    parser = argparse.ArgumentParser(prog="mock", usage=mock_cmd.__doc__)
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('-i', '--interface', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('-s', '--storage', help='Only serve requests in this storage')
+    parser.add_argument('-m', '--match', nargs='+', default=list(match_strategies), choices=match_strategies,
+                        help='Match strategies to try in order')
+    parser.add_argument('-x', '--ignore-param', nargs='+', default=[], help='Query parameters to ignore when matching')
+    parser.add_argument('--any-host', action='store_true', help='Match requests regardless of their Host header')
+    parser.add_argument('--fallback', choices=fallbacks, default='404', help='What to do with requests that don\'t match')
+    parser.add_argument('-o', '--output', help='Save forwarded requests to this storage')
+    args = parser.parse_args(cargs)
+
+    src = None
+    if args.storage is not None:
+        src = storage_from_arg(client, args.storage).storage_id
+    record = None
+    if args.output is not None:
+        if args.fallback != 'forward':
+            raise CommandError("-o can only be used with --fallback forward")
+        record = storage_from_arg(client, args.output).storage_id
+
+    start = time.time()
+    try:
+        index = build_index(client, client.context.query, storage=src, strategies=args.match,
+                            match_host=not args.any_host, ignore_params=args.ignore_param)
+        server = MockServer(index, iface=args.interface, port=args.port, fallback=args.fallback,
+                            client=client, record_storage=record)
+        server.start()
+    except MockError as e:
+        raise CommandError(str(e))
+    print("Indexed %d responses in %.2fs" % (len(index), time.time() - start))
+    print("Serving on http://%s:%d. Press <Enter> to stop..." % server.address)
+    try:
+        input()
+    finally:
+        server.stop()
+
+    rows = [[s, server.hits[s]] for s in list(args.match) + ['forward', 'miss'] if server.hits[s]]
+    if rows:
+        print_table([{'name': 'Match'}, {'name': 'Requests'}], rows)
+    else:
+        print("No requests were made")
+
+###############
+## Plugin hooks
+
+def load_cmds(cmd):
+    cmd.set_cmds({
+        'mock': (mock_cmd, None),
+    })
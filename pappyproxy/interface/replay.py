@@ -0,0 +1,88 @@
+import argparse
+import sys
+
+from ..console import CommandError
+from ..util import print_table
+from ..replay import ReplayError, replay_session
+from .storage import _free_prefix, storage_from_arg
+
+def replay_cmd(client, cargs):
+    """
+    Replay the in-context requests in the order they were made and compare the
+    results with the original responses. Replayed requests are saved to a new
+    in-memory storage unless a storage is given with -o.
+    Usage: replay [-x SPEED] [-j WORKERS] [-s STORAGE] [-o STORAGE] [--no-carry] [-a]
+    """
+    parser = argparse.ArgumentParser(prog="replay", usage=replay_cmd.__doc__)
+    parser.add_argument('-x', '--speed', type=float, default=1.0,
+                        help='Replay this many times faster than the original session. 0 sends requests as fast as possible')
+    parser.add_argument('-j', '--workers', type=int, default=8, help='Number of requests to send at once')
+    parser.add_argument('-s', '--storage', help='Only replay requests in this storage')
+    parser.add_argument('-o', '--output', help='Prefix or sqlite file of the storage to save replayed requests to')
+    parser.add_argument('--no-carry', action='store_true',
+                        help="Don't carry new cookies and CSRF tokens forward to later requests")
+    parser.add_argument('-a', '--all', action='store_true', help='Print every request that changed rather than the first 25')
+    args = parser.parse_args(cargs)
+
+    src = None
+    if args.storage is not None:
+        src = storage_from_arg(client, args.storage).storage_id
+    if args.output is not None:
+        dst = storage_from_arg(client, args.output)
+    else:
+        prefix = _free_prefix(client)
+        dst = client.add_in_memory_storage(prefix)
+    if dst.storage_id == src:
+        raise CommandError("Replayed requests can't be saved to the storage being replayed")
+
+    done = [0]
+    def progress(diff):
+        done[0] += 1
+        sys.stdout.write("\r%d requests replayed" % done[0])
+        sys.stdout.flush()
+
+    try:
+        result = replay_session(client, client.context.query, dst.storage_id, storage=src,
+                                speed=args.speed, workers=args.workers,
+                                carry=not args.no_carry, on_result=progress)
+    except ReplayError as e:
+        raise CommandError(str(e))
+    print('')
+    print('Replayed %d requests in %.2fs to storage "%s", %d failed, %d values carried forward' %
+          (result.replayed, result.seconds, dst.prefix, result.errors, result.substitutions))
+
+    changes = result.status_changes()
+    if changes:
+        print('')
+        rows = [[old, new, n] for (old, new), n in changes.most_common()]
+        print_table([{'name': 'Original'}, {'name': 'Replayed'}, {'name': 'Count'}], rows)
+
+    sized = set(id(d) for d in result.size_changes())
+    changed = [d for d in result.diffs if d.error is not None or
+               d.orig_status != d.new_status or id(d) in sized]
+    if not changed:
+        print("Every response had the same status and about the same size")
+        return
+    print('')
+    shown = changed if args.all else changed[:25]
+    rows = []
+    for d in shown:
+        rows.append([d.orig_id, d.new_id or '--', d.method, d.path,
+                     d.orig_status or '--', d.new_status or '--',
+                     d.orig_len if d.orig_len is not None else '--',
+                     d.new_len if d.new_len is not None else '--',
+                     d.error or ''])
+    cols = [{'name': 'ID'}, {'name': 'New ID'}, {'name': 'Verb'}, {'name': 'Path', 'width': 40},
+            {'name': 'Status'}, {'name': 'New Status'}, {'name': 'Rsp Len'}, {'name': 'New Len'},
+            {'name': 'Error', 'width': 30}]
+    print_table(cols, rows)
+    if len(shown) < len(changed):
+        print("Use -a to show all %d requests that changed" % len(changed))
+
+###############
+## Plugin hooks
+
+def load_cmds(cmd):
+    cmd.set_cmds({
+        'replay': (replay_cmd, None),
+    })
@@ -0,0 +1,219 @@
+import argparse
+import os
+import string
+import sys
+
+from ..console import CommandError
+from ..proxy import MessageError, ProxyException
+from ..util import print_table
+
+###############
+## Helper funcs
+
+def _free_prefix(client):
+    # `u` and `s` are reserved for unmangled requests/responses
+    for c in string.ascii_lowercase:
+        if c not in ('u', 's') and c not in client.storage_by_prefix:
+            return c
+    raise CommandError("No free storage prefixes")
+
+def storage_from_arg(client, arg):
+    """
+    Get a storage from a command argument. The argument can either be the
+    prefix of an open storage ("" for the default storage) or the path to a
+    sqlite file, which will be opened with an unused prefix.
+    """
+    if arg in client.storage_by_prefix:
+        return client.storage_by_prefix[arg]
+    if os.path.exists(arg) or arg.endswith('.db'):
+        prefix = _free_prefix(client)
+        storage = client.add_sqlite_storage(arg, prefix)
+        print('Opened {} with prefix "{}"'.format(arg, prefix))
+        return storage
+    raise CommandError('"{}" is not a storage prefix or sqlite file'.format(arg))
+
+def print_progress(done, total):
+    sys.stdout.write("\r{}/{}".format(done, total))
+    sys.stdout.flush()
+
+####################
+## Command functions
+
+def copy_requests(client, args):
+    """
+    Copy the in-context requests from one storage to another. Use "" for the
+    default storage or the path to a sqlite file to open it as a new storage.
+    Usage: copy_requests <src prefix|file> <dst prefix|file>
+    """
+    if len(args) != 2:
+        raise CommandError("Usage: copy_requests <src prefix|file> <dst prefix|file>")
+    src = storage_from_arg(client, args[0])
+    dst = storage_from_arg(client, args[1])
+    if src.storage_id == dst.storage_id:
+        raise CommandError("Source and destination must be different storages")
+    result = client.copy_requests(client.context.query, src.storage_id,
+                                  dst.storage_id, progress=print_progress)
+    print('')
+    rate = 0
+    if result.seconds > 0:
+        rate = result.copied / result.seconds
+    print("Copied {} requests in {:.2f}s ({:.1f} requests/s)".format(
+        result.copied, result.seconds, rate))
+
+def export_cmd(client, cargs):
+    """
+    Export the in-context requests to a HAR 1.2 or JSON Lines file. The file
+    is gzipped if its name ends in .gz
+    Usage: export <har|jsonl> <filename> [-j WORKERS] [-z]
+    """
+    from ..export import export_requests, export_formats, open_export_file
+    parser = argparse.ArgumentParser(prog="export", usage=export_cmd.__doc__)
+    parser.add_argument('format', choices=export_formats())
+    parser.add_argument('filename')
+    parser.add_argument('-j', '--workers', type=int, help='Number of processes to encode messages with (1 to encode in a thread)')
+    parser.add_argument('-z', '--gzip', action='store_true', default=None, help='Compress the output with gzip')
+    args = parser.parse_args(cargs)
+
+    def progress(exported):
+        sys.stdout.write("\r{} requests exported".format(exported))
+        sys.stdout.flush()
+
+    with open_export_file(args.filename, compress=args.gzip) as f:
+        exported = export_requests(client, client.context.query, f, fmt=args.format,
+                                   workers=args.workers, progress=progress)
+    print('')
+    print("Exported {} requests to {}".format(exported, args.filename))
+
+def import_cmd(client, cargs):
+    """
+    Import requests from a HAR, Burp XML, JSON Lines or pcap/pcapng file. The
+    format is guessed from the file extension if it is not given.
+    Usage: import <filename> [-f FORMAT] [-s STORAGE] [-j WORKERS]
+    """
+    from ..importer import import_file, import_formats, ImporterError
+    parser = argparse.ArgumentParser(prog="import", usage=import_cmd.__doc__)
+    parser.add_argument('filename')
+    parser.add_argument('-f', '--format', choices=import_formats(), help='Format of the file')
+    parser.add_argument('-s', '--storage', help='Prefix or sqlite file of the storage to import into. Defaults to the proxy storage')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Number of processes to decode messages with')
+    args = parser.parse_args(cargs)
+
+    storage_id = None
+    if args.storage is not None:
+        storage_id = storage_from_arg(client, args.storage).storage_id
+
+    def progress(imported, errors):
+        sys.stdout.write("\r{} requests imported, {} errors".format(imported, errors))
+        sys.stdout.flush()
+
+    try:
+        result = import_file(client, args.filename, fmt=args.format, storage=storage_id,
+                             workers=args.workers, progress=progress)
+    except ImporterError as e:
+        raise CommandError(str(e))
+    print('')
+    rate = 0
+    if result.seconds > 0:
+        rate = result.imported / result.seconds
+    print("Imported {} requests in {:.2f}s ({:.1f} requests/s), {} entries could not be parsed".format(
+        result.imported, result.seconds, rate, result.errors))
+
+def list_storage(client, args):
+    """
+    List the open storages
+    Usage: list_storage
+    """
+    for s in client.storage_iter():
+        print('{} "{}" ({})'.format(s.storage_id, s.prefix, s.type))
+
+def _fmt_limit(v):
+    return v if v else 'none'
+
+def retention_cmd(client, cargs):
+    """
+    Show or change the retention policies of in-memory storages. When a
+    storage goes over its limits, new requests go to a fresh storage with the
+    next rollover prefix and the storage that had that prefix is closed. A
+    limit of 0 removes it.
+    Usage: retention [-p PREFIX] [-n MAX_REQUESTS] [-b MAX_BYTES] [-a MAX_AGE] [-e oldest|untagged] [-r PREFIX...] [--remove PREFIX] [--now]
+    """
+    from ..retention import RetentionManager, RetentionPolicy
+    parser = argparse.ArgumentParser(prog="retention", usage=retention_cmd.__doc__)
+    parser.add_argument('-p', '--prefix', help='Prefix of the storage whose policy to change')
+    parser.add_argument('-n', '--max-requests', type=int, help='Number of requests in the storage')
+    parser.add_argument('-b', '--max-bytes', type=int, help='Total size of the messages in the storage')
+    parser.add_argument('-a', '--max-age', type=int, help='Age of the oldest request in seconds')
+    parser.add_argument('-e', '--evict', choices=RetentionPolicy.evict_modes,
+                        help='Whether storages with tagged requests can be closed')
+    parser.add_argument('-r', '--rollover', nargs='+', help='Prefixes of the storages that replace a full storage')
+    parser.add_argument('--remove', metavar='PREFIX', help='Remove the policy for a storage')
+    parser.add_argument('--now', action='store_true', help='Apply the policies now')
+    args = parser.parse_args(cargs)
+
+    if client.retention is None:
+        client.retention = RetentionManager(client, {})
+    manager = client.retention
+    if args.remove is not None:
+        if not manager.remove_policy(args.remove):
+            raise CommandError('No policy is set for "%s"' % args.remove)
+    changes = (args.max_requests, args.max_bytes, args.max_age, args.evict, args.rollover)
+    if any(v is not None for v in changes):
+        if args.prefix is None:
+            raise CommandError("-p is needed to change a policy")
+        s = client.storage_by_prefix.get(args.prefix)
+        if s is None or s.type != "inmem":
+            raise CommandError('"%s" is not an in-memory storage' % args.prefix)
+        old = manager.policies.get(args.prefix, RetentionPolicy())
+        def pick(new, cur):
+            return cur if new is None else new
+        try:
+            policy = RetentionPolicy(max_requests=pick(args.max_requests, old.max_requests),
+                                     max_bytes=pick(args.max_bytes, old.max_bytes),
+                                     max_age=pick(args.max_age, old.max_age),
+                                     evict=pick(args.evict, old.evict),
+                                     rollover=pick(args.rollover, old.rollover))
+        except ProxyException as e:
+            raise CommandError(str(e))
+        manager.set_policy(args.prefix, policy)
+    elif args.prefix is not None:
+        raise CommandError("-p needs -n, -b, -a, -e or -r")
+    if args.now:
+        manager.enforce_all()
+
+    policies = manager.policies
+    if not policies:
+        print("No retention policies are set")
+        return
+    rows = []
+    for prefix, policy in sorted(policies.items()):
+        active = manager.active_prefix(prefix)
+        requests, size = '--', '--'
+        s = client.storage_by_prefix.get(active)
+        if s is not None:
+            try:
+                usage = manager.usage(s.storage_id)
+                requests, size = usage.requests, usage.bytes
+            except MessageError as e:
+                raise CommandError(str(e))
+        rows.append([prefix, active, _fmt_limit(policy.max_requests), _fmt_limit(policy.max_bytes),
+                     _fmt_limit(policy.max_age), policy.evict, ' '.join(policy.rollover), requests, size])
+    cols = [{'name': 'Prefix'}, {'name': 'Active'}, {'name': 'Max requests'}, {'name': 'Max bytes'},
+            {'name': 'Max age'}, {'name': 'Evict'}, {'name': 'Rollover'}, {'name': 'Requests'},
+            {'name': 'Bytes'}]
+    print_table(cols, rows)
+
+###############
+## Plugin hooks
+
+def load_cmds(cmd):
+    cmd.set_cmds({
+        'copy_requests': (copy_requests, None),
+        'list_storage': (list_storage, None),
+        'export': (export_cmd, None),
+        'import': (import_cmd, None),
+        'retention': (retention_cmd, None),
+    })
+    cmd.add_aliases([
+        ('copy_requests', 'cpq'),
+        ('list_storage', 'lss'),
+    ])
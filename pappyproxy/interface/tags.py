@@ -1,6 +1,13 @@
 from ..console import CommandError
 from ..util import confirm, load_reqlist
 
+def _load_tag_targets(client, reqids):
+    # Returns a list of (db_id, storage_id) pairs. In-context requests are
+    # looked up by id only so that no message data is transferred
+    if reqids == '*':
+        return [(f["DbId"], f["StorageId"]) for f in client.in_context_fields(["DbId"])]
+    return [(r.db_id, r.storage_id) for r in load_reqlist(client, reqids, headers_only=True)]
+
 def tag_cmd(client, args):
     if len(args) == 0:
         raise CommandError("Usage: tag <tag> [reqid1] [reqid2] ...")
@@ -11,14 +18,13 @@ def tag_cmd(client, args):
         reqids = '*'
     else:
         reqids = ','.join(args[1:])
-    reqs = [r for r in load_reqlist(client, reqids, headers_only=True)]
+    reqs = _load_tag_targets(client, reqids)
     if len(reqs) > 10:
         cnt = confirm("You are about to tag {} requests with \"{}\". Continue?".format(len(reqs), tag))
         if not cnt:
             return
-    for reqh in reqs:
-        reqid = client.get_reqid(reqh)
-        client.add_tag(reqid, tag)
+    for db_id, storage_id in reqs:
+        client.add_tag(db_id, tag, storage=storage_id)
             
 def untag_cmd(client, args):
     if len(args) == 0:
@@ -30,14 +36,13 @@ def untag_cmd(client, args):
         reqids = '*'
     else:
         reqids = ','.join(args[1:])
-    reqs = [r for r in load_reqlist(client, reqids, headers_only=True)]
+    reqs = _load_tag_targets(client, reqids)
     if len(reqs) > 10:
         cnt = confirm("You are about to remove the \"{}\" tag from {} requests. Continue?".format(tag, len(reqs)))
         if not cnt:
             return
-    for reqh in reqs:
-        reqid = client.get_reqid(reqh)
-        client.remove_tag(reqid, tag)
+    for db_id, storage_id in reqs:
+        client.remove_tag(db_id, tag, storage=storage_id)
 
 def clrtag_cmd(client, args):
     if len(args) == 0:
@@ -47,14 +52,13 @@ def clrtag_cmd(client, args):
         reqids = '*'
     else:
         reqids = ','.join(args[1:])
-    reqs = [r for r in load_reqlist(client, reqids, headers_only=True)]
+    reqs = _load_tag_targets(client, reqids)
     if len(reqs) > 5:
         cnt = confirm("You are about to clear ALL TAGS from {} requests. Continue?".format(len(reqs)))
         if not cnt:
             return
-    for reqh in reqs:
-        reqid = client.get_reqid(reqh)
-        client.clear_tag(reqid)
+    for db_id, storage_id in reqs:
+        client.clear_tag(db_id, storage=storage_id)
 
 def load_cmds(cmd):
     cmd.set_cmds({
@@ -0,0 +1,81 @@
+import argparse
+import sys
+
+from ..console import CommandError
+from ..util import load_reqlist, print_table
+from ..timing import TimingError, measure_timing, replacement_variants
+
+def _us(seconds):
+    if seconds is None:
+        return '--'
+    return '%.1f' % (seconds * 1000000)
+
+def _box(result):
+    if not result:
+        return ''
+    return 'faster' if result < 0 else 'slower'
+
+def timing_cmd(client, cargs):
+    """
+    Send request variants many times in a random order and compare their
+    response times with the first variant. Each request is a variant, or with
+    -f, variants are made by replacing a string in one request.
+    Usage: timing reqids [-n ROUNDS] [-w WARMUP] [-f FIND REPLACEMENT...] [-a ALPHA] [--trim FRACTION] [--box LOW HIGH]
+    """
+    parser = argparse.ArgumentParser(prog="timing", usage=timing_cmd.__doc__)
+    parser.add_argument('reqids', help='IDs of the requests to time')
+    parser.add_argument('-n', '--rounds', type=int, default=100, help='Number of times to send each variant')
+    parser.add_argument('-w', '--warmup', type=int, default=5, help='Number of rounds to send before recording times')
+    parser.add_argument('-f', '--find', nargs='+', metavar=('FIND', 'REPLACEMENT'),
+                        help='Make variants of the request by replacing FIND with each replacement')
+    parser.add_argument('-a', '--alpha', type=float, default=0.01,
+                        help='Significance level for the Mann-Whitney test across all variants')
+    parser.add_argument('--trim', type=float, default=0.1, help='Fraction of times to drop from each end for the trimmed mean')
+    parser.add_argument('--box', type=float, nargs=2, default=[5, 10], metavar=('LOW', 'HIGH'),
+                        help='Percentiles of the box test')
+    args = parser.parse_args(cargs)
+
+    reqs = list(load_reqlist(client, args.reqids))
+    if not reqs:
+        raise CommandError("No requests to time")
+    try:
+        if args.find is not None:
+            if len(reqs) != 1 or len(args.find) < 2:
+                raise CommandError("-f needs one request, a string to find and at least one replacement")
+            variants = replacement_variants(client.get_reqid(reqs[0]), reqs[0], args.find[0], args.find[1:])
+        else:
+            variants = [(client.get_reqid(r), r) for r in reqs]
+
+        def progress(result):
+            sys.stdout.write("\rRound %d/%d" % (result.rounds, args.rounds))
+            sys.stdout.flush()
+
+        result = measure_timing(client, variants, rounds=args.rounds, warmup=args.warmup, progress=progress)
+        comparisons = result.compare(alpha=args.alpha, trim=args.trim, box=args.box)
+    except TimingError as e:
+        raise CommandError(str(e))
+    print('')
+    print("Sent %d variants %d times in %.2fs" % (len(variants), result.rounds, result.seconds))
+
+    rows = []
+    for c in comparisons:
+        rows.append([c.name, c.count, c.errors, _us(c.median), _us(c.trimmed_mean), _us(c.iqr),
+                     _us(c.diff), '%.2g' % c.p_value if c.p_value is not None else '--',
+                     _box(c.box), 'yes' if c.significant else ''])
+    cols = [{'name': 'Variant', 'width': 40}, {'name': 'Count'}, {'name': 'Errors'}, {'name': 'Median us'},
+            {'name': 'Trim mean us'}, {'name': 'IQR us'}, {'name': 'Diff us'}, {'name': 'p'},
+            {'name': 'Box'}, {'name': 'Differs'}]
+    print_table(cols, rows)
+    differ = [c.name for c in comparisons if c.significant]
+    if differ:
+        print("Response times differ from %s: %s" % (comparisons[0].name, ', '.join(differ)))
+    else:
+        print("No variant's response time differs significantly from %s" % comparisons[0].name)
+
+###############
+## Plugin hooks
+
+def load_cmds(cmd):
+    cmd.set_cmds({
+        'timing': (timing_cmd, None),
+    })
@@ -511,15 +511,13 @@ def site_map(client, args):
         paths = True
     else:
         paths = False
-    all_reqs = client.in_context_requests(headers_only=True)
-    reqs_by_host = {}
-    for req in all_reqs:
-        reqs_by_host.setdefault(req.dest_host, []).append(req)
-    for host, reqs in reqs_by_host.items():
-        paths_set = set()
-        for req in reqs:
-            if req.response and req.response.status_code != 404:
-                paths_set.add(path_tuple(req.url))
+    rows = client.aggregate(client.context.query, group_by=["host", "path", "status"])
+    paths_by_host = {}
+    for row in rows:
+        paths_set = paths_by_host.setdefault(row["host"], set())
+        if row["status"] is not None and row["status"] != 404:
+            paths_set.add(tuple(row["path"].split('/')))
+    for host, paths_set in paths_by_host.items():
         tree = sorted(list(paths_set))
         print(host)
         if paths:
@@ -529,6 +527,100 @@ def site_map(client, args):
             print_tree(tree)
         print("")
         
+def aggregate_cmd(client, args):
+    """
+    Group the in-context requests and print summary statistics for each group
+    Usage: aggregate <key1,key2,...> [metric1] [metric2] ...
+
+    Keys: host, port, tls, method, path, status
+    Metrics: count, sum(v), avg(v), min(v), max(v), p<N>(v)
+    where v is one of req_len, rsp_len, duration
+    ie: aggregate host,status count p95(duration) sum(rsp_len)
+    """
+    from ..aggregate import AggregateError
+    if not args:
+        raise CommandError("Usage: aggregate <key1,key2,...> [metric1] [metric2] ...")
+    group_by = [k for k in args[0].split(',') if k]
+    metrics = args[1:] or ["count"]
+    try:
+        rows = client.aggregate(client.context.query, group_by=group_by, metrics=metrics)
+    except AggregateError as e:
+        raise CommandError(str(e))
+    cols = [{'name': k} for k in group_by + metrics]
+    print_rows = []
+    for row in rows:
+        print_row = []
+        for k in group_by + metrics:
+            v = row[k]
+            if v is None:
+                v = '--'
+            elif isinstance(v, float):
+                v = '%.3f' % v
+            print_row.append(v)
+        print_rows.append(print_row)
+    print_table(cols, print_rows)
+
+def cluster_cmd(client, args):
+    """
+    Group the responses of the in-context requests into clusters of similar
+    responses. Small clusters are marked as outliers.
+    Usage: cluster [-d DISTANCE] [-o SIZE] [-t TAG] [-s STORAGE] [-a]
+    """
+    import argparse
+    from ..cluster import ClusterError, tag_clusters
+    from .storage import storage_from_arg
+    parser = argparse.ArgumentParser(prog="cluster", usage=cluster_cmd.__doc__)
+    parser.add_argument('-d', '--distance', type=int, default=3,
+                        help='Number of bits the body hashes of two responses in a cluster can differ by')
+    parser.add_argument('-o', '--outlier-size', type=int, default=None,
+                        help='Clusters with at most this many responses are outliers. Defaults to 1%% of the responses')
+    parser.add_argument('-t', '--tag', help='Tag the requests in outlier clusters')
+    parser.add_argument('-s', '--storage', help='Only cluster requests in this storage')
+    parser.add_argument('-a', '--all', action='store_true', help='Print every cluster rather than the first 50')
+    args = parser.parse_args(args)
+
+    storage = None
+    if args.storage is not None:
+        storage = storage_from_arg(client, args.storage).storage_id
+    try:
+        clusterer = client.cluster(client.context.query, storage=storage, distance=args.distance)
+    except ClusterError as e:
+        raise CommandError(str(e))
+    clusters = clusterer.sorted_clusters()
+    outliers = clusterer.outliers(args.outlier_size)
+    outlier_ids = set(id(c) for c in outliers)
+
+    cols = [
+        {'name': '#'},
+        {'name': 'Size'},
+        {'name': 'Status'},
+        {'name': 'Rsp Len'},
+        {'name': 'Sample'},
+        {'name': 'Outlier'},
+        {'name': 'Requests', 'width': 40},
+    ]
+    rows = []
+    shown = clusters if args.all else clusters[:50]
+    for i, c in enumerate(shown):
+        if c.min_len == c.max_len:
+            lens = str(c.min_len)
+        else:
+            lens = '%d-%d' % (c.min_len, c.max_len)
+        rows.append([i, len(c), c.status, lens, c.sample,
+                     'yes' if id(c) in outlier_ids else '',
+                     ','.join(c.reqids)])
+    print_table(cols, rows)
+    total = sum(len(c) for c in clusters)
+    print("%d responses in %d clusters, %d outliers in %d clusters" %
+          (total, len(clusters), sum(len(c) for c in outliers), len(outliers)))
+    if len(shown) < len(clusters):
+        print("Use -a to show all %d clusters" % len(clusters))
+    if clusterer.no_response:
+        print("%d requests have no response" % len(clusterer.no_response))
+    if args.tag and outliers:
+        tag_clusters(client, outliers, args.tag)
+        print('Tagged the outliers with "%s"' % args.tag)
+
 def save_request(client, args):
     if not args:
         raise CommandError("Request id is required")
@@ -712,6 +804,8 @@ def load_cmds(cmd):
         'param_info': (get_param_info, None),
         'urls': (find_urls, None),
         'site_map': (site_map, None),
+        'aggregate': (aggregate_cmd, None),
+        'cluster': (cluster_cmd, None),
         'dump_response': (dump_response, None),
         'save_request': (save_request, None),
         'save_response': (save_response, None),
@@ -733,6 +827,7 @@ def load_cmds(cmd):
         ('print_params', 'pprm'),
         ('param_info', 'pri'),
         ('site_map', 'sm'),
+        ('aggregate', 'agg'),
         ('save_request', 'savereq'),
         ('save_response', 'saversp'),
         # ('view_request_bytes', 'vbq'),
@@ -0,0 +1,389 @@
+"""
+Payload fuzzing. An Attack takes a base request, a list of insertion points
+and payload sets and generates the requests to send, which are submitted
+concurrently with submitter.submit_requests. Payload sets are iterated lazily
+so files of payloads are streamed rather than loaded, even when every
+combination of several sets is generated.
+
+Attack modes:
+
+* sniper: one payload set. Each point gets each payload in turn while the
+  other points keep their original values
+* battering_ram: one payload set. Every point gets the same payload
+* pitchfork: one payload set per point. The nth request uses the nth payload
+  of every set
+* cluster_bomb: one payload set per point. Every combination of payloads
+"""
+
+import threading
+
+from collections import namedtuple
+
+from .proxy import parse_request
+from .submitter import submit_requests
+
+class IntruderError(Exception):
+    pass
+
+IntruderResult = namedtuple("IntruderResult", ["index", "payloads", "request", "error"])
+
+def _to_str(v):
+    if isinstance(v, bytes):
+        return v.decode('latin-1')
+    return str(v)
+
+def _to_bytes(v):
+    if isinstance(v, bytes):
+        return v
+    return str(v).encode()
+
+####################
+## Insertion points
+
+class InsertionPoint:
+    """
+    A place in a request to put payloads. ``raw`` points are applied to the
+    full message before it is parsed and every other point is applied to the
+    parsed request.
+    """
+    raw = False
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, self.describe())
+
+    def describe(self):
+        return ''
+
+    def apply(self, req, payload):
+        raise NotImplementedError()
+
+class URLParamPoint(InsertionPoint):
+
+    def __init__(self, name):
+        self.name = name
+
+    def describe(self):
+        return 'urlparam:%s' % self.name
+
+    def apply(self, req, payload):
+        req.url.set_param(self.name, _to_str(payload))
+
+class BodyParamPoint(InsertionPoint):
+
+    def __init__(self, name):
+        self.name = name
+
+    def describe(self):
+        return 'postparam:%s' % self.name
+
+    def apply(self, req, payload):
+        req.set_param(self.name, _to_str(payload))
+
+class CookiePoint(InsertionPoint):
+
+    def __init__(self, name):
+        self.name = name
+
+    def describe(self):
+        return 'cookie:%s' % self.name
+
+    def apply(self, req, payload):
+        req.set_cookie(self.name, _to_str(payload))
+
+class HeaderPoint(InsertionPoint):
+
+    def __init__(self, name):
+        self.name = name
+
+    def describe(self):
+        return 'header:%s' % self.name
+
+    def apply(self, req, payload):
+        req.headers.set(self.name, _to_str(payload))
+
+class RawPoint(InsertionPoint):
+    """
+    Replaces bytes start to end (exclusive) of the full message of the base
+    request
+    """
+    raw = True
+
+    def __init__(self, start, end):
+        if start < 0 or end < start:
+            raise IntruderError("invalid raw offsets %d-%d" % (start, end))
+        self.start = start
+        self.end = end
+
+    def describe(self):
+        return 'raw:%d-%d' % (self.start, self.end)
+
+_point_types = {
+    'urlparam': URLParamPoint,
+    'uparam': URLParamPoint,
+    'postparam': BodyParamPoint,
+    'pparam': BodyParamPoint,
+    'cookie': CookiePoint,
+    'ck': CookiePoint,
+    'header': HeaderPoint,
+    'hd': HeaderPoint,
+}
+
+def parse_point(s):
+    """
+    Parse an insertion point from a string such as ``urlparam:id``,
+    ``postparam:user``, ``cookie:session``, ``header:User-Agent`` or
+    ``raw:120-128``
+    """
+    if ':' not in s:
+        raise IntruderError("invalid insertion point %s" % s)
+    kind, arg = s.split(':', 1)
+    if kind == 'raw':
+        try:
+            start, end = arg.split('-', 1)
+            return RawPoint(int(start), int(end))
+        except ValueError:
+            raise IntruderError("raw insertion points need a range of offsets (ie raw:10-20)")
+    if kind not in _point_types:
+        raise IntruderError("invalid insertion point type %s" % kind)
+    return _point_types[kind](arg)
+
+def points_from_markers(raw, marker='§'.encode()):
+    """
+    Find the insertion points marked in a raw message (ie ``id=§1§``).
+    Returns the message with the markers removed and a list of RawPoints.
+    """
+    raw = _to_bytes(raw)
+    parts = raw.split(marker)
+    if len(parts) % 2 == 0:
+        raise IntruderError("unmatched insertion point marker")
+    out = b''
+    points = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            points.append(RawPoint(len(out), len(out) + len(part)))
+        out += part
+    return out, points
+
+##############
+## Payloads
+
+class PayloadList:
+    """
+    A payload set from a list of values
+    """
+
+    def __init__(self, payloads):
+        self.payloads = list(payloads)
+
+    def __iter__(self):
+        return iter(self.payloads)
+
+    def __len__(self):
+        return len(self.payloads)
+
+class PayloadFile:
+    """
+    A payload set with one payload per line of a file. The file is read
+    lazily each time the set is iterated.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._count = None
+
+    def __iter__(self):
+        with open(self.fname, 'rb') as f:
+            for line in f:
+                yield line.rstrip(b'\r\n')
+
+    def count(self):
+        if self._count is None:
+            with open(self.fname, 'rb') as f:
+                self._count = sum(1 for _ in f)
+        return self._count
+
+class NumberRange:
+    """
+    A payload set of numbers from start to stop (inclusive) formatted with
+    ``fmt`` (ie "%04d" or "%x")
+    """
+
+    def __init__(self, start, stop, step=1, fmt="%d"):
+        if step == 0:
+            raise IntruderError("step can't be 0")
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.fmt = fmt
+
+    def __iter__(self):
+        end = self.stop + (1 if self.step > 0 else -1)
+        for i in range(self.start, end, self.step):
+            yield self.fmt % i
+
+    def __len__(self):
+        end = self.stop + (1 if self.step > 0 else -1)
+        return len(range(self.start, end, self.step))
+
+def set_size(pset):
+    # Number of payloads in a set or None if it can't be known cheaply
+    if hasattr(pset, '__len__'):
+        return len(pset)
+    if hasattr(pset, 'count'):
+        return pset.count()
+    return None
+
+def parse_number_range(s):
+    """
+    Parse a range such as ``1-100``, ``0-255:5`` or ``0-ff::%02x`` (start-stop[:step[:fmt]])
+    """
+    parts = s.split(':', 2)
+    rng = parts[0]
+    step = 1
+    fmt = "%d"
+    if len(parts) > 2:
+        fmt = parts[2]
+    base = 16 if fmt.endswith(('x', 'X')) else 10
+    try:
+        if len(parts) > 1 and parts[1]:
+            step = int(parts[1])
+        start, stop = rng.split('-', 1)
+        return NumberRange(int(start, base), int(stop, base), step, fmt)
+    except ValueError:
+        raise IntruderError("invalid number range %s" % s)
+
+###########
+## Attacks
+
+attack_modes = ("sniper", "battering_ram", "pitchfork", "cluster_bomb")
+
+def _product(psets):
+    # Like itertools.product but iterates the sets again instead of keeping
+    # them in memory
+    if not psets:
+        yield ()
+        return
+    for p in psets[0]:
+        for rest in _product(psets[1:]):
+            yield (p,) + rest
+
+class Attack:
+    """
+    Generates the requests for an attack. Iterating over an attack yields
+    (index, payloads, request) where payloads has a payload (or None) for
+    each insertion point.
+    """
+
+    def __init__(self, base, points, payloads, mode="sniper"):
+        if mode not in attack_modes:
+            raise IntruderError("invalid attack mode %s. Must be one of %s" %
+                                (mode, ', '.join(attack_modes)))
+        if not points:
+            raise IntruderError("an attack needs at least one insertion point")
+        if mode in ("sniper", "battering_ram") and len(payloads) != 1:
+            raise IntruderError("%s attacks use one payload set" % mode)
+        if mode in ("pitchfork", "cluster_bomb") and len(payloads) != len(points):
+            raise IntruderError("%s attacks need one payload set for each insertion point" % mode)
+        raw_points = sorted((p for p in points if p.raw), key=lambda p: p.start)
+        for a, b in zip(raw_points, raw_points[1:]):
+            if b.start < a.end:
+                raise IntruderError("raw insertion points can't overlap")
+        self.base = base
+        self.points = points
+        self.payloads = payloads
+        self.mode = mode
+        self._raw_base = base.full_message() if raw_points else None
+
+    def count(self):
+        """
+        The number of requests the attack will make or None if it isn't known
+        """
+        sizes = [set_size(p) for p in self.payloads]
+        if None in sizes:
+            return None
+        if self.mode == "sniper":
+            return sizes[0] * len(self.points)
+        if self.mode == "battering_ram":
+            return sizes[0]
+        if self.mode == "pitchfork":
+            return min(sizes)
+        n = 1
+        for s in sizes:
+            n *= s
+        return n
+
+    def combinations(self):
+        """
+        Yield a tuple with the payload for each insertion point (None to leave
+        the point unchanged)
+        """
+        n = len(self.points)
+        if self.mode == "sniper":
+            for i in range(n):
+                for p in self.payloads[0]:
+                    yield tuple(p if j == i else None for j in range(n))
+        elif self.mode == "battering_ram":
+            for p in self.payloads[0]:
+                yield (p,) * n
+        elif self.mode == "pitchfork":
+            for ps in zip(*self.payloads):
+                yield ps
+        else:
+            for ps in _product(self.payloads):
+                yield ps
+
+    def build(self, payloads):
+        """
+        Create the request for a tuple of payloads
+        """
+        if self._raw_base is not None:
+            raw = self._raw_base
+            # replace from the end so the earlier offsets stay valid
+            raws = [(pt, p) for pt, p in zip(self.points, payloads) if pt.raw and p is not None]
+            for pt, p in sorted(raws, key=lambda x: x[0].start, reverse=True):
+                raw = raw[:pt.start] + _to_bytes(p) + raw[pt.end:]
+            req = parse_request(raw, dest_host=self.base.dest_host,
+                                dest_port=self.base.dest_port, use_tls=self.base.use_tls)
+        else:
+            req = self.base.copy()
+        for pt, p in zip(self.points, payloads):
+            if not pt.raw and p is not None:
+                pt.apply(req, p)
+        return req
+
+    def __iter__(self):
+        for i, payloads in enumerate(self.combinations()):
+            yield i, payloads, self.build(payloads)
+
+def run_attack(client, attack, workers=8, rate=0, retries=1, storage=None,
+               tag="intruder", on_result=None, progress=None):
+    """
+    Run an attack. Requests are submitted by a pool of workers, with at most
+    ``rate`` requests per second to a host if it is non-zero, and saved to
+    ``storage`` (the in-memory storage by default) with ``tag``. on_result is
+    called with an IntruderResult as each request finishes. Returns a
+    SubmitResult.
+    """
+    if storage is None:
+        storage = client.inmem_storage.storage_id
+    info = {}
+    lock = threading.Lock()
+
+    def generate():
+        for i, payloads, req in attack:
+            with lock:
+                info[id(req)] = (i, payloads)
+            yield req
+
+    def result(req, err):
+        with lock:
+            i, payloads = info.pop(id(req), (None, None))
+        if on_result is not None:
+            on_result(IntruderResult(i, payloads, req, err))
+
+    tags = [tag] if tag else None
+    # small batches so results are shown soon after they finish
+    return submit_requests(client, generate(), workers=workers, rate=rate,
+                           retries=retries, storage=storage, tags=tags,
+                           batch_size=max(workers, 10), on_result=result,
+                           progress=progress, total=attack.count())
@@ -0,0 +1,338 @@
+"""
+Load testing with captured traffic. A set of captured requests is sent over
+and over for a fixed duration, either by a fixed number of concurrent
+workers or at a target rate of requests per second, optionally against a
+different host than they were captured from. Requests are sent directly with
+sender.HTTPSender rather than through the proxy.
+
+Latencies are recorded in a histogram for each endpoint with buckets that
+are 1% wide so memory use doesn't grow with the length of the test. When a
+target rate is given, latency is measured from when a request was supposed
+to be sent so that a slow server can't hide its latency by slowing down the
+rate requests are sent at.
+"""
+
+import asyncio
+import concurrent.futures
+import math
+import time
+
+from collections import Counter
+
+from .proxy import _clear_db_ids
+from .sender import HTTPSender, SendError
+
+class LoadTestError(Exception):
+    pass
+
+class LatencyHistogram:
+    """
+    A histogram of latencies in seconds with logarithmic buckets. Percentiles
+    are accurate to within the bucket width (1% by default).
+    """
+
+    def __init__(self, precision=0.01):
+        self._base = math.log(1 + precision)
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.min = None
+
+    def add(self, seconds):
+        us = max(seconds * 1000000, 1)
+        self.buckets[int(math.log(us) / self._base)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, pct):
+        """
+        The latency in seconds that pct percent of the values are at or below
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(pct / 100.0 * self.count)))
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                # the top of the bucket, but never more than the real max
+                return min(math.exp((b + 1) * self._base) / 1000000, self.max)
+        return self.max
+
+class EndpointStats:
+    """
+    Counts and latencies for one endpoint. ``failures`` are requests that
+    got no response and ``errors`` also includes 5xx responses.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.failures = 0
+        self.statuses = Counter()
+        self.latency = LatencyHistogram()
+        self.bytes = 0
+
+    @property
+    def errors(self):
+        return self.failures + sum(n for s, n in self.statuses.items() if s >= 500)
+
+    @property
+    def error_rate(self):
+        if self.requests == 0:
+            return 0
+        return self.errors / self.requests
+
+    def record(self, latency, status=None, size=0):
+        self.requests += 1
+        if status is None:
+            self.failures += 1
+            return
+        self.statuses[status] += 1
+        self.latency.add(latency)
+        self.bytes += size
+
+class LoadTestResult:
+    """
+    The results of a load test. ``endpoints`` maps an endpoint name to its
+    EndpointStats and ``missed`` is how many requests couldn't be sent on
+    time because the concurrency limit was reached.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.seconds = 0
+        self.missed = 0
+
+    def stats(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = EndpointStats(name)
+        return self.endpoints[name]
+
+    def total(self):
+        """
+        EndpointStats for every endpoint combined
+        """
+        tot = EndpointStats("Total")
+        for s in self.endpoints.values():
+            tot.requests += s.requests
+            tot.failures += s.failures
+            tot.statuses.update(s.statuses)
+            tot.latency.merge(s.latency)
+            tot.bytes += s.bytes
+        return tot
+
+    @property
+    def requests(self):
+        return sum(s.requests for s in self.endpoints.values())
+
+    @property
+    def rate(self):
+        if self.seconds <= 0:
+            return 0
+        return self.requests / self.seconds
+
+def endpoint_name(req):
+    return "%s %s%s" % (req.method, req.dest_host, req.url.geturl(include_params=False))
+
+def parse_target(target):
+    """
+    Parse a host override of the form host, host:port or http(s)://host[:port].
+    Returns (host, port, use_tls) where port and use_tls are None if they
+    should be kept from each request.
+    """
+    use_tls = None
+    if target.startswith("https://"):
+        use_tls = True
+        target = target[len("https://"):]
+    elif target.startswith("http://"):
+        use_tls = False
+        target = target[len("http://"):]
+    target = target.rstrip("/")
+    port = None
+    if target.startswith("["):
+        # [ipv6]:port
+        end = target.find("]")
+        if end < 0:
+            raise LoadTestError("invalid host %s" % target)
+        host, rest = target[1:end], target[end+1:]
+        if rest.startswith(":"):
+            port = rest[1:]
+    elif ":" in target:
+        host, port = target.rsplit(":", 1)
+    else:
+        host = target
+    if port is not None:
+        try:
+            port = int(port)
+        except ValueError:
+            raise LoadTestError("invalid port %s" % port)
+    elif use_tls is not None:
+        port = 443 if use_tls else 80
+    if not host:
+        raise LoadTestError("invalid host %s" % target)
+    return host, port, use_tls
+
+def _retarget(req, host, port, use_tls, keep_host):
+    if host is None:
+        return req
+    req.dest_host = host
+    if port is not None:
+        req.dest_port = port
+    if use_tls is not None:
+        req.use_tls = use_tls
+    if not keep_host:
+        default = 443 if req.use_tls else 80
+        req.headers.set("Host", host if req.dest_port == default else "%s:%d" % (host, req.dest_port))
+    return req
+
+async def _run(client, templates, duration, rate, concurrency, target, keep_host,
+               storage, batch_size, progress, result, sender):
+    loop = asyncio.get_event_loop()
+    host, port, use_tls = target
+    deadline = time.time() + duration
+    next_req = [0]
+    inflight = [0]
+    batch = []
+    saver = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    save_lock = asyncio.Lock()
+
+    def template():
+        # cycle through the captured requests
+        t = templates[next_req[0] % len(templates)]
+        next_req[0] += 1
+        return _retarget(t.copy(), host, port, use_tls, keep_host)
+
+    async def save_batch():
+        nonlocal batch
+        async with save_lock:
+            to_save, batch = batch, []
+            if to_save:
+                await loop.run_in_executor(saver, lambda: client.save_new_batch(to_save, storage=storage))
+
+    async def send(req, start):
+        name = endpoint_name(req)
+        try:
+            await sender.send(req)
+            rsp = req.response
+            result.stats(name).record(time.time() - start, rsp.status_code, len(rsp.body))
+            if storage is not None:
+                _clear_db_ids(req)
+                req.tags.add("loadtest")
+                batch.append(req)
+                if len(batch) >= batch_size:
+                    await save_batch()
+        except SendError:
+            result.stats(name).record(time.time() - start)
+
+    async def worker():
+        while time.time() < deadline:
+            await send(template(), time.time())
+
+    async def paced():
+        # open loop: requests are started on a schedule whether or not
+        # earlier ones have finished
+        tasks = set()
+
+        def done(task):
+            tasks.discard(task)
+            inflight[0] -= 1
+
+        interval = 1.0 / rate
+        start = time.time()
+        n = 0
+        while True:
+            due = start + n * interval
+            if due >= deadline:
+                break
+            wait = due - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            n += 1
+            if inflight[0] >= concurrency:
+                result.missed += 1
+                continue
+            inflight[0] += 1
+            task = asyncio.ensure_future(send(template(), due))
+            tasks.add(task)
+            task.add_done_callback(done)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def report():
+        while True:
+            await asyncio.sleep(1)
+            progress(result)
+
+    reporter = asyncio.ensure_future(report()) if progress is not None else None
+    start = time.time()
+    try:
+        if rate > 0:
+            await paced()
+        else:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        result.seconds = time.time() - start
+        await save_batch()
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        await sender.close()
+        saver.shutdown(wait=True)
+
+def run_load_test(client, reqs, duration, rate=0, concurrency=10, target=None, keep_host=False,
+                  storage=None, batch_size=100, progress=None, **sender_args):
+    """
+    Send a list of captured requests over and over for ``duration`` seconds.
+
+    rate: requests per second to start. If 0, ``concurrency`` workers send
+          requests one after another as fast as they can. Otherwise
+          concurrency is the most requests that can be in flight at once
+    target: send the requests to this host instead (see parse_target)
+    keep_host: keep the original Host header when a target is given
+    storage: if given, every response is saved to this storage with the
+             "loadtest" tag
+    progress: called with the LoadTestResult about once a second
+
+    Other keyword arguments are passed to sender.HTTPSender. Returns a
+    LoadTestResult.
+    """
+    reqs = list(reqs)
+    if not reqs:
+        raise LoadTestError("no requests to send")
+    if duration <= 0:
+        raise LoadTestError("duration must be positive")
+    if concurrency < 1:
+        raise LoadTestError("concurrency must be at least 1")
+    target = parse_target(target) if target else (None, None, None)
+    sender_args.setdefault("max_per_host", concurrency)
+    sender_args.setdefault("retries", 0)
+    try:
+        sender = HTTPSender(**sender_args)
+    except SendError as e:
+        raise LoadTestError(str(e))
+    result = LoadTestResult()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_run(client, reqs, duration, rate, concurrency, target, keep_host,
+                                     storage, batch_size, progress, result, sender))
+    finally:
+        loop.close()
+    return result
@@ -1,5 +1,6 @@
 import glob
 import imp
+import inspect
 import os
 import random
 import re
@@ -7,6 +8,8 @@ import stat
 from jinja2 import Environment, FileSystemLoader
 from collections import namedtuple
 
+from .intercept import ProcessMacroPool
+from .prefilter import PrefilterError, prefilter_from_source
 from .proxy import InterceptMacro
 
 class MacroException(Exception):
@@ -22,6 +25,9 @@ class FileInterceptMacro(InterceptMacro):
         self.file_name = filename or '' # filename we load from
         self.source = None
         self.client = client
+        self.async_funcs = [] # names of the mangle functions that are coroutines
+        self.processes = 0 # run in this many worker processes if > 0
+        self.proc_pool = None
 
         if self.file_name:
             self.load()
@@ -63,22 +69,59 @@ class FileInterceptMacro(InterceptMacro):
         else:
             self.intercept_ws = False
 
+        # async functions return a coroutine when called which the intercept
+        # pool runs on its event loop
+        self.async_funcs = []
+        for fname in ('mangle_request', 'mangle_response', 'mangle_websocket'):
+            if self.source and inspect.iscoroutinefunction(getattr(self.source, fname, None)):
+                self.async_funcs.append(fname)
+
+        # CPU heavy macros can opt in to running in worker processes by
+        # setting PROCESSES = n in the file
+        self.processes = getattr(self.source, 'PROCESSES', 0) if self.source else 0
+
+        # FILTER, HOSTS, PATH_PREFIXES and METHODS limit which messages are
+        # decoded and passed to the macro
+        self.prefilter = None
+        if self.source:
+            try:
+                self.prefilter = prefilter_from_source(self.source)
+            except PrefilterError as e:
+                raise MacroException("Invalid prefilter in %s: %s" % (self.file_name, e))
+
     def init(self, args):
+        if self.processes > 0:
+            # init is called in each of the worker processes instead
+            self.stop()
+            self.proc_pool = ProcessMacroPool(self.file_name, args, self.processes,
+                                              client_addr=self.client.maddr)
+            return
         if hasattr(self.source, 'init'):
             self.source.init(self.client, args)
 
+    def stop(self):
+        if self.proc_pool is not None:
+            self.proc_pool.shutdown()
+            self.proc_pool = None
+
     def mangle_request(self, request):
         if hasattr(self.source, 'mangle_request'):
+            if self.proc_pool is not None:
+                return self.proc_pool.mangle('mangle_request', request)
             return self.source.mangle_request(self.client, request)
         return request
 
     def mangle_response(self, request, response):
         if hasattr(self.source, 'mangle_response'):
+            if self.proc_pool is not None:
+                return self.proc_pool.mangle('mangle_response', request, response)
             return self.source.mangle_response(self.client, request, response)
         return response
 
     def mangle_websocket(self, request, response, message):
         if hasattr(self.source, 'mangle_websocket'):
+            if self.proc_pool is not None:
+                return self.proc_pool.mangle('mangle_websocket', request, response, message)
             return self.source.mangle_websocket(self.client, request, response, message)
         return message
 
@@ -0,0 +1,320 @@
+"""
+Serving recorded responses as a local HTTP server so that a client can run
+against captured data without the real servers. When the server starts, the
+responses of the requests matching a query are indexed by a normalized key
+of the request so that each lookup is a few dictionary lookups.
+
+Match strategies, tried in the order they are given:
+
+* exact: method, host, path, query parameters (in any order) and a hash of
+  the body
+* params: method, host, path and query parameters
+* path: method, host and path
+
+The host can be left out of the keys and some query parameters (such as
+cache busters) can be ignored. When several recorded requests have the same
+key, their responses are served in the order they were recorded and then
+start over.
+
+Requests that don't match anything get a 404, or are forwarded through the
+proxy to the real server. Forwarded requests are added to the index and can
+be saved to a storage so that the next run can be served offline.
+"""
+
+import asyncio
+import hashlib
+import threading
+
+from collections import Counter
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+from .proxy import MessageError, SocketClosed, parse_req_sline
+from .wire import HTTPParseError, MessageParser, header_value, request_from_parsed
+
+class MockError(Exception):
+    pass
+
+match_strategies = ("exact", "params", "path")
+fallbacks = ("404", "forward")
+
+# headers that describe the connection the response was recorded on
+_hop_headers = ("content-length", "transfer-encoding", "connection", "keep-alive")
+
+def _dechunk(rsp):
+    parser = MessageParser(is_response=True)
+    try:
+        msgs = parser.feed(rsp.full_message())
+        msgs += parser.close()
+    except HTTPParseError:
+        return rsp.body
+    return msgs[0].body if msgs else rsp.body
+
+def _serialize_response(rsp):
+    # Returns (head, body) ready to be written to a keep-alive connection
+    body = rsp.body
+    if "chunked" in ",".join(v for _, v in rsp.headers.pairs("transfer-encoding")).lower():
+        body = _dechunk(rsp)
+    head = [("HTTP/1.1 %d %s" % (rsp.status_code, rsp.reason)).encode()]
+    for k, v in rsp.headers.pairs():
+        if k.lower() not in _hop_headers:
+            head.append(("%s: %s" % (k, v)).encode())
+    head.append(b"Content-Length: " + str(len(body)).encode())
+    return b"\r\n".join(head) + b"\r\n\r\n", body
+
+def _plain_response(status, reason, msg):
+    body = msg.encode()
+    head = ("HTTP/1.1 %d %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n" %
+            (status, reason, len(body))).encode()
+    return head, body
+
+def _normal_host(host):
+    host = host.lower()
+    if host.startswith("["):
+        return host[:host.find("]")+1]
+    return host.split(":", 1)[0]
+
+class MockIndex:
+    """
+    Recorded responses indexed by normalized request keys for each match
+    strategy.
+    """
+
+    def __init__(self, strategies=match_strategies, match_host=True, ignore_params=()):
+        for s in strategies:
+            if s not in match_strategies:
+                raise MockError("invalid match strategy %s. Must be one of %s" %
+                                (s, ", ".join(match_strategies)))
+        if not strategies:
+            raise MockError("at least one match strategy is needed")
+        self.strategies = tuple(strategies)
+        self.match_host = match_host
+        self.ignore_params = set(ignore_params)
+        self._tables = {s: {} for s in self.strategies}
+        self._next = {}
+        self.origins = {} # host -> (port, use_tls) of the recorded requests
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def keys(self, method, host, path, query, body):
+        """
+        Returns a list of (strategy, key) for a request
+        """
+        host = _normal_host(host) if self.match_host else None
+        base = (method.upper(), host, unquote(path) or "/")
+        ret = []
+        params = None
+        for s in self.strategies:
+            if s == "path":
+                ret.append((s, base))
+                continue
+            if params is None:
+                params = tuple(sorted((k, v) for k, v in parse_qsl(query, keep_blank_values=True)
+                                      if k not in self.ignore_params))
+            if s == "params":
+                ret.append((s, base + (params,)))
+            else:
+                ret.append((s, base + (params, hashlib.sha1(body).digest())))
+        return ret
+
+    def add(self, req):
+        """
+        Add the response of a request. Returns False if it has no response
+        """
+        if req.response is None:
+            return False
+        host = req.headers.get("Host") if "host" in req.headers else req.dest_host
+        data = _serialize_response(req.response)
+        for s, key in self.keys(req.method, host, req.url.path, req.url.query, req.body):
+            self._tables[s].setdefault(key, []).append(data)
+        self.origins.setdefault(_normal_host(host), (req.dest_port, req.use_tls))
+        self.count += 1
+        return True
+
+    def lookup(self, method, host, path, query, body):
+        """
+        Find a recorded response. Returns ((head, body), strategy) or (None, None)
+        """
+        for s, key in self.keys(method, host, path, query, body):
+            found = self._tables[s].get(key)
+            if found:
+                i = self._next.get((s, key), 0)
+                self._next[(s, key)] = i + 1
+                return found[i % len(found)], s
+        return None, None
+
+    def reset(self):
+        """
+        Start serving every key's responses from the first one again
+        """
+        self._next = {}
+
+def build_index(client, q, storage=None, batch_size=100, **kwargs):
+    """
+    Index the responses of every request matching a query. Other keyword
+    arguments are passed to MockIndex.
+    """
+    index = MockIndex(**kwargs)
+    for reqs in client.request_batches(q, storage=storage, batch_size=batch_size):
+        for req in reqs:
+            index.add(req)
+    return index
+
+class MockServer:
+    """
+    An HTTP/1.1 server that answers requests from a MockIndex. fallback is
+    what to do when nothing matches: "404" or "forward" to send the request
+    through the proxy. Forwarded requests are saved to record_storage if it
+    is given.
+    """
+
+    def __init__(self, index, iface="127.0.0.1", port=8000, fallback="404", client=None,
+                 record_storage=None):
+        if fallback not in fallbacks:
+            raise MockError("invalid fallback %s. Must be one of %s" % (fallback, ", ".join(fallbacks)))
+        if fallback == "forward" and client is None:
+            raise MockError("forwarding requests needs a client")
+        self.index = index
+        self.iface = iface
+        self.port = port
+        self.fallback = fallback
+        self.client = client
+        self.record_storage = record_storage
+        self.hits = Counter() # strategy (or "miss"/"forward") -> count
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        if self._server is None:
+            return None
+        return self._server.sockets[0].getsockname()[:2]
+
+    def _forward(self, req):
+        # runs in a worker thread with its own connection to the proxy
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.client.new_conn()
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        try:
+            conn.submit(req, storage=self.record_storage or 0)
+        except (MessageError, SocketClosed, OSError):
+            # the connection can't be trusted after an error so the next
+            # request on this thread gets a new one
+            self._local.conn = None
+            with self._conns_lock:
+                self._conns.remove(conn)
+            conn.close()
+            raise
+        return req
+
+    async def _respond(self, parsed, writer):
+        # Write the response to a request. Returns whether to keep the
+        # connection open
+        try:
+            sline = parse_req_sline(parsed.start_line)
+        except Exception:
+            raise HTTPParseError("malformed request line: %r" % parsed.start_line)
+        target = urlsplit(sline.path)
+        host = target.netloc or header_value(parsed.headers, "host", "")
+        path, query = target.path, target.query
+        data, strategy = self.index.lookup(sline.method, host, path, query, parsed.body)
+        if data is None and sline.method == "HEAD":
+            data, strategy = self.index.lookup("GET", host, path, query, b"")
+        if data is not None:
+            self.hits[strategy] += 1
+        elif self.fallback == "forward":
+            port, use_tls = self.index.origins.get(_normal_host(host), (80, False))
+            req = request_from_parsed(parsed, dest_host=_normal_host(host).strip("[]"),
+                                      dest_port=port, use_tls=use_tls)
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._forward, req)
+                if req.response is None:
+                    raise MessageError("no response was received")
+                self.index.add(req)
+                data = _serialize_response(req.response)
+                self.hits["forward"] += 1
+            except (MessageError, SocketClosed, OSError) as e:
+                data = _plain_response(502, "Bad Gateway", "Could not forward the request: %s" % e)
+                self.hits["miss"] += 1
+        else:
+            data = _plain_response(404, "Not Found", "No recorded response for %s %s" %
+                                   (sline.method, sline.path))
+            self.hits["miss"] += 1
+        head, body = data
+        writer.write(head if sline.method == "HEAD" else head + body)
+        conn_hdr = header_value(parsed.headers, "connection", "").lower()
+        if "close" in conn_hdr:
+            return False
+        return sline.proto_minor >= 1 or "keep-alive" in conn_hdr
+
+    async def _handle(self, reader, writer):
+        parser = MessageParser(is_response=False)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for parsed in parser.feed(data):
+                    if not await self._respond(parsed, writer):
+                        await writer.drain()
+                        return
+                await writer.drain()
+        except (HTTPParseError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        """
+        Start serving in a background thread. Raises MockError if the server
+        can't listen on its port.
+        """
+        started = threading.Event()
+        error = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle, self.iface, self.port, backlog=1024))
+            except OSError as e:
+                error.append(e)
+                started.set()
+                self._loop.close()
+                return
+            started.set()
+            try:
+                self._loop.run_forever()
+            finally:
+                self._server.close()
+                tasks = asyncio.all_tasks(self._loop)
+                for t in tasks:
+                    t.cancel()
+                self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        if error:
+            raise MockError("could not listen on %s:%d: %s" % (self.iface, self.port, error[0]))
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
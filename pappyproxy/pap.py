@@ -8,6 +8,8 @@ import os
 from .proxy import HTTPRequest, ProxyClient, MessageError
 from .console import interface_loop
 from .config import ProxyConfig
+from .retention import RetentionManager, policy_from_config
+from .throttle import governor_from_config
 from .util import confirm
 
 def fmt_time(t):
@@ -90,6 +92,8 @@ def main():
     cert_dir = os.path.join(data_dir, "certs")
     
     with ProxyClient(binary=binloc, conn_addr=msg_addr, debug=args.debug) as client:
+        client.config = config
+        client.governor = governor_from_config(config.throttle)
         try:
             load_certificates(client, cert_dir)
         except MessageError as e:
@@ -114,6 +118,13 @@ def main():
                 client.inmem_storage = client.add_in_memory_storage("m")
                 client.set_proxy_storage(storage.storage_id)
 
+                policies = {}
+                for prefix, info in config.retention_policies.items():
+                    policies[prefix] = policy_from_config(info)
+                client.retention = RetentionManager(client, policies,
+                                                    interval=config.retention_interval)
+                client.retention.start()
+
                 for iface, port, transparent in config.listeners:
                     try:
                         if transparent is not None:
@@ -0,0 +1,532 @@
+"""
+Reconstructing HTTP traffic from packet captures. pcap and pcapng files are
+read one packet at a time, TCP streams are reassembled per connection and the
+HTTP/1.x messages in each stream are paired into requests and responses.
+Connections are dropped as soon as they are closed (or after being idle for a
+while) so memory use depends on the number of concurrent connections in the
+capture rather than on its size. Only plaintext HTTP can be recovered.
+"""
+
+import datetime
+import socket
+import struct
+
+from collections import deque
+
+from .wire import (MessageParser, WSFrameParser, HTTPParseError, header_value,
+                   request_from_parsed, response_from_parsed)
+
+class PcapError(Exception):
+    pass
+
+##########
+## Packets
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+_pcap_magics = {
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+}
+_pcapng_shb = b"\x0a\x0d\x0d\x0a"
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        return None
+    return data
+
+def _iter_pcap(f, magic):
+    endian, resolution = _pcap_magics[magic]
+    header = _read_exact(f, 20)
+    if header is None:
+        raise PcapError("truncated pcap header")
+    linktype = struct.unpack(endian + "HHiIII", header)[5] & 0xffff
+    rec_struct = struct.Struct(endian + "IIII")
+    while True:
+        rec = _read_exact(f, 16)
+        if rec is None:
+            return
+        ts_sec, ts_frac, incl_len, _ = rec_struct.unpack(rec)
+        data = _read_exact(f, incl_len)
+        if data is None:
+            return
+        yield (ts_sec + ts_frac * resolution, linktype, data)
+
+def _tsresol(options, endian):
+    # Find the if_tsresol option of an interface description block
+    pos = 0
+    while pos + 4 <= len(options):
+        code, length = struct.unpack(endian + "HH", options[pos:pos+4])
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            v = options[pos+4]
+            if v & 0x80:
+                return 2 ** -(v & 0x7f)
+            return 10 ** -v
+        pos += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+def _iter_pcapng(f):
+    endian = "<"
+    interfaces = []
+    first = True
+    while True:
+        head = _read_exact(f, 8)
+        if head is None:
+            return
+        if head[:4] == _pcapng_shb:
+            # the byte order magic tells us the endianness of the section
+            bom = _read_exact(f, 4)
+            if bom is None:
+                return
+            endian = "<" if bom == b"\x4d\x3c\x2b\x1a" else ">"
+            block_len = struct.unpack(endian + "I", head[4:8])[0]
+            if _read_exact(f, block_len - 12) is None:
+                return
+            interfaces = []
+            first = False
+            continue
+        if first:
+            raise PcapError("not a pcapng file")
+        block_type, block_len = struct.unpack(endian + "II", head)
+        if block_len < 12:
+            raise PcapError("invalid pcapng block length")
+        body = _read_exact(f, block_len - 8)
+        if body is None:
+            return
+        body = body[:-4]
+        if block_type == 1:
+            # interface description
+            linktype = struct.unpack(endian + "H", body[:2])[0]
+            interfaces.append((linktype, _tsresol(body[8:], endian)))
+        elif block_type == 6:
+            # enhanced packet
+            iface, ts_high, ts_low, cap_len, _ = struct.unpack(endian + "IIIII", body[:20])
+            if iface >= len(interfaces):
+                continue
+            linktype, resolution = interfaces[iface]
+            ts = ((ts_high << 32) | ts_low) * resolution
+            yield (ts, linktype, body[20:20+cap_len])
+        elif block_type == 3:
+            # simple packet, no timestamp
+            if not interfaces:
+                continue
+            yield (None, interfaces[0][0], body[4:])
+
+def iter_packets(f):
+    """
+    Yield (timestamp, linktype, data) for each packet in a pcap or pcapng
+    file object. The timestamp is in seconds since the epoch and may be None.
+    """
+    magic = _read_exact(f, 4)
+    if magic is None:
+        raise PcapError("file is empty")
+    if magic in _pcap_magics:
+        yield from _iter_pcap(f, magic)
+    elif magic == _pcapng_shb:
+        f.seek(-4, 1)
+        yield from _iter_pcapng(f)
+    else:
+        raise PcapError("not a pcap or pcapng file")
+
+def _ip_payload(linktype, data):
+    # Strip the link layer header. Returns the IP packet or None
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None
+        ethertype = struct.unpack("!H", data[12:14])[0]
+        pos = 14
+        while ethertype in (0x8100, 0x88a8) and len(data) >= pos + 4:
+            # vlan tags
+            ethertype = struct.unpack("!H", data[pos+2:pos+4])[0]
+            pos += 4
+        if ethertype not in (0x0800, 0x86dd):
+            return None
+        return data[pos:]
+    if linktype == LINKTYPE_NULL:
+        return data[4:]
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, 12, 14):
+        return data
+    if linktype == LINKTYPE_LINUX_SLL:
+        return data[16:]
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return data[20:]
+    return None
+
+def parse_tcp(linktype, data):
+    """
+    Parse a link layer frame. If it is a TCP segment, returns
+    (src, sport, dst, dport, seq, flags, payload), otherwise None
+    """
+    ip = _ip_payload(linktype, data)
+    if ip is None or len(ip) < 20:
+        return None
+    version = ip[0] >> 4
+    if version == 4:
+        ihl = (ip[0] & 0x0f) * 4
+        total_len, frag = struct.unpack("!H2xH", ip[2:8])
+        if ip[9] != 6 or (frag & 0x3fff) != 0:
+            # not TCP or a fragment
+            return None
+        src = socket.inet_ntop(socket.AF_INET, ip[12:16])
+        dst = socket.inet_ntop(socket.AF_INET, ip[16:20])
+        segment = ip[ihl:total_len]
+    elif version == 6:
+        if len(ip) < 40 or ip[6] != 6:
+            return None
+        payload_len = struct.unpack("!H", ip[4:6])[0]
+        src = socket.inet_ntop(socket.AF_INET6, ip[8:24])
+        dst = socket.inet_ntop(socket.AF_INET6, ip[24:40])
+        segment = ip[40:40+payload_len]
+    else:
+        return None
+    if len(segment) < 20:
+        return None
+    sport, dport, seq = struct.unpack("!HHI", segment[:8])
+    offset = (segment[12] >> 4) * 4
+    flags = segment[13]
+    return (src, sport, dst, dport, seq, flags, segment[offset:])
+
+#################
+## TCP reassembly
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+def _seq_diff(a, b):
+    # a - b with sequence number wraparound
+    d = (a - b) & 0xffffffff
+    if d >= 0x80000000:
+        d -= 0x100000000
+    return d
+
+class TCPStream:
+    """
+    Reassembles one direction of a TCP connection. Out of order segments are
+    held until the gap is filled. If more than max_pending bytes are waiting,
+    the gap is assumed to be lost and skipped.
+    """
+
+    def __init__(self, max_pending=1024*1024):
+        self.next_seq = None
+        self.pending = {}
+        self.pending_size = 0
+        self.max_pending = max_pending
+        self.gaps = 0
+        self.fin = False
+
+    def add(self, seq, flags, payload):
+        """
+        Add a segment. Returns the new contiguous data.
+        """
+        if flags & TCP_SYN:
+            self.next_seq = (seq + 1) & 0xffffffff
+            return b''
+        if flags & TCP_FIN:
+            self.fin = True
+        if not payload:
+            return b''
+        if self.next_seq is None:
+            # the handshake wasn't captured
+            self.next_seq = seq
+        diff = _seq_diff(seq, self.next_seq)
+        if diff > 0:
+            if seq not in self.pending:
+                self.pending[seq] = payload
+                self.pending_size += len(payload)
+            if self.pending_size > self.max_pending:
+                return self._skip_gap()
+            return b''
+        if -diff >= len(payload):
+            # retransmission
+            return b''
+        data = payload[-diff:]
+        self.next_seq = (self.next_seq + len(data)) & 0xffffffff
+        return data + self._drain()
+
+    def _drain(self):
+        out = []
+        while self.pending:
+            ready = None
+            for seq in self.pending:
+                if _seq_diff(seq, self.next_seq) <= 0:
+                    ready = seq
+                    break
+            if ready is None:
+                break
+            payload = self.pending.pop(ready)
+            self.pending_size -= len(payload)
+            skip = -_seq_diff(ready, self.next_seq)
+            if skip < len(payload):
+                out.append(payload[skip:])
+                self.next_seq = (self.next_seq + len(payload) - skip) & 0xffffffff
+        return b''.join(out)
+
+    def _skip_gap(self):
+        self.gaps += 1
+        self.next_seq = min(self.pending, key=lambda s: _seq_diff(s, self.next_seq))
+        return self._drain()
+
+#######
+## HTTP
+
+_methods = (b"GET ", b"POST ", b"PUT ", b"DELETE ", b"HEAD ", b"OPTIONS ",
+            b"PATCH ", b"TRACE ", b"CONNECT ", b"PROPFIND ")
+
+def _looks_like_request(data):
+    return data.startswith(_methods)
+
+def _datetime(ts):
+    if ts is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(ts)
+
+class HTTPFlow:
+    """
+    One TCP connection carrying HTTP/1.x. Requests are returned once their
+    response has been parsed. If the connection is upgraded to a websocket,
+    the handshake request is returned with its messages when the connection
+    closes.
+    """
+
+    def __init__(self, client, server, max_pending=1024*1024):
+        self.client = client
+        self.server = server
+        self.client_stream = TCPStream(max_pending)
+        self.server_stream = TCPStream(max_pending)
+        self.req_parser = MessageParser()
+        self.rsp_parser = MessageParser(is_response=True)
+        self.waiting = deque()
+        self.req_start = None
+        self.ws_req = None
+        self.ws_client = None
+        self.ws_server = None
+        self.broken = False
+        self.last_seen = None
+
+    def _make_request(self, parsed, ts):
+        host = header_value(parsed.headers, "host", "")
+        if host.startswith("["):
+            host = host[1:].split("]", 1)[0]
+        else:
+            host = host.split(":", 1)[0]
+        req = request_from_parsed(parsed, dest_host=host or self.server[0],
+                                  dest_port=self.server[1])
+        req.time_start = _datetime(self.req_start if self.req_start is not None else ts)
+        return req
+
+    def client_data(self, seq, flags, payload, ts):
+        data = self.client_stream.add(seq, flags, payload)
+        if not data or self.broken:
+            return []
+        if self.ws_client is not None:
+            for msg in self.ws_client.feed(data):
+                msg.timestamp = _datetime(ts) or msg.timestamp
+                self.ws_req.ws_messages.append(msg)
+            return []
+        if self.req_start is None:
+            self.req_start = ts
+        try:
+            for parsed in self.req_parser.feed(data):
+                req = self._make_request(parsed, ts)
+                self.rsp_parser.expect(req.method)
+                self.waiting.append(req)
+                self.req_start = ts
+        except HTTPParseError:
+            self.broken = True
+            return self._flush()
+        if self.req_parser.idle:
+            self.req_start = None
+        return []
+
+    def server_data(self, seq, flags, payload, ts):
+        data = self.server_stream.add(seq, flags, payload)
+        if not data or self.broken:
+            return []
+        if self.ws_server is not None:
+            for msg in self.ws_server.feed(data):
+                msg.timestamp = _datetime(ts) or msg.timestamp
+                self.ws_req.ws_messages.append(msg)
+            return []
+        done = []
+        try:
+            for parsed in self.rsp_parser.feed(data):
+                done += self._add_response(parsed, ts)
+        except HTTPParseError:
+            self.broken = True
+            return done + self._flush()
+        if self.rsp_parser.upgraded and self.ws_server is None:
+            self._start_websocket(ts)
+        return done
+
+    def _add_response(self, parsed, ts):
+        rsp = response_from_parsed(parsed)
+        if 100 <= rsp.status_code < 200 and rsp.status_code != 101:
+            return []
+        if not self.waiting:
+            return []
+        req = self.waiting.popleft()
+        req.response = rsp
+        req.time_end = _datetime(ts)
+        if rsp.status_code == 101:
+            self.ws_req = req
+            return []
+        return [req]
+
+    def _start_websocket(self, ts):
+        self.ws_client = WSFrameParser(to_server=True)
+        self.ws_server = WSFrameParser(to_server=False)
+        if self.ws_req is None:
+            return
+        for parser, leftover in ((self.ws_client, self.req_parser.take_buffer()),
+                                 (self.ws_server, self.rsp_parser.take_buffer())):
+            for msg in parser.feed(leftover):
+                msg.timestamp = _datetime(ts) or msg.timestamp
+                self.ws_req.ws_messages.append(msg)
+
+    def _flush(self):
+        # Return everything we have left, including requests with no response
+        done = []
+        if self.ws_req is not None:
+            done.append(self.ws_req)
+            self.ws_req = None
+        done += list(self.waiting)
+        self.waiting.clear()
+        return done
+
+    @property
+    def finished(self):
+        return self.client_stream.fin and self.server_stream.fin
+
+    def close(self, ts):
+        """
+        The connection is over. Returns the remaining requests.
+        """
+        done = []
+        if not self.broken and self.ws_server is None:
+            try:
+                for parsed in self.rsp_parser.close():
+                    done += self._add_response(parsed, ts)
+            except HTTPParseError:
+                pass
+        return done + self._flush()
+
+class HTTPReassembler:
+    """
+    Turns a sequence of TCP segments into HTTPRequests. Connections that have
+    not seen a packet in idle_timeout seconds are closed, and if more than
+    max_flows connections are open the least recently active one is closed.
+    """
+
+    def __init__(self, idle_timeout=300, max_flows=10000, max_pending=1024*1024):
+        self.flows = {}
+        self.ignored = {}
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.max_pending = max_pending
+        self.last_ts = 0
+        self.last_sweep = 0
+
+    def _new_flow(self, src, sport, dst, dport, flags, payload):
+        if flags & TCP_SYN and not flags & TCP_ACK:
+            return HTTPFlow((src, sport), (dst, dport), self.max_pending)
+        if flags & TCP_SYN and flags & TCP_ACK:
+            return HTTPFlow((dst, dport), (src, sport), self.max_pending)
+        if _looks_like_request(payload):
+            return HTTPFlow((src, sport), (dst, dport), self.max_pending)
+        if payload.startswith(b"HTTP/"):
+            return HTTPFlow((dst, dport), (src, sport), self.max_pending)
+        return None
+
+    def add(self, ts, segment):
+        """
+        Add a segment as returned by parse_tcp. Returns a list of completed
+        requests.
+        """
+        src, sport, dst, dport, seq, flags, payload = segment
+        if ts is None:
+            ts = self.last_ts
+        self.last_ts = ts
+        a, b = (src, sport), (dst, dport)
+        key = (a, b) if a < b else (b, a)
+
+        done = []
+        if key in self.ignored:
+            self.ignored[key] = ts
+            if flags & (TCP_FIN | TCP_RST):
+                del self.ignored[key]
+            return done
+
+        flow = self.flows.get(key)
+        if flow is None:
+            if flags & (TCP_FIN | TCP_RST):
+                return done
+            flow = self._new_flow(src, sport, dst, dport, flags, payload)
+            if flow is None:
+                if payload:
+                    self.ignored[key] = ts
+                return done
+            self.flows[key] = flow
+            if len(self.flows) > self.max_flows:
+                done += self._evict_oldest(ts)
+        flow.last_seen = ts
+
+        if a == flow.client:
+            done += flow.client_data(seq, flags, payload, ts)
+        else:
+            done += flow.server_data(seq, flags, payload, ts)
+        if flags & TCP_RST or flow.finished:
+            del self.flows[key]
+            done += flow.close(ts)
+
+        if ts - self.last_sweep > self.idle_timeout / 10:
+            done += self._sweep(ts)
+        return done
+
+    def _evict_oldest(self, ts):
+        key = min(self.flows, key=lambda k: self.flows[k].last_seen or 0)
+        return self.flows.pop(key).close(ts)
+
+    def _sweep(self, ts):
+        self.last_sweep = ts
+        cutoff = ts - self.idle_timeout
+        done = []
+        for key in [k for k, f in self.flows.items() if (f.last_seen or 0) < cutoff]:
+            done += self.flows.pop(key).close(ts)
+        for key in [k for k, t in self.ignored.items() if t < cutoff]:
+            del self.ignored[key]
+        return done
+
+    def close(self):
+        done = []
+        for flow in self.flows.values():
+            done += flow.close(self.last_ts)
+        self.flows = {}
+        self.ignored = {}
+        return done
+
+def read_pcap(fname, **kwargs):
+    """
+    Yield the HTTP requests (with their responses and websocket messages) in
+    a pcap or pcapng file. Keyword arguments are passed to HTTPReassembler.
+    """
+    reassembler = HTTPReassembler(**kwargs)
+    with open(fname, 'rb') as f:
+        for ts, linktype, data in iter_packets(f):
+            segment = parse_tcp(linktype, data)
+            if segment is None:
+                continue
+            yield from reassembler.add(ts, segment)
+    yield from reassembler.close()
@@ -0,0 +1,301 @@
+"""
+Prefilters for intercepting macros. A prefilter is checked against the raw
+message from the proxy before anything is decoded so that macros only pay for
+decoding the messages they actually want. Filters use the same filter strings
+as the context (see README.md) except for the fields that only make sense for
+saved requests (tag, before and after).
+"""
+
+import base64
+import re
+import shlex
+
+from itertools import groupby
+from urllib.parse import parse_qsl, urlparse
+
+class PrefilterError(Exception):
+    pass
+
+_field_aliases = {
+    "all": ("all",),
+    "reqbody": ("reqbody", "reqbd", "qbd", "qdata", "qdt"),
+    "rspbody": ("rspbody", "rspbd", "sbd", "sdata", "sdt"),
+    "body": ("body", "bd", "data", "dt"),
+    "wsmessage": ("wsmessage", "wsm"),
+    "method": ("method", "verb", "vb"),
+    "host": ("host", "domain", "hs", "dm"),
+    "path": ("path", "pt"),
+    "url": ("url",),
+    "statuscode": ("statuscode", "sc"),
+    "reqheader": ("reqheader", "reqhd", "qhd"),
+    "rspheader": ("rspheader", "rsphd", "shd"),
+    "header": ("header", "hd"),
+    "param": ("param", "pm"),
+    "urlparam": ("urlparam", "uparam"),
+    "postparam": ("postparam", "pparam"),
+    "rspcookie": ("rspcookie", "rspck", "sck"),
+    "reqcookie": ("reqcookie", "reqck", "qck"),
+    "cookie": ("cookie", "ck"),
+}
+_fields = {alias: name for name, aliases in _field_aliases.items() for alias in aliases}
+
+_kv_fields = {"reqheader", "rspheader", "header", "param", "urlparam",
+              "postparam", "rspcookie", "reqcookie", "cookie"}
+
+_comparer_aliases = {
+    "is": ("is",),
+    "contains": ("contains", "ct"),
+    "containsr": ("containsr", "ctr"),
+    "leneq": ("leneq",),
+    "lengt": ("lengt",),
+    "lenlt": ("lenlt",),
+}
+_comparers = {alias: name for name, aliases in _comparer_aliases.items() for alias in aliases}
+
+def _comparer(name, value):
+    # Returns a function that compares a string to value
+    try:
+        cmp = _comparers[name]
+    except KeyError:
+        raise PrefilterError("invalid comparer: %s" % name)
+    if cmp == "is":
+        return lambda s: s == value
+    if cmp == "contains":
+        return lambda s: value in s
+    if cmp == "containsr":
+        try:
+            regexp = re.compile(value)
+        except re.error as e:
+            raise PrefilterError("invalid regexp %s: %s" % (value, e))
+        return lambda s: regexp.search(s) is not None
+    try:
+        n = int(value)
+    except ValueError:
+        raise PrefilterError("%s needs a number" % cmp)
+    if cmp == "leneq":
+        return lambda s: len(s) == n
+    if cmp == "lengt":
+        return lambda s: len(s) > n
+    return lambda s: len(s) < n
+
+class RawMessage:
+    """
+    Lazily extracts the fields of a message from the proxy. Bodies are only
+    base64 decoded if a filter needs them.
+    """
+
+    def __init__(self, msg):
+        self.req = msg.get("Request")
+        self.rsp = msg.get("Response")
+        self.ws = msg.get("WSMessage")
+        self._cache = {}
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    @staticmethod
+    def _body(d, key="Body"):
+        if d is None or not d.get(key):
+            return ""
+        # latin-1 maps every byte to one character
+        return base64.b64decode(d[key]).decode("latin-1")
+
+    @staticmethod
+    def _headers(d):
+        if d is None:
+            return []
+        return [(k, v) for k, vs in (d.get("Headers") or {}).items() for v in vs]
+
+    def reqbody(self):
+        return self._cached("reqbody", lambda: self._body(self.req))
+
+    def rspbody(self):
+        return self._cached("rspbody", lambda: self._body(self.rsp))
+
+    def wsmessage(self):
+        return self._cached("wsmessage", lambda: self._body(self.ws, "Message"))
+
+    def host(self):
+        return self.req.get("DestHost", "") if self.req else ""
+
+    def method(self):
+        return self.req.get("Method", "") if self.req else ""
+
+    def full_path(self):
+        return self.req.get("Path", "") if self.req else ""
+
+    def path(self):
+        return urlparse(self.full_path()).path
+
+    def url(self):
+        if self.req is None:
+            return ""
+        use_tls = self.req.get("UseTLS", False)
+        port = self.req.get("DestPort", 0)
+        host = self.host()
+        if port != (443 if use_tls else 80):
+            host = "%s:%d" % (host, port)
+        return "%s://%s%s" % ("https" if use_tls else "http", host, self.full_path())
+
+    def statuscode(self):
+        if self.rsp is None:
+            return []
+        return [str(self.rsp.get("StatusCode", ""))]
+
+    def reqheader(self):
+        return self._headers(self.req)
+
+    def rspheader(self):
+        return self._headers(self.rsp)
+
+    def urlparam(self):
+        return parse_qsl(urlparse(self.full_path()).query, keep_blank_values=True)
+
+    def postparam(self):
+        ctype = ""
+        for k, v in self.reqheader():
+            if k.lower() == "content-type":
+                ctype = v
+        if "application/x-www-form-urlencoded" not in ctype:
+            return []
+        return parse_qsl(self.reqbody(), keep_blank_values=True)
+
+    def reqcookie(self):
+        ret = []
+        for k, v in self.reqheader():
+            if k.lower() == "cookie":
+                for c in v.split(";"):
+                    if "=" in c:
+                        ck, cv = c.split("=", 1)
+                        ret.append((ck.strip(), cv.strip()))
+        return ret
+
+    def rspcookie(self):
+        ret = []
+        for k, v in self.rspheader():
+            if k.lower() == "set-cookie":
+                c = v.split(";", 1)[0]
+                if "=" in c:
+                    ck, cv = c.split("=", 1)
+                    ret.append((ck.strip(), cv.strip()))
+        return ret
+
+    def values(self, field):
+        # A list of strings or (key, value) pairs for a field
+        if field == "all":
+            ret = [self.full_path(), self.reqbody(), self.rspbody(), self.wsmessage()]
+            for k, v in self.reqheader() + self.rspheader():
+                ret.append("%s: %s" % (k, v))
+            return ret
+        if field == "body":
+            return [self.reqbody(), self.rspbody()]
+        if field == "header":
+            return self.reqheader() + self.rspheader()
+        if field == "param":
+            return self.urlparam() + self.postparam()
+        if field == "cookie":
+            return self.reqcookie() + self.rspcookie()
+        if field in ("reqbody", "rspbody", "wsmessage", "host", "method", "path", "url"):
+            return [getattr(self, field)()]
+        return getattr(self, field)()
+
+def _compile_filter(args):
+    # Returns a function that takes a RawMessage and returns whether it passes
+    if not args:
+        raise PrefilterError("empty filter")
+    if args[0] in ("invert", "inv"):
+        inner = _compile_filter(args[1:])
+        return lambda m: not inner(m)
+    if args[0] not in _fields:
+        if args[0] in ("tag", "after", "af", "before", "b4"):
+            raise PrefilterError("%s can't be used in a prefilter" % args[0])
+        raise PrefilterError("invalid field: %s" % args[0])
+    field = _fields[args[0]]
+    if field in _kv_fields:
+        if len(args) == 3:
+            cmp = _comparer(args[1], args[2])
+            return lambda m: any(cmp(k) or cmp(v) for k, v in m.values(field))
+        if len(args) == 5:
+            kcmp = _comparer(args[1], args[2])
+            vcmp = _comparer(args[3], args[4])
+            return lambda m: any(kcmp(k) and vcmp(v) for k, v in m.values(field))
+        raise PrefilterError("%s needs either a comparer and value or two comparers and values" % field)
+    if len(args) != 3:
+        raise PrefilterError("%s needs a comparer and a value" % field)
+    cmp = _comparer(args[1], args[2])
+    return lambda m: any(cmp(v) for v in m.values(field))
+
+def parse_filter_strings(strs):
+    """
+    Turn a list of filter strings into a query. Like the filter command, each
+    string is a phrase and filters in a phrase can be separated with OR.
+    """
+    query = []
+    for s in strs:
+        args = shlex.split(s)
+        query.append([list(group) for k, group in groupby(args, lambda x: x == "OR") if not k])
+    return query
+
+class Prefilter:
+    """
+    Decides whether a message from the proxy should be passed to a macro.
+    ``query`` is a list of phrases that must all pass, each being a list of
+    filters where at least one must pass (the same format as a context
+    query). ``hosts``, ``path_prefixes`` and ``methods`` are checked first
+    and only look at the start of the request.
+    """
+
+    def __init__(self, query=None, hosts=None, path_prefixes=None, methods=None):
+        self.query = query or []
+        self.hosts = set(h.lower() for h in hosts) if hosts else None
+        self.path_prefixes = tuple(path_prefixes) if path_prefixes else None
+        self.methods = set(m.upper() for m in methods) if methods else None
+        self._phrases = [[_compile_filter(f) for f in phrase] for phrase in self.query]
+
+    def __repr__(self):
+        return "<Prefilter hosts=%s path_prefixes=%s methods=%s query=%s>" % \
+            (self.hosts, self.path_prefixes, self.methods, self.query)
+
+    def _sniff(self, req):
+        # the cheap checks that only look at the first line of the request
+        if req is None:
+            return False
+        if self.hosts is not None and req.get("DestHost", "").lower() not in self.hosts:
+            return False
+        if self.path_prefixes is not None and not req.get("Path", "").startswith(self.path_prefixes):
+            return False
+        if self.methods is not None and req.get("Method", "").upper() not in self.methods:
+            return False
+        return True
+
+    def match(self, msg):
+        """
+        Check a message from the proxy
+        """
+        if not self._sniff(msg.get("Request")):
+            return False
+        if not self._phrases:
+            return True
+        raw = RawMessage(msg)
+        for phrase in self._phrases:
+            if not any(f(raw) for f in phrase):
+                return False
+        return True
+
+def prefilter_from_source(source):
+    """
+    Build a prefilter from the FILTER, HOSTS, PATH_PREFIXES and METHODS
+    variables of a macro file. Returns None if none of them are set.
+    """
+    filters = getattr(source, 'FILTER', None)
+    hosts = getattr(source, 'HOSTS', None)
+    prefixes = getattr(source, 'PATH_PREFIXES', None)
+    methods = getattr(source, 'METHODS', None)
+    if not (filters or hosts or prefixes or methods):
+        return None
+    if isinstance(filters, str):
+        filters = [filters]
+    return Prefilter(query=parse_filter_strings(filters or []), hosts=hosts,
+                     path_prefixes=prefixes, methods=methods)
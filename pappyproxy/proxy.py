@@ -9,6 +9,7 @@ import re
 import socket
 import shlex
 import threading
+import time
 
 from collections import namedtuple
 from urllib.parse import urlparse, ParseResult, parse_qs, urlencode
@@ -45,13 +46,13 @@ class SockBuffer:
         
     def _check_newline(self):
         for chunk in self.buf:
-            if '\n' in chunk:
+            if b'\n' in chunk:
                 return True
         return False
             
     def readline(self):
         # Receive until we get a newline, raise SocketClosed if socket is closed
-        while True:
+        while not self._check_newline():
             try:
                 data = self.s.recv(8192)
             except OSError:
@@ -219,7 +220,7 @@ class URL:
     def set_param(self, key, val):
         params = self.parameters()
         params[key] = [val]
-        self.query = urlencode(params)
+        self.query = urlencode(params, doseq=True)
         
     def add_param(self, key, val):
         params = self.parameters()
@@ -227,12 +228,12 @@ class URL:
             params[key].append(val)
         else:
             params[key] = [val]
-        self.query = urlencode(params)
+        self.query = urlencode(params, doseq=True)
         
     def del_param(self, key):
         params = self.parameters()
         del params[key]
-        self.query = urlencode(params)
+        self.query = urlencode(params, doseq=True)
         
     def set_params(self, params):
         self.query = urlencode(params)
@@ -241,7 +242,7 @@ class URL:
 class InterceptMacro:
     """
     A class representing a macro that modifies requests as they pass through the
-    proxy
+    proxy. The mangle functions can also be defined with ``async def``.
     """
 
     def __init__(self):
@@ -249,6 +250,7 @@ class InterceptMacro:
         self.intercept_requests = False
         self.intercept_responses = False
         self.intercept_ws = False
+        self.prefilter = None # only intercept messages that pass this Prefilter
 
     def __repr__(self):
         return "<InterceptingMacro (%s)>" % self.name
@@ -357,7 +359,7 @@ class HTTPRequest:
     def set_param(self, key, val):
         params = self.parameters()
         params[key] = [val]
-        self.body = urlencode(params)
+        self.body = urlencode(params, doseq=True)
         
     def add_param(self, key, val):
         params = self.parameters()
@@ -365,12 +367,12 @@ class HTTPRequest:
             params[key].append(val)
         else:
             params[key] = [val]
-        self.body = urlencode(params)
+        self.body = urlencode(params, doseq=True)
         
     def del_param(self, key):
         params = self.parameters()
         del params[key]
-        self.body = urlencode(params)
+        self.body = urlencode(params, doseq=True)
         
     def set_params(self, params):
         self.body = urlencode(params)
@@ -613,6 +615,8 @@ class ProxyConnection:
         self.closed = True
         self.sock_lock_read = threading.Lock()
         self.sock_lock_write = threading.Lock()
+        # held for a whole command/reply exchange so threads can share a conn
+        self.cmd_lock = threading.RLock()
         self.kind = None
         self.addr = None
         
@@ -677,8 +681,9 @@ class ProxyConnection:
             self.sbuf.send(ln)
         
     def reqrsp_cmd(self, cmd):
-        self.submit_command(cmd)
-        ret = self.read_message()
+        with self.cmd_lock:
+            self.submit_command(cmd)
+            ret = self.read_message()
         if ret is None:
             raise Exception()
         return ret
@@ -701,7 +706,15 @@ class ProxyConnection:
         }
         if storage is not None:
             cmd["Storage"] = storage
-        result = self.reqrsp_cmd(cmd)
+        governor = None
+        if self.parent_client is not None and self.parent_client.governor.enabled:
+            governor = self.parent_client.governor
+            governor.acquire(req.dest_host)
+        try:
+            result = self.reqrsp_cmd(cmd)
+        finally:
+            if governor is not None:
+                governor.release(req.dest_host)
         if "SubmittedRequest" not in result:
             raise MessageError("no request returned")
         newreq = decode_req(result["SubmittedRequest"], storage=storage)
@@ -724,7 +737,45 @@ class ProxyConnection:
         req.storage_id = storage
         return result["DbId"]
     
-    def _query_storage(self, q, storage, headers_only=False, max_results=0):
+    @messagingFunction
+    def save_new_batch(self, reqs, storage):
+        # Send every SaveNew command before reading any of the results so
+        # that the whole batch only waits on the backend once. All of the
+        # results are read even if one fails to keep the connection in sync
+        db_ids = []
+        err = None
+        with self.cmd_lock:
+            for req in reqs:
+                cmd = {
+                    "Command": "SaveNew",
+                    "Request": encode_req(req),
+                    "Storage": storage,
+                }
+                self.submit_command(cmd)
+            for req in reqs:
+                try:
+                    result = self.read_message()
+                except MessageError as e:
+                    err = e
+                    db_ids.append(None)
+                    continue
+                req.db_id = result["DbId"]
+                req.storage_id = storage
+                db_ids.append(result["DbId"])
+        if err is not None:
+            raise err
+        return db_ids
+
+    @messagingFunction
+    def reqs_by_ids(self, reqids, storage, headers_only=False):
+        if len(reqids) == 0:
+            return []
+        q = [[["dbid", "is", reqid] for reqid in reqids]]
+        return self._query_storage(q, storage, headers_only=headers_only)
+
+    def _query_storage_raw(self, q, storage, headers_only=False, max_results=0):
+        # Returns the encoded results of a query with the unmangled versions
+        # of requests removed
         cmd = {
             "Command": "StorageQuery",
             "Query": q,
@@ -733,19 +784,39 @@ class ProxyConnection:
             "Storage": storage,
         }
         result = self.reqrsp_cmd(cmd)
-        reqs = []
         unmangled = set()
         for reqd in result["Results"]:
+            if "Unmangled" in reqd:
+                unmangled.add(reqd["Unmangled"].get("DbId", ""))
+        return [r for r in result["Results"] if r.get("DbId", "") not in unmangled]
+
+    def _query_storage(self, q, storage, headers_only=False, max_results=0):
+        reqs = []
+        for reqd in self._query_storage_raw(q, storage, headers_only=headers_only,
+                                            max_results=max_results):
             req = decode_req(reqd, headers_only=headers_only, storage=storage)
             req.storage_id = storage
             reqs.append(req)
-            if req.unmangled is not None:
-                unmangled.add(req.unmangled.db_id)
-        return [r for r in reqs if r.db_id not in unmangled]
+        return reqs
         
     @messagingFunction
     def query_storage(self, q, storage, max_results=0, headers_only=False):
         return self._query_storage(q, storage, headers_only=headers_only, max_results=max_results)
+
+    @messagingFunction
+    def count_storage(self, q, storage):
+        return len(self._query_storage_raw(q, storage, headers_only=True))
+
+    @messagingFunction
+    def query_exists(self, q, storage):
+        results = self._query_storage_raw(q, storage, headers_only=True, max_results=1)
+        return len(results) > 0
+
+    @messagingFunction
+    def query_fields(self, q, storage, fields, max_results=0):
+        results = self._query_storage_raw(q, storage, headers_only=True,
+                                          max_results=max_results)
+        return [project_fields(reqd, fields) for reqd in results]
         
     @messagingFunction
     def req_by_id(self, reqid, storage, headers_only=False):
@@ -963,7 +1034,7 @@ class ProxyConnection:
         return result["StorageId"]
 
     @messagingFunction
-    def close_storage(self, strage_id):
+    def close_storage(self, storage_id):
         cmd = {
             "Command": "CloseStorage",
             "StorageId": storage_id,
@@ -1005,10 +1076,13 @@ class ProxyConnection:
         self.reqrsp_cmd(cmd)
         
     @messagingFunction
-    def intercept(self, macro):
-        # Run an intercepting macro until closed
-
+    def intercept(self, macro, pool=None):
+        # Run an intercepting macro until closed. Messages are mangled by the
+        # worker threads of an InterceptPool
+        from .intercept import HandshakeCache, InterceptPool, mangle_message, select_macro
         from .util import log_error
+        if pool is None:
+            pool = InterceptPool()
         # Start intercepting
         self.is_interactive = True
         cmd = {
@@ -1022,92 +1096,54 @@ class ProxyConnection:
         except Exception as e:
             self.is_interactive = False
             raise e
-        
+
+        self.int_pool = pool
+        self.ws_cache = HandshakeCache()
+        pool.start(lambda msg, m: mangle_message(m, msg, self.ws_cache), self.submit_command)
+
         def run_macro():
-            while True:
-                try:
-                    msg = self.read_message()
-                except MessageError as e:
-                    log_error(str(e))
-                    return
-                except SocketClosed:
-                    return
-
-                def mangle_and_respond(msg):
-                    retCmd = None
-                    if msg["Type"] == "httprequest":
-                        req = decode_req(msg["Request"])
-                        newReq = macro.mangle_request(req)
-
-                        if newReq is None:
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": True,
-                            }
-                        else:
-                            newReq.unmangled = None
-                            newReq.response = None
-                            newReq.ws_messages = []
-
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": False,
-                                "Request": encode_req(newReq),
-                            }
-                    elif msg["Type"] == "httpresponse":
-                        req = decode_req(msg["Request"])
-                        rsp = decode_rsp(msg["Response"])
-                        newRsp = macro.mangle_response(req, rsp)
-
-                        if newRsp is None:
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": True,
-                            }
-                        else:
-                            newRsp.unmangled = None
-
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": False,
-                                "Response": encode_rsp(newRsp),
-                            }
-                    elif msg["Type"] == "wstoserver" or msg["Type"] == "wstoclient":
-                        req = decode_req(msg["Request"])
-                        rsp = decode_rsp(msg["Response"])
-                        wsm = decode_ws(msg["WSMessage"])
-                        newWsm = macro.mangle_websocket(req, rsp, wsm)
-
-                        if newWsm is None:
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": True,
-                            }
+            try:
+                while True:
+                    try:
+                        msg = self.read_message()
+                    except MessageError as e:
+                        log_error(str(e))
+                        return
+                    except SocketClosed:
+                        return
+                    try:
+                        # check prefilters before the message is queued
+                        m = select_macro(macro, msg)
+                        if m is None:
+                            pool.skip(msg)
                         else:
-                            newWsm.unmangled = None
-
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": False,
-                                "WSMessage": encode_ws(newWsm),
-                            }
-                    else:
-                        raise Exception("Unknown message type: " + msg["Type"])
-                    if retCmd is not None:
-                        try:
-                            self.submit_command(retCmd)
-                        except SocketClosed:
-                            return
-
-                mangle_thread = threading.Thread(target=mangle_and_respond,
-                                                 args=(msg,))
-                mangle_thread.start()
-        
+                            pool.put(msg, m)
+                    except SocketClosed:
+                        return
+            finally:
+                pool.shutdown()
+
         self.int_thread = threading.Thread(target=run_macro)
         self.int_thread.start()
     
 
 ActiveStorage = namedtuple("ActiveStorage", ["type", "storage_id", "prefix"])
+CopyResult = namedtuple("CopyResult", ["copied", "seconds"])
+
+def _clear_db_ids(req):
+    # Clear the ids of a request and everything attached to it so that it is
+    # saved as a new request
+    req.db_id = ""
+    if req.unmangled is not None:
+        _clear_db_ids(req.unmangled)
+    if req.response is not None:
+        req.response.db_id = ""
+        if req.response.unmangled is not None:
+            req.response.unmangled.db_id = ""
+    for wsm in req.ws_messages:
+        wsm.db_id = ""
+        if wsm.unmangled is not None:
+            wsm.unmangled.db_id = ""
 
 def _serialize_storage(stype, prefix):
     return "{}|{}".format(stype, prefix)
@@ -1130,6 +1166,16 @@ class ProxyClient:
         self.storage_by_prefix = {}
         self.proxy_storage = None
         self.inmem_storage = None
+        # held while storages are added, removed or replaced
+        self.storage_lock = threading.RLock()
+        self._replaced_storage = {} # storage id -> id of the storage that replaced it
+        self.disk_storage = None
+        self.config = None
+        self.retention = None # RetentionManager for in-memory storages
+
+        # per-host limits for submitted requests (see pappyproxy.throttle)
+        from .throttle import SubmitGovernor
+        self.governor = SubmitGovernor()
         
         self.reqrsp_methods = {
             "submit_command",
@@ -1210,6 +1256,8 @@ class ProxyClient:
         self._get_storage()
         
     def close(self):
+        if self.retention is not None:
+            self.retention.stop()
         conns = list(self.conns)
         for conn in conns:
             conn.close()
@@ -1226,12 +1274,22 @@ class ProxyClient:
     # functions involving storage
     
     def _add_storage(self, storage, prefix):
-        self.storage_by_prefix[prefix] = storage
-        self.storage_by_id[storage.storage_id] = storage
+        with self.storage_lock:
+            self.storage_by_prefix[prefix] = storage
+            self.storage_by_id[storage.storage_id] = storage
         
     def _clear_storage(self):
-        self.storage_by_prefix = {}
-        self.storage_by_id = {}
+        with self.storage_lock:
+            self.storage_by_prefix = {}
+            self.storage_by_id = {}
+
+    def _current_storage(self, storage_id):
+        # the id of the storage that has replaced storage_id if requests have
+        # been deleted from it
+        with self.storage_lock:
+            while storage_id in self._replaced_storage:
+                storage_id = self._replaced_storage[storage_id]
+            return storage_id
 
     def _get_storage(self):
         self._clear_storage()
@@ -1267,7 +1325,9 @@ class ProxyClient:
         return storage, realid
 
     def storage_iter(self):
-        for _, s in self.storage_by_id.items():
+        with self.storage_lock:
+            storages = list(self.storage_by_id.values())
+        for s in storages:
             yield s
             
     def _stg_or_def(self, storage):
@@ -1287,6 +1347,16 @@ class ProxyClient:
             ret = results[:max_results]
         return ret
 
+    def in_context_count(self):
+        return self.count_requests(self.context.query)
+
+    def in_context_fields(self, fields, max_results=0):
+        results = self.query_fields(self.context.query, fields,
+                                    max_results=max_results)
+        if max_results > 0 and len(results) > max_results:
+            results = results[:max_results]
+        return results
+
     def in_context_requests_iter(self, headers_only=False, max_results=0):
         results = self.query_storage(self.context.query,
                                      headers_only=headers_only,
@@ -1322,10 +1392,11 @@ class ProxyClient:
         return s
     
     def close_storage(self, storage_id):
-        s = self.storage_by_id[storage_id]
-        self.msg_conn.close_storage(s.storage_id)
-        del self.storage_by_id[s.storage_id]
-        del self.storage_by_prefix[s.storage_prefix]
+        with self.storage_lock:
+            s = self.storage_by_id[storage_id]
+            self.msg_conn.close_storage(s.storage_id)
+            del self.storage_by_id[s.storage_id]
+            del self.storage_by_prefix[s.prefix]
         
     def set_proxy_storage(self, storage_id):
         s = self.storage_by_id[storage_id]
@@ -1337,7 +1408,150 @@ class ProxyClient:
             storage = self.inmem_storage
         else:
             storage = self._stg_or_def(storage)
-        self.msg_conn.save_new(req, storage=storage)
+        self.msg_conn.save_new(req, storage=self._current_storage(storage))
+        
+    def save_new_batch(self, reqs, inmem=False, storage=None):
+        if inmem:
+            storage = self.inmem_storage
+        else:
+            storage = self._stg_or_def(storage)
+        return self.msg_conn.save_new_batch(reqs, storage=self._current_storage(storage))
+
+    def request_batches(self, q, storage=None, batch_size=100, headers_only=False):
+        """
+        Yield the requests matching a query in lists of about batch_size
+        requests, oldest first within each storage. The matching requests are
+        paged through by start time with queries of at most batch_size results,
+        so only the start time of every batch_size'th request is kept. Memory
+        use is bounded by the batch size rather than the number of results,
+        except that a batch holds every request with the same start time as
+        its first one.
+        """
+        for sid in self._storage_ids(storage):
+            for lo, hi in self._time_windows(q, sid, batch_size):
+                window = list(q)
+                if lo is not None:
+                    window.append([["after", str(lo - 1)]])
+                if hi is not None:
+                    window.append([["before", str(hi)]])
+                reqs = self.msg_conn.query_storage(window, sid, headers_only=headers_only)
+                if reqs:
+                    reqs.sort(key=lambda r: r.time_start or datetime.datetime(1970, 1, 1))
+                    yield reqs
+
+    def _time_windows(self, q, storage_id, batch_size):
+        # Split the requests matching a query into [lo, hi) start time ranges
+        # (in nanoseconds, None for no bound) of about batch_size requests,
+        # oldest first. Pages back from the newest request, relying on the
+        # storage returning the newest results first.
+        bounds = []
+        cursor = None
+        while True:
+            page_q = list(q)
+            if cursor is not None:
+                page_q.append([["before", str(cursor)]])
+            page = self.msg_conn.query_fields(page_q, storage_id, ["StartTime"],
+                                              max_results=batch_size)
+            if len(page) < batch_size:
+                break
+            oldest = min(f["StartTime"] or 0 for f in page)
+            if oldest <= 0:
+                break
+            bounds.append(oldest)
+            cursor = oldest
+        edges = [None] + bounds[::-1] + [None]
+        return list(zip(edges[:-1], edges[1:]))
+
+    def copy_requests(self, q, src_storage, dst_storage, batch_size=100, progress=None):
+        """
+        Copy every request matching a query from one storage to another. The
+        unmangled versions, responses, websocket messages and tags are copied
+        along with the requests. Requests are fetched and saved batch_size at a
+        time and are copied oldest first. If given, progress(copied, total) is
+        called after every batch. Returns a CopyResult.
+        """
+        ids = self.query_fields(q, ["DbId", "StartTime"], storage=src_storage)
+        ids.reverse()
+        return self.copy_request_ids([f["DbId"] for f in ids], src_storage,
+                                     dst_storage, batch_size=batch_size,
+                                     progress=progress)
+
+    def copy_request_ids(self, ids, src_storage, dst_storage, batch_size=100, progress=None):
+        """
+        Same as copy_requests but copies a list of request ids in order
+        """
+        start = time.time()
+        copied = 0
+        for i in range(0, len(ids), batch_size):
+            reqs = self.msg_conn.reqs_by_ids(ids[i:i+batch_size], src_storage)
+            for req in reqs:
+                _clear_db_ids(req)
+            self.msg_conn.save_new_batch(reqs, dst_storage)
+            copied += len(reqs)
+            if progress is not None:
+                progress(copied, len(ids))
+        return CopyResult(copied, time.time() - start)
+        
+    def delete_request_ids(self, ids, storage_id, batch_size=100):
+        """
+        Delete a list of requests from an in-memory storage. The backend cannot
+        remove requests from a storage, so the requests that are kept are
+        copied into a new storage which then replaces the old one. The proxy is
+        switched to the new storage before anything is copied so that no
+        incoming requests are lost. Returns the new ActiveStorage.
+
+        The kept requests are renumbered, so reqids from the storage refer to
+        different requests (or none) afterwards. Saves to the old storage id
+        go to the new storage. If copying fails, the old storage is left in
+        place and the new one is closed.
+        """
+        with self.storage_lock:
+            storage_id = self._current_storage(storage_id)
+            s = self.storage_by_id[storage_id]
+            if s.type != "inmem":
+                raise ProxyException("requests can only be deleted from in-memory storages")
+            to_delete = set(ids)
+            new_sid = self.msg_conn.add_in_memory_storage(_serialize_storage(s.type, s.prefix))
+            new_s = ActiveStorage(type=s.type, storage_id=new_sid, prefix=s.prefix)
+            was_proxy = self.proxy_storage == storage_id
+            try:
+                self.storage_by_id[new_sid] = new_s
+                if was_proxy:
+                    self.set_proxy_storage(new_sid)
+                keep = self.query_fields([], ["DbId", "StartTime"], storage=storage_id)
+                keep.reverse()
+                keep = [f["DbId"] for f in keep if f["DbId"] not in to_delete]
+                self.copy_request_ids(keep, storage_id, new_sid, batch_size=batch_size)
+            except Exception:
+                # put the old storage back
+                if was_proxy and self.proxy_storage == new_sid:
+                    self.set_proxy_storage(storage_id)
+                self.storage_by_id.pop(new_sid, None)
+                try:
+                    self.msg_conn.close_storage(new_sid)
+                except (MessageError, SocketClosed, OSError):
+                    pass
+                raise
+
+            self._replaced_storage[storage_id] = new_sid
+            self.msg_conn.close_storage(storage_id)
+            del self.storage_by_id[storage_id]
+            self._add_storage(new_s, s.prefix)
+            if self.inmem_storage == s:
+                self.inmem_storage = new_s
+            if self.disk_storage == s:
+                self.disk_storage = new_s
+            return new_s
+
+    def delete_requests(self, q, storage_id, batch_size=100):
+        """
+        Delete the requests matching a query from an in-memory storage. See
+        delete_request_ids. Returns the number of deleted requests.
+        """
+        ids = [f["DbId"] for f in self.query_fields(q, ["DbId"], storage=storage_id)]
+        if ids:
+            self.delete_request_ids(ids, storage_id, batch_size=batch_size)
+        return len(ids)
         
     def submit(self, req, save=False, inmem=False, storage=None):
         if save:
@@ -1346,6 +1560,24 @@ class ProxyClient:
             storage = self.inmem_storage
         self.msg_conn.submit(req, storage=storage)
 
+    def submit_many(self, reqs, save=False, inmem=False, storage=None, direct=False, **kwargs):
+        """
+        Submit many requests concurrently. If save is True, the results are
+        saved to storage (the proxy storage by default) in batches. Other
+        arguments are passed to submitter.submit_requests. If direct is True,
+        requests are sent from pappy over keep-alive connections rather than
+        through the backend (see pappyproxy.sender). Returns a SubmitResult.
+        """
+        from .submitter import submit_requests
+        from .sender import send_requests
+        if save:
+            storage = self._stg_or_def(storage)
+        if inmem:
+            storage = self.inmem_storage.storage_id
+        if direct:
+            return send_requests(self, reqs, storage=storage, **kwargs)
+        return submit_requests(self, reqs, storage=storage, **kwargs)
+
     def query_storage(self, q, max_results=0, headers_only=False, storage=None):
         results = []
         if storage is None:
@@ -1365,6 +1597,74 @@ class ProxyClient:
         results = [r for r in reversed(results)]
         return results
             
+    def _storage_ids(self, storage=None):
+        if storage is None:
+            return [s.storage_id for s in self.storage_iter()]
+        return [storage]
+
+    def count_requests(self, q, storage=None):
+        """
+        Count the requests matching a query without decoding them
+        """
+        count = 0
+        for sid in self._storage_ids(storage):
+            count += self.msg_conn.count_storage(q, storage=sid)
+        return count
+
+    def requests_exist(self, q, storage=None):
+        """
+        Return whether any request matches a query
+        """
+        for sid in self._storage_ids(storage):
+            if self.msg_conn.query_exists(q, storage=sid):
+                return True
+        return False
+
+    def query_fields(self, q, fields, max_results=0, storage=None):
+        """
+        Return a list of dicts containing only the requested fields of each
+        matching request (see project_fields). Each dict also includes the
+        "StorageId" of the storage the request came from. If "StartTime" is one
+        of the fields, results are ordered newest first like query_storage.
+        """
+        results = []
+        for sid in self._storage_ids(storage):
+            for r in self.msg_conn.query_fields(q, sid, fields, max_results=max_results):
+                r["StorageId"] = sid
+                results.append(r)
+        if "StartTime" in fields:
+            results.sort(key=lambda r: r["StartTime"] or 0, reverse=True)
+        return results
+
+    def aggregate(self, q, group_by=None, metrics=None, storage=None):
+        """
+        Group the requests matching a query and compute metrics for each group
+        without decoding the full messages. See pappyproxy.aggregate for the
+        available keys and metrics. Returns a list of dicts.
+        """
+        from .aggregate import Aggregator
+        agg = Aggregator(group_by or [], metrics or ["count"])
+        for sid in self._storage_ids(storage):
+            agg.add_all(self.msg_conn.query_fields(q, sid, agg.fields))
+        return agg.rows()
+
+    def cluster(self, q, storage=None, distance=3, batch_size=100, progress=None):
+        """
+        Group the responses of the requests matching a query into clusters of
+        similar responses. See pappyproxy.cluster for how responses are
+        compared. Returns a cluster.Clusterer.
+        """
+        from .cluster import cluster_requests
+        return cluster_requests(self, q, storage=storage, distance=distance,
+                                batch_size=batch_size, progress=progress)
+
+    def fields_reqid(self, fields):
+        # get the prefixed id of a result from query_fields
+        prefix = ""
+        if fields["StorageId"] in self.storage_by_id:
+            prefix = self.storage_by_id[fields["StorageId"]].prefix
+        return "{}{}".format(prefix, fields["DbId"])
+            
     def req_by_id(self, reqid, storage_id=None, headers_only=False):
         if storage_id is None:
             storage, db_id = self.parse_reqid(reqid)
@@ -1402,6 +1702,74 @@ class ProxyClient:
         self.msg_conn.delete_query(name, storage=self._stg_or_def(storage))
 
 
+# Fields that project_fields reads from the response of a request
+_response_fields = ("StatusCode", "Reason")
+
+def _encoded_content_length(msgd):
+    if msgd is None:
+        return None
+    for k, vs in (msgd.get("Headers") or {}).items():
+        if k.lower() == "content-length" and vs:
+            try:
+                return int(vs[0])
+            except ValueError:
+                return None
+    return None
+
+def _b64_len(data):
+    if not data:
+        return 0
+    return len(data) * 3 // 4 - data[-2:].count("=")
+
+def _encoded_size(msgd):
+    # bytes of an encoded request or response: the start line, headers and
+    # body, plus the unmangled version if there is one. Bodies that weren't
+    # fetched are counted by their Content-Length
+    if msgd is None:
+        return 0
+    size = _b64_len(msgd.get("Body")) or _encoded_content_length(msgd) or 0
+    size += len(msgd.get("Method") or "") + len(msgd.get("Path") or "") + len(msgd.get("Reason") or "") + 16
+    for k, vs in (msgd.get("Headers") or {}).items():
+        for v in vs:
+            size += len(k) + len(v) + 4
+    return size + _encoded_size(msgd.get("Unmangled"))
+
+def project_fields(result, fields):
+    """
+    Pull a set of fields out of an encoded request without decoding it. Fields
+    use the names from the message protocol (ie "DbId", "Method", "DestHost",
+    "Path", "StartTime"). "StatusCode" and "Reason" are taken from the
+    response and are None if the request has no response. The following
+    derived fields are also available:
+
+    ReqLen: the Content-Length of the request
+    RspLen: the Content-Length of the response
+    Size: the number of bytes in the request, response and websocket
+          messages, including headers and unmangled versions. Bodies that
+          weren't included in the query are counted by their Content-Length
+    Duration: EndTime - StartTime in nanoseconds
+    """
+    ret = {}
+    for f in fields:
+        if f in _response_fields:
+            rsp = result.get("Response")
+            ret[f] = rsp.get(f) if rsp is not None else None
+        elif f == "ReqLen":
+            ret[f] = _encoded_content_length(result)
+        elif f == "RspLen":
+            ret[f] = _encoded_content_length(result.get("Response"))
+        elif f == "Size":
+            ret[f] = (_encoded_size(result) + _encoded_size(result.get("Response")) +
+                      sum(_b64_len(ws.get("Message")) + _b64_len((ws.get("Unmangled") or {}).get("Message"))
+                          for ws in result.get("WSMessages") or []))
+        elif f == "Duration":
+            start = result.get("StartTime") or 0
+            end = result.get("EndTime") or 0
+            ret[f] = end - start if start > 0 and end > 0 else None
+        else:
+            ret[f] = result.get(f)
+    return ret
+
 def decode_req(result, headers_only=False, storage=0):
     if "StartTime" in result and result["StartTime"] > 0:
         time_start = time_from_nsecs(result["StartTime"])
@@ -1481,7 +1849,7 @@ def decode_ws(result, storage=0):
         to_server=result["ToServer"],
         timestamp=timestamp,
         db_id=db_id,
-        storage=storage,
+        storage_id=storage,
     )
     
     if "Unmangled" in result:
@@ -1497,7 +1865,7 @@ def encode_req(req, int_rsp=False):
 	"Method": req.method,
 	"Path": req.url.geturl(),
 	"ProtoMajor": req.proto_major,
-	"ProtoMinor": req.proto_major,
+	"ProtoMinor": req.proto_minor,
 	"Headers": req.headers.dict(),
         "Tags": list(req.tags),
 	"Body": base64.b64encode(copy.copy(req.body)).decode(),
@@ -1510,7 +1878,7 @@ def encode_req(req, int_rsp=False):
             msg["Unmangled"] = encode_req(req.unmangled)
         if req.response is not None:
             msg["Response"] = encode_rsp(req.response)
-            msg["WSMessages"] = []
+        msg["WSMessages"] = []
         for wsm in req.ws_messages:
             msg["WSMessages"].append(encode_ws(wsm))
     return msg
@@ -1534,7 +1902,7 @@ def encode_ws(ws, int_rsp=False):
     msg = {
 	"Message": base64.b64encode(ws.message).decode(),
 	"IsBinary": ws.is_binary,
-	"toServer": ws.to_server,
+	"ToServer": ws.to_server,
     }
     if not int_rsp:
         if ws.unmangled is not None:
@@ -1558,13 +1926,14 @@ RequestStatusLine = namedtuple("RequestStatusLine", ["method", "path", "proto_ma
 ResponseStatusLine = namedtuple("ResponseStatusLine", ["proto_major", "proto_minor", "status_code", "reason"])
 
 def parse_req_sline(sline):
-    if len(sline.split(b' ')) == 3:
-        verb, path, version = sline.split(b' ')
+    parts = sline.split(b' ')
+    if len(parts) == 3:
+        verb, path, version = parts
     elif len(parts) == 2:
-        verb, version = parts.split(b' ')
+        verb, version = parts
         path = b''
     else:
-        raise ParseError("malformed statusline")
+        raise MessageError("malformed statusline")
     raw_version = version[5:] # strip HTTP/
     pmajor, pminor = raw_version.split(b'.', 1)
     return RequestStatusLine(verb.decode(), path.decode(), int(pmajor), int(pminor))
@@ -1574,19 +1943,26 @@ def parse_rsp_sline(sline):
         version, status_code, reason = sline.split(b' ', 2)
     else:
         version, status_code = sline.split(b' ', 1)
-        reason = ''
+        reason = b''
     raw_version = version[5:] # strip HTTP/
     pmajor, pminor = raw_version.split(b'.', 1)
     return ResponseStatusLine(int(pmajor), int(pminor), int(status_code), reason.decode())
 
 def _parse_message(bs, sline_parser):
-    header_env, body = re.split(b"\r?\n\r?\n", bs, 1)
-    status_line, header_bytes = re.split(b"\r?\n", header_env, 1)
+    parts = re.split(b"\r?\n\r?\n", bs, 1)
+    if len(parts) == 2:
+        header_env, body = parts
+    else:
+        header_env, body = bs.rstrip(b"\r\n"), b''
+    lines = re.split(b"\r?\n", header_env)
+    status_line = lines[0]
     h = Headers()
-    for l in re.split(b"\r?\n", header_bytes):
-        k, v = l.split(b": ", 1)
-        if k.lower != 'content-length':
-            h.add(k.decode(), v.decode())
+    for l in lines[1:]:
+        if b":" not in l:
+            raise MessageError("malformed header: %s" % l.decode(errors="replace"))
+        k, v = l.split(b":", 1)
+        if k.lower() != b'content-length':
+            h.add(k.decode(), v.strip().decode())
     h.add("Content-Length", str(len(body)))
     return (sline_parser(status_line), h, body)
         
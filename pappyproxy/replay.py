@@ -0,0 +1,390 @@
+"""
+Replaying a captured browsing session. The requests matching a query are sent
+again in the order they were originally made, with the gaps between them
+scaled by a speed factor (1 for the original timing, 10 for ten times faster
+or 0 for as fast as possible).
+
+Values that the server handed out during the original session (cookies and
+CSRF tokens in hidden inputs, meta tags, JSON and headers) are carried
+forward: when a replayed response gives a different value than the original
+response did, later requests have the old value replaced with the new one.
+
+Requests are sent concurrently unless they depend on each other. A request
+depends on the earlier request whose original response handed out a value it
+uses, and requests that change state (anything but GET, HEAD and OPTIONS)
+are ordered with respect to every other request to the same host.
+
+The replayed requests are saved to a separate storage and the status codes
+and response lengths are compared with the original session.
+"""
+
+import concurrent.futures
+import queue
+import re
+import threading
+import time
+
+from collections import Counter, namedtuple
+from urllib.parse import quote_plus
+
+from .proxy import MessageError, SocketClosed, _clear_db_ids, parse_request
+
+class ReplayError(Exception):
+    pass
+
+ReplayDiff = namedtuple("ReplayDiff", ["orig_id", "new_id", "method", "path", "orig_status",
+                                       "new_status", "orig_len", "new_len", "error"])
+
+_safe_methods = ("GET", "HEAD", "OPTIONS")
+
+# names of form fields, meta tags, JSON keys and headers that hold tokens
+_token_name = rb"[\w.-]*(?:csrf|xsrf|token|nonce|authenticity)[\w.-]*"
+_input_re = re.compile(rb"<input\b[^>]*>", re.I)
+_meta_re = re.compile(rb"<meta\b[^>]*>", re.I)
+_attr_re = re.compile(rb"""([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+_token_name_re = re.compile(rb"^" + _token_name + rb"$", re.I)
+_json_re = re.compile(rb'"(' + _token_name + rb')"\s*:\s*"([^"\\]{8,})"', re.I)
+
+MIN_COOKIE_LEN = 4
+MIN_TOKEN_LEN = 8
+
+def _tag_attrs(tag):
+    return {m.group(1).lower(): m.group(2) if m.group(2) is not None else m.group(3)
+            for m in _attr_re.finditer(tag)}
+
+def response_tokens(rsp):
+    """
+    Find the values handed out by a response. Returns a dict of
+    "kind:name" -> bytes value for cookies and anything that looks like a
+    CSRF token.
+    """
+    tokens = {}
+    for k, v in rsp.cookie_iter():
+        if len(v) >= MIN_COOKIE_LEN:
+            tokens["cookie:" + k] = v.encode()
+    for k, v in rsp.headers.pairs():
+        if _token_name_re.match(k.encode()) and len(v) >= MIN_TOKEN_LEN:
+            tokens["header:" + k.lower()] = v.encode()
+    body = rsp.body
+    if not body:
+        return tokens
+    for tag in _input_re.findall(body):
+        attrs = _tag_attrs(tag)
+        name, value = attrs.get(b"name"), attrs.get(b"value")
+        if name and value and len(value) >= MIN_TOKEN_LEN and _token_name_re.match(name):
+            tokens["input:" + name.decode(errors="replace")] = value
+    for tag in _meta_re.findall(body):
+        attrs = _tag_attrs(tag)
+        name, value = attrs.get(b"name"), attrs.get(b"content")
+        if name and value and len(value) >= MIN_TOKEN_LEN and _token_name_re.match(name):
+            tokens["meta:" + name.decode(errors="replace")] = value
+    for m in _json_re.finditer(body):
+        tokens["json:" + m.group(1).decode(errors="replace")] = m.group(2)
+    return tokens
+
+def _encodings(value):
+    # the forms a value can appear in in a request
+    forms = [value]
+    quoted = quote_plus(value).encode()
+    if quoted != value:
+        forms.append(quoted)
+    return forms
+
+def _encoded_pairs(old, new):
+    # (old form, new form) for each form a value can appear in in a request.
+    # The quoted form of old is replaced by the quoted form of new even if
+    # only one of them needs quoting
+    pairs = [(old, new)]
+    quoted = quote_plus(old).encode()
+    if quoted != old:
+        pairs.append((quoted, quote_plus(new).encode()))
+    return pairs
+
+class Substitutions:
+    """
+    A thread safe map of values from the original session to the values that
+    replaced them
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs = {}
+
+    def __len__(self):
+        return len(self._subs)
+
+    def learn(self, orig_rsp, new_rsp):
+        """
+        Compare the values handed out by an original response and its replay
+        """
+        old = response_tokens(orig_rsp)
+        new = response_tokens(new_rsp)
+        with self._lock:
+            for k, v in old.items():
+                if k in new and new[k] != v:
+                    for o, n in _encoded_pairs(v, new[k]):
+                        self._subs[o] = n
+
+    def apply(self, raw):
+        with self._lock:
+            subs = sorted(self._subs.items(), key=lambda s: len(s[0]), reverse=True)
+        for old, new in subs:
+            raw = raw.replace(old, new)
+        return raw
+
+def session_requests(client, q, storage=None, batch_size=100):
+    """
+    Yield the requests matching a query across storages in the order they
+    were made. Only the ids are kept in memory between batches.
+    """
+    ids = client.query_fields(q, ["DbId", "StartTime"], storage=storage)
+    ids.reverse()
+    for i in range(0, len(ids), batch_size):
+        chunk = ids[i:i+batch_size]
+        by_storage = {}
+        for f in chunk:
+            by_storage.setdefault(f["StorageId"], []).append(f["DbId"])
+        found = {}
+        for sid, db_ids in by_storage.items():
+            for req in client.msg_conn.reqs_by_ids(db_ids, sid):
+                found[(sid, req.db_id)] = req
+        for f in chunk:
+            req = found.get((f["StorageId"], f["DbId"]))
+            if req is not None:
+                yield req
+
+class ReplayResult:
+    """
+    The outcome of a replay. ``diffs`` has a ReplayDiff for every request.
+    """
+
+    def __init__(self):
+        self.diffs = []
+        self.seconds = 0
+        self.substitutions = 0
+
+    @property
+    def replayed(self):
+        return sum(1 for d in self.diffs if d.error is None)
+
+    @property
+    def errors(self):
+        return sum(1 for d in self.diffs if d.error is not None)
+
+    def status_changes(self):
+        """
+        Counter of (original status, new status) for requests whose status changed
+        """
+        return Counter((d.orig_status, d.new_status) for d in self.diffs
+                       if d.error is None and d.orig_status != d.new_status)
+
+    def size_changes(self, threshold=0.1):
+        """
+        Diffs whose response length changed by more than threshold (a fraction
+        of the original length)
+        """
+        ret = []
+        for d in self.diffs:
+            if d.error is not None or d.orig_len is None or d.new_len is None:
+                continue
+            if abs(d.new_len - d.orig_len) > threshold * max(d.orig_len, 1):
+                ret.append(d)
+        return ret
+
+class _Replayer:
+
+    def __init__(self, client, speed, carry):
+        self.client = client
+        self.speed = speed
+        self.carry = carry
+        self.subs = Substitutions()
+        self.results = queue.Queue()
+        self.local = threading.local()
+        self.conns = []
+        self.conns_lock = threading.Lock()
+        self.start = None
+        self.first = None
+        # for dependencies. Only futures that haven't finished are kept since
+        # waiting on a finished one does nothing
+        self.producers = {} # value from an original response -> future
+        self.last_write = {} # host -> future
+        self.reads = {} # host -> futures since the last write
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.client.new_conn()
+            self.local.conn = conn
+            with self.conns_lock:
+                self.conns.append(conn)
+        return conn
+
+    def close(self):
+        with self.conns_lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+
+    def due(self, orig):
+        # wall clock time to send a request
+        if self.speed <= 0 or orig.time_start is None:
+            return 0
+        if self.first is None:
+            self.first = orig.time_start
+        return self.start + (orig.time_start - self.first).total_seconds() / self.speed
+
+    def _prune(self):
+        self.producers = {v: fut for v, fut in self.producers.items() if not fut.done()}
+        for host in list(self.reads):
+            self.reads[host] = [fut for fut in self.reads[host] if not fut.done()]
+            if not self.reads[host]:
+                del self.reads[host]
+        for host in list(self.last_write):
+            if self.last_write[host].done():
+                del self.last_write[host]
+
+    def dependencies(self, orig):
+        self._prune()
+        deps = set()
+        if self.carry and self.producers:
+            raw = orig.full_message()
+            for v, fut in self.producers.items():
+                if v in raw:
+                    deps.add(fut)
+        host = orig.dest_host
+        if host in self.last_write:
+            deps.add(self.last_write[host])
+        if orig.method not in _safe_methods:
+            deps.update(self.reads.get(host, []))
+        return deps
+
+    def scheduled(self, orig, fut):
+        host = orig.dest_host
+        if orig.method in _safe_methods:
+            self.reads.setdefault(host, []).append(fut)
+        else:
+            self.last_write[host] = fut
+            self.reads[host] = []
+        if self.carry and orig.response is not None:
+            for v in response_tokens(orig.response).values():
+                for form in _encodings(v):
+                    self.producers[form] = fut
+
+    def _replay(self, orig, deps, due):
+        for d in deps:
+            d.result()
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        raw = orig.full_message()
+        if self.carry:
+            raw = self.subs.apply(raw)
+        req = parse_request(raw, dest_host=orig.dest_host, dest_port=orig.dest_port,
+                            use_tls=orig.use_tls)
+        err = None
+        for _ in range(2):
+            try:
+                self._conn().submit(req, storage=0)
+                err = None
+                break
+            except (SocketClosed, OSError) as e:
+                # reconnect once if the connection to the proxy dropped
+                conn = self.local.conn
+                self.local.conn = None
+                conn.close()
+                err = e
+            except MessageError as e:
+                err = e
+                break
+        if err is None and self.carry and orig.response is not None and req.response is not None:
+            self.subs.learn(orig.response, req.response)
+        return req, err
+
+    def replay(self, index, orig, deps, due):
+        req, err = None, None
+        try:
+            req, err = self._replay(orig, deps, due)
+        except Exception as e:
+            err = e
+        self.results.put((index, orig, req, err))
+
+def replay_session(client, q, dest_storage, storage=None, speed=1.0, workers=8, carry=True,
+                   tag="replay", batch_size=50, on_result=None):
+    """
+    Replay the requests matching a query in the order they were made and save
+    the results to dest_storage. speed scales the original gaps between
+    requests (0 sends them as fast as possible), workers is how many can be
+    in flight at once and carry turns carrying cookies and tokens forward on
+    and off. on_result is called with a ReplayDiff as each result is saved.
+    Returns a ReplayResult.
+    """
+    if workers < 1:
+        raise ReplayError("at least one worker is needed")
+    rp = _Replayer(client, speed, carry)
+    result = ReplayResult()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    # bound how many original requests are held in memory
+    max_outstanding = workers * 4
+    outstanding = 0
+    batch = []
+    diffs = []
+    start = time.time()
+    rp.start = start
+
+    def flush():
+        ok = [req for _, _, req, err in batch if err is None]
+        for req in ok:
+            _clear_db_ids(req)
+            if tag:
+                req.tags.add(tag)
+        if ok:
+            client.save_new_batch(ok, storage=dest_storage)
+        for index, orig, req, err in batch:
+            orsp = orig.response
+            rsp = req.response if err is None else None
+            d = ReplayDiff(client.get_reqid(orig), client.get_reqid(req) if err is None else None,
+                           orig.method, orig.url.geturl(),
+                           orsp.status_code if orsp is not None else None,
+                           rsp.status_code if rsp is not None else None,
+                           len(orsp.body) if orsp is not None else None,
+                           len(rsp.body) if rsp is not None else None,
+                           str(err) if err is not None else None)
+            diffs.append((index, d))
+            if on_result is not None:
+                on_result(d)
+        del batch[:]
+
+    def collect(block):
+        nonlocal outstanding
+        while outstanding > 0:
+            try:
+                item = rp.results.get(block=block)
+            except queue.Empty:
+                return
+            outstanding -= 1
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+            if block:
+                return
+
+    try:
+        for i, orig in enumerate(session_requests(client, q, storage=storage)):
+            while outstanding >= max_outstanding:
+                collect(True)
+            deps = rp.dependencies(orig)
+            fut = pool.submit(rp.replay, i, orig, deps, rp.due(orig))
+            rp.scheduled(orig, fut)
+            outstanding += 1
+            collect(False)
+        while outstanding > 0:
+            collect(True)
+        flush()
+    finally:
+        pool.shutdown(wait=True)
+        rp.close()
+    # results are saved as they finish but reported in the original order
+    result.diffs = [d for _, d in sorted(diffs, key=lambda x: x[0])]
+    result.seconds = time.time() - start
+    result.substitutions = len(rp.subs)
+    return result
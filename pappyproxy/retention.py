@@ -0,0 +1,277 @@
+"""
+Retention policies for in-memory storages. A policy limits the number of
+requests, the total size of the messages and the age of the requests in a
+storage. A RetentionManager periodically measures the storages with a policy
+and when one goes over its limits it stops taking new requests: a fresh
+in-memory storage takes its place as the proxy's storage (and as the storage
+that saves to the full one go to). The full storage keeps its requests and
+their ids until its prefix comes around again, when it is closed as a whole.
+
+Requests are never renumbered by a policy. Deleting individual requests
+(which means rebuilding a storage) is only done by the prune command.
+"""
+
+import threading
+import time
+
+from collections import namedtuple
+
+from .proxy import MessageError, ProxyException, SocketClosed
+from .util import log_error
+
+StorageUsage = namedtuple("StorageUsage", ["requests", "bytes", "oldest", "newest"])
+
+class RetentionPolicy:
+    """
+    Limits for a storage. A limit of 0 means no limit. When a storage goes
+    over a limit, new requests go to a fresh storage with the next prefix in
+    ``rollover`` (or the same prefix if there are none) and any storage
+    already using that prefix is closed. ``evict`` is either "oldest" to
+    close storages regardless of their tags or "untagged" to never close a
+    storage with tagged requests in it.
+    """
+
+    evict_modes = ("oldest", "untagged")
+
+    def __init__(self, max_requests=0, max_bytes=0, max_age=0, evict="oldest", rollover=None):
+        if evict not in self.evict_modes:
+            raise ProxyException("invalid eviction mode %s. Must be one of %s" %
+                                 (evict, ', '.join(self.evict_modes)))
+        for p in rollover or []:
+            if len(p) != 1 or not p.isalpha() or p in ('u', 's'):
+                raise ProxyException("invalid rollover prefix \"%s\". Prefixes are a single letter "
+                                     "other than u and s" % p)
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict = evict
+        self.rollover = list(rollover or [])
+
+    def __repr__(self):
+        return "<RetentionPolicy max_requests=%d max_bytes=%d max_age=%d evict=%s rollover=%s>" % \
+            (self.max_requests, self.max_bytes, self.max_age, self.evict, ''.join(self.rollover))
+
+    def over_limit(self, usage, now=None):
+        """
+        Returns a description of the limit a storage's StorageUsage is over
+        or None if it is within its limits
+        """
+        if now is None:
+            now = time.time()
+        if self.max_requests > 0 and usage.requests > self.max_requests:
+            return "%d requests" % usage.requests
+        if self.max_bytes > 0 and usage.bytes > self.max_bytes:
+            return "%d bytes" % usage.bytes
+        if self.max_age > 0 and usage.oldest and usage.oldest < (now - self.max_age) * 1000000000:
+            return "requests older than %ds" % self.max_age
+        return None
+
+    def expired(self, usage, now=None):
+        # whether every request in a retired storage is older than max_age
+        if now is None:
+            now = time.time()
+        return (self.max_age > 0 and usage.newest > 0 and
+                usage.newest < (now - self.max_age) * 1000000000)
+
+def policy_from_config(info):
+    return RetentionPolicy(max_requests=info.get("max_requests", 0),
+                           max_bytes=info.get("max_bytes", 0),
+                           max_age=info.get("max_age", 0),
+                           evict=info.get("evict", "oldest"),
+                           rollover=info.get("rollover"))
+
+class _Usage:
+    # running totals for a storage. Only requests newer than the newest one
+    # already counted are read on each pass
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.oldest = 0
+        self.newest = 0
+        self.at_newest = set() # ids of the counted requests that started at newest
+
+    def add(self, f):
+        start = f["StartTime"] or 0
+        if start == self.newest and f["DbId"] in self.at_newest:
+            return
+        self.requests += 1
+        self.bytes += f["Size"] or 0
+        if start and (not self.oldest or start < self.oldest):
+            self.oldest = start
+        if start > self.newest:
+            self.newest = start
+            self.at_newest = set()
+        if start == self.newest:
+            self.at_newest.add(f["DbId"])
+
+    def snapshot(self):
+        return StorageUsage(self.requests, self.bytes, self.oldest, self.newest)
+
+class RetentionManager:
+    """
+    Applies retention policies to storages (by prefix) every ``interval``
+    seconds in a background thread. Storages are measured over a connection
+    of the manager's own using only the requests' headers, so sizes count
+    bodies by their Content-Length. Policies can be changed while it is
+    running with set_policy and remove_policy.
+    """
+
+    def __init__(self, client, policies, interval=60):
+        self.client = client
+        self.interval = interval
+        self._policies = dict(policies)
+        self._active = {} # policy prefix -> prefix of the storage taking new requests
+        self._usage = {} # storage id -> _Usage
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+
+    @property
+    def policies(self):
+        with self._lock:
+            return dict(self._policies)
+
+    def set_policy(self, prefix, policy):
+        with self._lock:
+            self._policies[prefix] = policy
+        self.start()
+
+    def remove_policy(self, prefix):
+        """
+        Stop applying the policy for a storage. Returns False if it had none
+        """
+        with self._lock:
+            if self._policies.pop(prefix, None) is None:
+                return False
+            self._active.pop(prefix, None)
+            return True
+
+    def active_prefix(self, prefix):
+        """
+        The prefix of the storage that is taking the new requests for a policy
+        """
+        with self._lock:
+            return self._active.get(prefix, prefix)
+
+    def _query(self, q, fields, storage_id):
+        if self._conn is None or self._conn.closed:
+            self._conn = self.client.new_conn()
+        return self._conn.query_fields(q, storage_id, fields)
+
+    def usage(self, storage_id):
+        """
+        Measure a storage, reading only the requests saved since it was last
+        measured. Returns a StorageUsage.
+        """
+        with self._lock:
+            u = self._usage.setdefault(storage_id, _Usage())
+            q = []
+            if u.newest:
+                q = [[["after", str(u.newest - 1)]]]
+            for f in self._query(q, ["DbId", "StartTime", "Size"], storage_id):
+                u.add(f)
+            return u.snapshot()
+
+    def _has_tags(self, storage_id):
+        return any(f["Tags"] for f in self._query([], ["DbId", "Tags"], storage_id))
+
+    def _closable(self, policy, storage):
+        return policy.evict != "untagged" or not self._has_tags(storage.storage_id)
+
+    def roll_over(self, prefix):
+        """
+        Replace the storage taking new requests for a policy with a fresh
+        one. Returns the new ActiveStorage or None if every prefix it could
+        use belongs to a storage that can't be closed.
+        """
+        client = self.client
+        with self._lock, client.storage_lock:
+            policy = self._policies[prefix]
+            ring = [prefix] + [p for p in policy.rollover if p != prefix]
+            cur_prefix = self._active.get(prefix, prefix)
+            cur = client.storage_by_prefix[cur_prefix]
+            start = ring.index(cur_prefix) if cur_prefix in ring else 0
+            for i in range(1, len(ring) + 1):
+                next_prefix = ring[(start + i) % len(ring)]
+                old = client.storage_by_prefix.get(next_prefix)
+                if old is None or self._closable(policy, old):
+                    break
+            else:
+                return None
+            if old is not None and old.type != "inmem":
+                raise ProxyException("storage \"%s\" is not an in-memory storage" % next_prefix)
+            if old is not None and old != cur:
+                client.close_storage(old.storage_id)
+                self._usage.pop(old.storage_id, None)
+            new = client.add_in_memory_storage(next_prefix)
+            if client.proxy_storage == cur.storage_id:
+                client.set_proxy_storage(new.storage_id)
+            if client.inmem_storage == cur:
+                client.inmem_storage = new
+            # saves to the full storage go to the new one from now on
+            client._replaced_storage[cur.storage_id] = new.storage_id
+            if old == cur:
+                # it had the prefix the new storage now has
+                client.msg_conn.close_storage(cur.storage_id)
+                del client.storage_by_id[cur.storage_id]
+                self._usage.pop(cur.storage_id, None)
+            self._active[prefix] = next_prefix
+            return new
+
+    def enforce(self, prefix):
+        """
+        Apply the policy for a storage now. Returns the new ActiveStorage if
+        the storage was over its limits and was rolled over, otherwise None.
+        """
+        with self._lock:
+            policy = self._policies[prefix]
+            now = time.time()
+            # close retired storages whose requests have all expired
+            cur_prefix = self._active.get(prefix, prefix)
+            for p in [prefix] + policy.rollover:
+                s = self.client.storage_by_prefix.get(p)
+                if p == cur_prefix or s is None or s.type != "inmem":
+                    continue
+                if policy.expired(self.usage(s.storage_id), now) and self._closable(policy, s):
+                    self.client.close_storage(s.storage_id)
+                    self._usage.pop(s.storage_id, None)
+            cur = self.client.storage_by_prefix[cur_prefix]
+            reason = policy.over_limit(self.usage(cur.storage_id), now)
+            if reason is None:
+                return None
+            new = self.roll_over(prefix)
+            if new is None:
+                log_error("storage \"%s\" is over its limit (%s) but every storage it could be replaced with "
+                          "has tagged requests" % (cur_prefix, reason))
+            return new
+
+    def enforce_all(self):
+        for prefix in self.policies:
+            if self.active_prefix(prefix) not in self.client.storage_by_prefix:
+                continue
+            try:
+                self.enforce(prefix)
+            except (MessageError, ProxyException, SocketClosed, OSError) as e:
+                log_error("could not apply retention policy to storage \"%s\": %s" % (prefix, e))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.enforce_all()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or not self._policies or self._stop.is_set():
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.interval)
+        with self._lock:
+            if self._conn is not None and not self._conn.closed:
+                self._conn.close()
+            self._conn = None
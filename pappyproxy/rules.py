@@ -0,0 +1,437 @@
+"""
+Match and replace rules for intercepted messages. Rules are listed in the
+"rules" section of config.json and are run by the built-in ``rules``
+intercepting macro. There are four kinds of rules:
+
+* literal: replace a string in the body
+* regex: replace a regular expression in the body
+* header: set, add, remove or rewrite a header
+* param: set, add or remove a URL or POST parameter
+
+Each rule can be limited to hosts (glob patterns) and path prefixes. All the
+literal rules that apply to a message are compiled into a single matcher so
+each body is only scanned once no matter how many literal rules there are.
+Matchers are cached by the set of rules that are in scope.
+"""
+
+import fnmatch
+import json
+import re
+import threading
+
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from .proxy import InterceptMacro
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+class RuleError(Exception):
+    pass
+
+_wheres = ("request", "response", "ws_to_server", "ws_to_client")
+_where_aliases = {
+    "req": ("request",),
+    "rsp": ("response",),
+    "ws": ("ws_to_server", "ws_to_client"),
+    "websocket": ("ws_to_server", "ws_to_client"),
+}
+_msg_wheres = {
+    "httprequest": "request",
+    "httpresponse": "response",
+    "wstoserver": "ws_to_server",
+    "wstoclient": "ws_to_client",
+}
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return str(s).encode()
+
+def _to_list(v):
+    if v is None:
+        return []
+    if isinstance(v, (list, tuple)):
+        return list(v)
+    return [v]
+
+def _parse_where(where, default):
+    if where is None:
+        return default
+    ret = set()
+    for w in _to_list(where):
+        w = w.lower()
+        if w in _where_aliases:
+            ret.update(_where_aliases[w])
+        elif w in _wheres:
+            ret.add(w)
+        else:
+            raise RuleError("invalid location for rule: %s" % w)
+    return frozenset(ret)
+
+class Rule:
+    """
+    The base class for rules. Handles the where/host/path scope shared by
+    every kind of rule.
+    """
+
+    default_where = frozenset(("request", "response"))
+    allowed_where = frozenset(_wheres)
+
+    def __init__(self, info):
+        self.where = _parse_where(info.get("where"), self.default_where)
+        bad = self.where - self.allowed_where
+        if bad:
+            raise RuleError("%s rules can't be applied to %s" % (self.kind, ", ".join(sorted(bad))))
+        self.hosts = [h.lower() for h in _to_list(info.get("host"))]
+        self.paths = tuple(_to_list(info.get("path")))
+        self.enabled = info.get("enabled", True)
+
+    def __repr__(self):
+        return "<%s rule where=%s hosts=%s paths=%s>" % (self.kind, sorted(self.where), self.hosts, self.paths)
+
+    def in_scope(self, where, host, path):
+        if not self.enabled or where not in self.where:
+            return False
+        if self.hosts and not any(fnmatch.fnmatchcase(host.lower(), h) for h in self.hosts):
+            return False
+        if self.paths and not path.startswith(self.paths):
+            return False
+        return True
+
+class LiteralRule(Rule):
+    kind = "literal"
+
+    def __init__(self, info):
+        Rule.__init__(self, info)
+        if not info.get("find"):
+            raise RuleError("literal rules need a string to find")
+        self.find = _to_bytes(info["find"])
+        self.replace = _to_bytes(info.get("replace", ""))
+
+class RegexRule(Rule):
+    kind = "regex"
+
+    def __init__(self, info):
+        Rule.__init__(self, info)
+        if not info.get("find"):
+            raise RuleError("regex rules need a pattern to find")
+        flags = re.IGNORECASE if info.get("ignore_case", False) else 0
+        try:
+            self.regex = re.compile(_to_bytes(info["find"]), flags)
+        except re.error as e:
+            raise RuleError("invalid regexp %s: %s" % (info["find"], e))
+        self.replace = _to_bytes(info.get("replace", ""))
+
+    def apply(self, data):
+        return self.regex.sub(self.replace, data)
+
+class HeaderRule(Rule):
+    kind = "header"
+    default_where = frozenset(("request",))
+    allowed_where = frozenset(("request", "response"))
+    actions = ("set", "add", "remove", "replace")
+
+    def __init__(self, info):
+        Rule.__init__(self, info)
+        if not info.get("name"):
+            raise RuleError("header rules need a header name")
+        self.name = info["name"]
+        self.action = info.get("action", "set")
+        if self.action not in self.actions:
+            raise RuleError("invalid header action: %s" % self.action)
+        self.value = info.get("value", "")
+        self.regex = None
+        if self.action == "replace":
+            try:
+                self.regex = re.compile(info.get("find", ""))
+            except re.error as e:
+                raise RuleError("invalid regexp %s: %s" % (info.get("find"), e))
+            self.value = info.get("replace", "")
+
+    def apply(self, headers):
+        if self.action == "set":
+            headers.set(self.name, self.value)
+        elif self.action == "add":
+            headers.add(self.name, self.value)
+        elif self.action == "remove":
+            headers.delete(self.name)
+        elif self.name in headers:
+            pairs = list(headers.pairs(self.name))
+            headers.delete(self.name)
+            for k, v in pairs:
+                headers.add(k, self.regex.sub(self.value, v))
+
+class ParamRule(Rule):
+    kind = "param"
+    default_where = frozenset(("request",))
+    allowed_where = frozenset(("request",))
+    actions = ("set", "add", "remove")
+
+    def __init__(self, info):
+        Rule.__init__(self, info)
+        if not info.get("name"):
+            raise RuleError("param rules need a parameter name")
+        self.name = info["name"]
+        self.action = info.get("action", "set")
+        if self.action not in self.actions:
+            raise RuleError("invalid param action: %s" % self.action)
+        self.value = info.get("value", "")
+        self.location = info.get("location", "url")
+        if self.location not in ("url", "body"):
+            raise RuleError("param location must be url or body")
+
+    def apply(self, req):
+        if self.location == "url":
+            target = req.url
+        else:
+            if "content-type" not in req.headers or \
+               "www-form-urlencoded" not in req.headers.get("content-type").lower():
+                return
+            target = req
+        if self.action == "set":
+            target.set_param(self.name, self.value)
+        elif self.action == "add":
+            target.add_param(self.name, self.value)
+        elif self.name in target.parameters():
+            target.del_param(self.name)
+
+rule_types = {
+    "literal": LiteralRule,
+    "regex": RegexRule,
+    "header": HeaderRule,
+    "param": ParamRule,
+}
+
+def rule_from_config(info):
+    """
+    Create a rule from its entry in the config file
+    """
+    rtype = info.get("type", "literal")
+    if rtype not in rule_types:
+        raise RuleError("invalid rule type: %s" % rtype)
+    return rule_types[rtype](info)
+
+def _trie_regex(words):
+    # Build a regexp from a trie of the words so that the regexp engine only
+    # has to follow one branch per byte. Longer matches are tried first so the
+    # leftmost-longest word wins.
+    trie = {}
+    for w in words:
+        node = trie
+        for b in w:
+            node = node.setdefault(b, {})
+        node[None] = True
+
+    def build(node):
+        parts = []
+        # follow chains with one child without recursing so long words
+        # don't hit the recursion limit
+        while None not in node and len(node) == 1:
+            (b, node), = node.items()
+            parts.append(re.escape(bytes([b])))
+        alts = [re.escape(bytes([b])) + build(child)
+                for b, child in sorted((k, v) for k, v in node.items() if k is not None)]
+        if alts:
+            if None in node:
+                alts.append(b'')
+            if len(alts) == 1:
+                parts.append(alts[0])
+            else:
+                parts.append(b'(?:' + b'|'.join(alts) + b')')
+        return b''.join(parts)
+
+    return re.compile(build(trie))
+
+class LiteralMatcher:
+    """
+    Replaces many literal strings in one pass. Uses pyahocorasick if it is
+    installed, otherwise the strings are compiled into a trie shaped regexp.
+    Overlapping matches are resolved leftmost-longest and replaced text is
+    never matched again.
+    """
+
+    def __init__(self, replacements):
+        # replacements is a dict of find -> replace
+        self.replacements = replacements
+        self._automaton = None
+        self._regex = None
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton(ahocorasick.STORE_ANY, ahocorasick.KEY_SEQUENCE)
+            for find, repl in replacements.items():
+                self._automaton.add_word(tuple(find), (len(find), repl))
+            self._automaton.make_automaton()
+        else:
+            self._regex = _trie_regex(replacements.keys())
+
+    def replace(self, data):
+        if not data:
+            return data
+        if self._regex is not None:
+            return self._regex.sub(lambda m: self.replacements[m.group(0)], data)
+        parts = []
+        last = 0
+        for end, (length, repl) in self._automaton.iter_long(tuple(data)):
+            start = end - length + 1
+            parts.append(data[last:start])
+            parts.append(repl)
+            last = end + 1
+        if last == 0:
+            return data
+        parts.append(data[last:])
+        return b''.join(parts)
+
+class RuleEngine:
+    """
+    Applies a list of rules to requests, responses and websocket messages.
+    Literal rules are applied first in a single pass, then regex, header and
+    param rules are applied in the order they were listed. Safe to use from
+    several intercept workers at once.
+    """
+
+    def __init__(self, rules, cache_size=64):
+        self.rules = list(rules)
+        self.cache_size = cache_size
+        self._matchers = OrderedDict()
+        self._lock = threading.Lock()
+        self.wheres = frozenset().union(*[r.where for r in self.rules if r.enabled])
+
+    def active(self, where, host, path):
+        return [(i, r) for i, r in enumerate(self.rules) if r.in_scope(where, host, path)]
+
+    def _matcher(self, literals):
+        key = tuple(i for i, _ in literals)
+        with self._lock:
+            if key in self._matchers:
+                self._matchers.move_to_end(key)
+                return self._matchers[key]
+        replacements = {}
+        for _, r in literals:
+            # the first rule for a string wins
+            replacements.setdefault(r.find, r.replace)
+        matcher = LiteralMatcher(replacements)
+        with self._lock:
+            self._matchers[key] = matcher
+            while len(self._matchers) > self.cache_size:
+                self._matchers.popitem(last=False)
+        return matcher
+
+    def rewrite(self, rules, data):
+        """
+        Apply the literal and regex rules in ``rules`` (a list of (index, rule)
+        from ``active``) to a body
+        """
+        literals = [(i, r) for i, r in rules if isinstance(r, LiteralRule)]
+        if literals:
+            data = self._matcher(literals).replace(data)
+        for _, r in rules:
+            if isinstance(r, RegexRule):
+                data = r.apply(data)
+        return data
+
+    def _apply_http(self, where, req, msg):
+        rules = self.active(where, req.dest_host, req.url.path)
+        if not rules:
+            return msg
+        if where == "request":
+            for _, r in rules:
+                if isinstance(r, ParamRule):
+                    r.apply(msg)
+        for _, r in rules:
+            if isinstance(r, HeaderRule):
+                r.apply(msg.headers)
+        body = self.rewrite(rules, msg.body)
+        if body != msg.body:
+            msg.body = body
+        return msg
+
+    def apply_request(self, req):
+        return self._apply_http("request", req, req)
+
+    def apply_response(self, req, rsp):
+        return self._apply_http("response", req, rsp)
+
+    def apply_ws(self, req, msg):
+        where = "ws_to_server" if msg.to_server else "ws_to_client"
+        rules = self.active(where, req.dest_host, req.url.path)
+        if rules:
+            msg.message = self.rewrite(rules, msg.message)
+        return msg
+
+    def match(self, msg):
+        """
+        Check whether any rule applies to a raw message from the proxy so that
+        messages no rule cares about aren't decoded. Used as the prefilter of
+        RulesMacro.
+        """
+        where = _msg_wheres.get(msg.get("Type"))
+        req = msg.get("Request")
+        if where is None or req is None:
+            return True
+        path = urlparse(req.get("Path", "")).path
+        host = req.get("DestHost", "")
+        return any(r.in_scope(where, host, path) for r in self.rules)
+
+def load_rules(infos):
+    """
+    Create rules from a list of rule entries
+    """
+    rules = []
+    for i, info in enumerate(infos):
+        try:
+            rules.append(rule_from_config(info))
+        except RuleError as e:
+            raise RuleError("rule %d: %s" % (i + 1, e))
+    return rules
+
+def load_rules_file(fname):
+    """
+    Load rules from a JSON file containing either a list of rules or an
+    object with a "rules" key like config.json
+    """
+    try:
+        with open(fname, 'r') as f:
+            info = json.loads(f.read())
+    except (IOError, ValueError) as e:
+        raise RuleError("could not load %s: %s" % (fname, e))
+    if isinstance(info, dict):
+        info = info.get("rules", [])
+    return load_rules(info)
+
+class RulesMacro(InterceptMacro):
+    """
+    The built-in intercepting macro that applies match and replace rules
+    """
+
+    def __init__(self, rules=None):
+        InterceptMacro.__init__(self)
+        self.name = 'rules'
+        self.file_name = '(built-in)'
+        self.async_funcs = []
+        self.processes = 0
+        self.set_rules(rules or [])
+
+    def set_rules(self, rules):
+        self.engine = RuleEngine(rules)
+        self.prefilter = self.engine
+        self.intercept_requests = "request" in self.engine.wheres
+        self.intercept_responses = "response" in self.engine.wheres
+        self.intercept_ws = bool(self.engine.wheres & {"ws_to_server", "ws_to_client"})
+
+    def init(self, args):
+        if len(args) > 0:
+            self.set_rules(load_rules_file(args[0]))
+        if not self.engine.rules:
+            raise RuleError("no rules are configured")
+
+    def mangle_request(self, request):
+        return self.engine.apply_request(request)
+
+    def mangle_response(self, request, response):
+        return self.engine.apply_response(request, response)
+
+    def mangle_websocket(self, request, response, message):
+        return self.engine.apply_ws(request, message)
@@ -0,0 +1,540 @@
+"""
+Sending requests directly from pappy rather than through the proxy backend.
+Every submit through the backend is a round trip over the message connection
+and may open a new connection to the server, which limits how fast large
+replays can go. HTTPSender sends requests with asyncio and keeps a pool of
+keep-alive connections for each host. Idempotent requests without a body are
+pipelined on connections that have already shown that they are persistent,
+TLS sessions are resumed when reconnecting and DNS lookups are cached.
+Responses are parsed with wire.MessageParser.
+
+Requests sent this way do not go through the upstream proxy or intercepting
+macros. send_requests sends an iterable of requests and saves the results to
+a storage in batches the same way as submitter.submit_requests.
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import socket
+import ssl
+import time
+
+from collections import deque
+
+from .proxy import _clear_db_ids
+from .submitter import HostRateLimiter, SubmitError, SubmitProgress, SubmitResult
+from .wire import HTTPParseError, MessageParser, header_value, response_from_parsed
+
+class SendError(Exception):
+    pass
+
+class _ConnectionLost(SendError):
+    # the connection closed before the response to a request was read
+    pass
+
+_pipeline_methods = ("GET", "HEAD", "OPTIONS", "TRACE")
+_idempotent_methods = _pipeline_methods + ("PUT", "DELETE")
+
+class DNSCache:
+    """
+    Caches the addresses of hosts for ``ttl`` seconds. Concurrent lookups
+    of the same host share one query.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._cache = {} # (host, port) -> (future of addrinfo list, expiry)
+
+    async def resolve(self, host, port):
+        key = (host, port)
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is None or entry[1] < now or (entry[0].done() and entry[0].exception()):
+            loop = asyncio.get_event_loop()
+            fut = asyncio.ensure_future(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+            entry = (fut, now + self.ttl)
+            self._cache[key] = entry
+        try:
+            return await asyncio.shield(entry[0])
+        except OSError as e:
+            raise SendError("could not resolve %s: %s" % (host, e))
+
+    def clear(self):
+        self._cache = {}
+
+class _Connection:
+    """
+    A connection to a server. A task reads responses off of the connection
+    and resolves the futures of the requests that were sent on it in order.
+    """
+
+    def __init__(self, key, reader, writer, tls=None):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.tls = tls # (SSLObject, incoming MemoryBIO, outgoing MemoryBIO)
+        self.parser = MessageParser(is_response=True)
+        self.pending = deque()
+        self.inflight = 0 # requests that have been given this connection
+        self.unsafe = 0 # inflight requests that can't be pipelined
+        self.responses = 0
+        self.persistent = False # has the server shown it keeps connections open
+        self.reusable = True
+        self.closed = False
+        self.idle_since = time.time()
+        self._task = None
+
+    @property
+    def session(self):
+        if self.tls is None:
+            return None
+        return self.tls[0].session
+
+    async def _flush(self):
+        data = self.tls[2].read()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def handshake(self):
+        sslobj, incoming, _ = self.tls
+        while True:
+            try:
+                sslobj.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                await self._flush()
+                data = await self.reader.read(65536)
+                if not data:
+                    raise _ConnectionLost("connection closed during TLS handshake")
+                incoming.write(data)
+        await self._flush()
+
+    async def _recv(self):
+        if self.tls is None:
+            return await self.reader.read(65536)
+        sslobj, incoming, _ = self.tls
+        while True:
+            try:
+                return sslobj.read(65536)
+            except ssl.SSLWantReadError:
+                await self._flush()
+                data = await self.reader.read(65536)
+                if not data:
+                    return b""
+                incoming.write(data)
+            except ssl.SSLZeroReturnError:
+                return b""
+
+    async def _read_loop(self):
+        err = None
+        try:
+            while True:
+                data = await self._recv()
+                if not data:
+                    for msg in self.parser.close():
+                        self._deliver(msg)
+                    break
+                for msg in self.parser.feed(data):
+                    self._deliver(msg)
+                if self.parser.upgraded:
+                    break
+        except (OSError, ssl.SSLError, HTTPParseError) as e:
+            err = e
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.close()
+            while self.pending:
+                fut = self.pending.popleft()
+                if not fut.done():
+                    fut.set_exception(_ConnectionLost(str(err) if err else "connection closed"))
+
+    def _deliver(self, parsed):
+        status = parsed.start_line.split(b" ", 2)
+        try:
+            code = int(status[1])
+        except (IndexError, ValueError):
+            code = 0
+        if 100 <= code < 200 and code != 101:
+            # interim response such as 100 Continue
+            return
+        if not self.pending:
+            raise HTTPParseError("response without a request")
+        fut = self.pending.popleft()
+        self.responses += 1
+        conn_hdr = header_value(parsed.headers, "connection", "").lower()
+        if code == 101 or "close" in conn_hdr or (parsed.start_line.startswith(b"HTTP/1.0") and
+                                                   "keep-alive" not in conn_hdr):
+            self.reusable = False
+        elif parsed.start_line.startswith(b"HTTP/1.1"):
+            self.persistent = True
+        if not fut.done():
+            fut.set_result(parsed)
+
+    async def request(self, data, method):
+        """
+        Send a request and return a future that resolves to its ParsedMessage
+        """
+        if self.closed:
+            raise _ConnectionLost("connection closed")
+        fut = asyncio.get_event_loop().create_future()
+        self.parser.expect(method)
+        self.pending.append(fut)
+        if self._task is None:
+            # started here rather than on connect so it doesn't read the TLS handshake
+            self._task = asyncio.ensure_future(self._read_loop())
+        if self.tls is not None:
+            self.tls[0].write(data)
+            await self._flush()
+        else:
+            self.writer.write(data)
+            await self.writer.drain()
+        return fut
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.reusable = False
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+class _HostPool:
+
+    def __init__(self):
+        self.conns = []
+        self.connecting = 0
+        self.cond = asyncio.Condition()
+
+class HTTPSender:
+    """
+    Sends requests directly to servers over keep-alive connections.
+
+    max_per_host: the most connections to open to each host
+    pipeline: how many idempotent requests can be sent on a connection before
+              their responses come back. 1 turns pipelining off
+    timeout: seconds to wait for a connection, a TLS handshake or a response
+    idle_timeout: connections idle for longer than this are closed
+    verify: check server certificates
+    retries: how many times to resend a request whose connection closed
+             before it was answered. Only idempotent requests or requests sent
+             on a reused connection are resent
+    """
+
+    def __init__(self, max_per_host=6, pipeline=1, timeout=30, idle_timeout=30,
+                 verify=False, retries=1, dns_ttl=300):
+        if max_per_host < 1:
+            raise SendError("at least one connection per host is needed")
+        self.max_per_host = max_per_host
+        self.pipeline = max(pipeline, 1)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.dns = DNSCache(dns_ttl)
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if verify:
+            self.ssl_context.load_default_certs()
+        else:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.ssl_context.set_alpn_protocols(["http/1.1"])
+        self._pools = {}
+        self._sessions = {} # (host, port) -> SSLSession
+        self.connections_opened = 0
+        self.sessions_reused = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        for pool in self._pools.values():
+            for c in pool.conns:
+                c.close()
+            pool.conns = []
+        self._pools = {}
+
+    async def _connect(self, key):
+        host, port, use_tls = key
+        infos = await self.dns.resolve(host, port)
+        last_err = None
+        for family, _, _, _, addr in infos:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(addr[0], addr[1], family=family), self.timeout)
+                break
+            except asyncio.TimeoutError:
+                last_err = "timed out"
+            except OSError as e:
+                last_err = e
+        else:
+            raise SendError("could not connect to %s:%d: %s" % (host, port, last_err))
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections_opened += 1
+        if not use_tls:
+            return _Connection(key, reader, writer)
+        incoming = ssl.MemoryBIO()
+        outgoing = ssl.MemoryBIO()
+        session = self._sessions.get((host, port))
+        sslobj = self.ssl_context.wrap_bio(incoming, outgoing, server_hostname=host,
+                                           session=session)
+        conn = _Connection(key, reader, writer, (sslobj, incoming, outgoing))
+        try:
+            await asyncio.wait_for(conn.handshake(), self.timeout)
+        except asyncio.TimeoutError:
+            conn.close()
+            raise SendError("TLS handshake with %s:%d timed out" % (host, port))
+        except (OSError, ssl.SSLError, _ConnectionLost) as e:
+            conn.close()
+            raise SendError("TLS handshake with %s:%d failed: %s" % (host, port, e))
+        if sslobj.session_reused:
+            self.sessions_reused += 1
+        return conn
+
+    def _usable(self, conn, pipelinable):
+        if conn.closed or not conn.reusable:
+            return False
+        if conn.inflight == 0:
+            return True
+        return (pipelinable and self.pipeline > 1 and conn.persistent and
+                conn.unsafe == 0 and conn.inflight < self.pipeline)
+
+    async def _acquire(self, key, pipelinable):
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = _HostPool()
+            self._pools[key] = pool
+        async with pool.cond:
+            while True:
+                now = time.time()
+                live = []
+                for c in pool.conns:
+                    if c.inflight == 0 and (c.closed or not c.reusable or
+                                            now - c.idle_since > self.idle_timeout):
+                        c.close()
+                    else:
+                        live.append(c)
+                pool.conns = live
+                # prefer idle connections and then the least loaded one
+                usable = [c for c in live if self._usable(c, pipelinable)]
+                if usable:
+                    conn = min(usable, key=lambda c: c.inflight)
+                    if conn.inflight == 0 or len(live) + pool.connecting >= self.max_per_host:
+                        break
+                if len(live) + pool.connecting < self.max_per_host:
+                    conn = None
+                    pool.connecting += 1
+                    break
+                await pool.cond.wait()
+            if conn is not None:
+                conn.inflight += 1
+                conn.unsafe += 0 if pipelinable else 1
+                return conn
+        try:
+            conn = await self._connect(key)
+        finally:
+            async with pool.cond:
+                pool.connecting -= 1
+                pool.cond.notify_all()
+        async with pool.cond:
+            conn.inflight += 1
+            conn.unsafe += 0 if pipelinable else 1
+            pool.conns.append(conn)
+        return conn
+
+    async def _release(self, conn, pipelinable):
+        pool = self._pools.get(conn.key)
+        if conn.tls is not None and conn.session is not None:
+            self._sessions[conn.key[:2]] = conn.session
+        if pool is None:
+            conn.close()
+            return
+        async with pool.cond:
+            conn.inflight -= 1
+            conn.unsafe -= 0 if pipelinable else 1
+            if conn.inflight == 0:
+                conn.idle_since = time.time()
+                if not conn.reusable:
+                    conn.close()
+            pool.cond.notify_all()
+
+    @staticmethod
+    def _message(req):
+        data = req.full_message()
+        if "host" not in req.headers:
+            host = req.dest_host
+            if req.dest_port != (443 if req.use_tls else 80):
+                host = "%s:%d" % (host, req.dest_port)
+            head, rest = data.split(b"\r\n", 1)
+            data = head + b"\r\nHost: " + host.encode() + b"\r\n" + rest
+        return data
+
+    async def send(self, req):
+        """
+        Send a request and set its response and times. Returns the request.
+        """
+        await self.send_timed(req)
+        return req
+
+    async def send_timed(self, req):
+        """
+        Send a request and set its response and times. Returns how many
+        seconds passed between writing the request and reading the response,
+        measured with time.perf_counter. Waiting for a connection, connecting
+        and the TLS handshake aren't included.
+        """
+        if not req.dest_host:
+            raise SendError("request has no destination host")
+        key = (req.dest_host, req.dest_port, req.use_tls)
+        data = self._message(req)
+        pipelinable = req.method in _pipeline_methods and not req.body
+        attempt = 0
+        while True:
+            conn = await self._acquire(key, pipelinable)
+            reused = conn.responses > 0 or conn.inflight > 1
+            try:
+                req.time_start = datetime.datetime.utcnow()
+                start = time.perf_counter()
+                fut = await conn.request(data, req.method)
+                parsed = await asyncio.wait_for(fut, self.timeout)
+                elapsed = time.perf_counter() - start
+                req.time_end = datetime.datetime.utcnow()
+                req.response = response_from_parsed(parsed)
+                return elapsed
+            except asyncio.TimeoutError:
+                conn.close()
+                raise SendError("timed out waiting for a response from %s:%d" % key[:2])
+            except (_ConnectionLost, OSError, ssl.SSLError) as e:
+                conn.close()
+                if attempt >= self.retries or not (reused or req.method in _idempotent_methods):
+                    raise SendError(str(e))
+                attempt += 1
+            except HTTPParseError as e:
+                conn.close()
+                raise SendError("invalid response: %s" % e)
+            finally:
+                await self._release(conn, pipelinable)
+
+async def _send_all(client, reqs, sender, workers, limiter, retries, backoff, storage,
+                    batch_size, tags, modify, on_result, progress, prog):
+    reqs = iter(reqs)
+    batch = []
+    saver = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    save_lock = asyncio.Lock()
+    loop = asyncio.get_event_loop()
+    governor = None
+    if client is not None and client.governor.enabled:
+        governor = client.governor
+
+    async def save_batch():
+        # batches are saved in a thread one at a time so the other workers
+        # keep sending while the backend saves them
+        nonlocal batch
+        async with save_lock:
+            to_save, batch = batch, []
+            if not to_save:
+                return
+            if storage is not None:
+                await loop.run_in_executor(saver, lambda: client.save_new_batch(to_save, storage=storage))
+                prog.saved += len(to_save)
+            if on_result is not None:
+                for req in to_save:
+                    on_result(req, None)
+
+    def finish(req, err, retried):
+        prog.retries += retried
+        if err is not None:
+            prog.errors += 1
+            if on_result is not None:
+                on_result(req, err)
+        else:
+            prog.submitted += 1
+            if tags:
+                req.tags.update(tags)
+            _clear_db_ids(req)
+            batch.append(req)
+        if progress is not None:
+            progress(prog)
+
+    async def work():
+        for req in reqs:
+            if modify is not None:
+                try:
+                    req = modify(req)
+                except Exception as e:
+                    finish(req, e, 0)
+                    continue
+                if req is None:
+                    continue
+            if limiter is not None:
+                wait = limiter.take(req.dest_host)
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = limiter.take(req.dest_host)
+            if governor is not None:
+                await governor.acquire_async(req.dest_host)
+            attempt = 0
+            try:
+                while True:
+                    try:
+                        await sender.send(req)
+                        finish(req, None, attempt)
+                        break
+                    except SendError as e:
+                        if attempt >= retries:
+                            finish(req, e, attempt)
+                            break
+                        await asyncio.sleep(backoff * (2 ** attempt))
+                        attempt += 1
+            finally:
+                if governor is not None:
+                    governor.release(req.dest_host)
+            if len(batch) >= batch_size:
+                await save_batch()
+
+    try:
+        await asyncio.gather(*[work() for _ in range(workers)])
+        await save_batch()
+    finally:
+        await sender.close()
+        saver.shutdown(wait=True)
+
+def send_requests(client, reqs, workers=32, rate=0, burst=1, retries=2, backoff=0.5,
+                  storage=None, batch_size=100, tags=None, modify=None,
+                  on_result=None, progress=None, total=None, **sender_args):
+    """
+    Send an iterable of requests directly with an HTTPSender and save the
+    results to a storage in batches. Requests are not saved if storage is
+    None. The arguments are the same as submitter.submit_requests and any
+    other keyword arguments are passed to HTTPSender. ``workers`` is the
+    number of requests in flight at once across every host. Returns a
+    SubmitResult.
+    """
+    if workers < 1:
+        raise SubmitError("at least one worker is needed")
+    if total is None and hasattr(reqs, '__len__'):
+        total = len(reqs)
+    try:
+        sender = HTTPSender(**sender_args)
+    except SendError as e:
+        raise SubmitError(str(e))
+    limiter = HostRateLimiter(rate, burst) if rate else None
+    prog = SubmitProgress(total)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_send_all(client, reqs, sender, workers, limiter, retries,
+                                          backoff, storage, batch_size, tags, modify,
+                                          on_result, progress, prog))
+    finally:
+        loop.close()
+    return SubmitResult(prog.submitted, prog.errors, prog.retries, prog.seconds)
@@ -0,0 +1,245 @@
+"""
+Submitting many requests at once. Requests are sent by a pool of worker
+threads that each have their own connection to the proxy, optionally limited
+to a number of requests per second per host. Failed submissions are retried
+with exponential backoff. The submitted requests and their responses are
+saved to storage in batches from the calling thread.
+"""
+
+import queue
+import threading
+import time
+
+from collections import namedtuple
+
+from .proxy import MessageError, SocketClosed, _clear_db_ids
+
+SubmitResult = namedtuple("SubmitResult", ["submitted", "errors", "retries", "seconds"])
+
+class SubmitError(Exception):
+    pass
+
+class HostRateLimiter:
+    """
+    A token bucket for each host. acquire() blocks until the host has a token.
+    ``rate`` is the number of requests per second allowed for each host and
+    ``burst`` is how many can be sent at once after being idle. A rate of 0
+    means no limit.
+    """
+
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._buckets = {} # host -> (tokens, time of last refill)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self.rate = rate
+            if burst is not None:
+                self.burst = max(burst, 1)
+
+    def take(self, host):
+        """
+        Take a token for host without waiting. Returns 0 if one was taken,
+        otherwise how many seconds until the next one is available.
+        """
+        with self._lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            tokens, last = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[host] = (tokens - 1, now)
+                return 0
+            self._buckets[host] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def acquire(self, host, stop=None):
+        """
+        Wait for a token for host. Returns the number of seconds spent waiting
+        or None if ``stop`` (a threading.Event) was set while waiting.
+        """
+        waited = 0
+        while True:
+            wait = self.take(host)
+            if wait <= 0:
+                return waited
+            if stop is not None:
+                if stop.wait(wait):
+                    return None
+            else:
+                time.sleep(wait)
+            waited += wait
+
+class SubmitProgress:
+    """
+    Counts for a running submission passed to the progress callback.
+    ``total`` is None if the number of requests isn't known.
+    """
+
+    def __init__(self, total=None):
+        self.total = total
+        self.start = time.time()
+        self.submitted = 0
+        self.errors = 0
+        self.retries = 0
+        self.saved = 0
+
+    @property
+    def done(self):
+        return self.submitted + self.errors
+
+    @property
+    def seconds(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        secs = self.seconds
+        if secs <= 0:
+            return 0
+        return self.done / secs
+
+class _Submitter:
+
+    def __init__(self, client, reqs, workers, rate_limiter, retries, backoff, modify):
+        self.client = client
+        self.reqs = iter(reqs)
+        self.reqs_lock = threading.Lock()
+        self.workers = workers
+        self.limiter = rate_limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.modify = modify
+        self.results = queue.Queue(maxsize=workers * 4)
+        self.stop = threading.Event()
+
+    def _next(self):
+        with self.reqs_lock:
+            try:
+                return next(self.reqs)
+            except StopIteration:
+                return None
+
+    def _submit(self, conn, req):
+        # Submit a request, retrying if it fails. Returns (conn, error, retries)
+        # where conn may be a new connection if the old one was closed
+        attempt = 0
+        while True:
+            try:
+                if conn is None:
+                    conn = self.client.new_conn()
+                conn.submit(req, storage=0)
+                return conn, None, attempt
+            except (MessageError, SocketClosed, OSError) as e:
+                if isinstance(e, (SocketClosed, OSError)) and conn is not None:
+                    conn.close()
+                    conn = None
+                if attempt >= self.retries or self.stop.is_set():
+                    return conn, e, attempt
+                if self.stop.wait(self.backoff * (2 ** attempt)):
+                    return conn, e, attempt
+                attempt += 1
+
+    def work(self):
+        conn = None
+        try:
+            while not self.stop.is_set():
+                req = self._next()
+                if req is None:
+                    return
+                if self.modify is not None:
+                    try:
+                        req = self.modify(req)
+                    except Exception as e:
+                        self.results.put((req, e, 0))
+                        continue
+                    if req is None:
+                        continue
+                if self.limiter is not None and self.limiter.acquire(req.dest_host, self.stop) is None:
+                    return
+                conn, err, retries = self._submit(conn, req)
+                self.results.put((req, err, retries))
+        finally:
+            if conn is not None:
+                conn.close()
+            self.results.put(None)
+
+def submit_requests(client, reqs, workers=8, rate=0, burst=1, retries=2, backoff=0.5,
+                    storage=None, batch_size=100, tags=None, modify=None,
+                    on_result=None, progress=None, total=None):
+    """
+    Submit an iterable of requests concurrently and save the results to a
+    storage in batches. Requests are not saved if storage is None.
+
+    workers: the number of requests that are submitted at once
+    rate: the maximum requests per second to each host (0 for no limit) with
+          bursts of up to ``burst`` requests
+    retries: how many times to retry a request that couldn't be submitted,
+             waiting backoff * 2^n seconds before the nth retry
+    tags: tags to add to every submitted request
+    modify: a function called on each request in a worker thread before it is
+            submitted. It returns the request to submit or None to skip it
+    on_result: called with (request, error) for each request, where error is
+               None if it was submitted. Successful requests are passed on
+               once their batch has been saved so they have an id
+    progress: called with a SubmitProgress after each request finishes
+    total: the number of requests for the progress callback if reqs is not a
+           list
+
+    Returns a SubmitResult.
+    """
+    if workers < 1:
+        raise SubmitError("at least one worker is needed")
+    if total is None and hasattr(reqs, '__len__'):
+        total = len(reqs)
+    limiter = HostRateLimiter(rate, burst) if rate else None
+    sub = _Submitter(client, reqs, workers, limiter, retries, backoff, modify)
+    prog = SubmitProgress(total)
+    batch = []
+
+    def save_batch():
+        if storage is not None and batch:
+            client.save_new_batch(batch, storage=storage)
+            prog.saved += len(batch)
+        if on_result is not None:
+            for req in batch:
+                on_result(req, None)
+        del batch[:]
+
+    threads = [threading.Thread(target=sub.work, daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    running = workers
+    try:
+        while running > 0:
+            item = sub.results.get()
+            if item is None:
+                running -= 1
+                continue
+            req, err, retries = item
+            prog.retries += retries
+            if err is not None:
+                prog.errors += 1
+                if on_result is not None:
+                    on_result(req, err)
+            else:
+                prog.submitted += 1
+                if tags:
+                    req.tags.update(tags)
+                _clear_db_ids(req)
+                batch.append(req)
+                if len(batch) >= batch_size:
+                    save_batch()
+            if progress is not None:
+                progress(prog)
+        save_batch()
+    finally:
+        sub.stop.set()
+        # let the workers finish so that they close their connections
+        while running > 0:
+            if sub.results.get() is None:
+                running -= 1
+    return SubmitResult(prog.submitted, prog.errors, prog.retries, prog.seconds)
@@ -0,0 +1,258 @@
+"""
+Limits on how hard requests submitted from pappy hit each host. The governor
+is shared by everything that submits requests through a client (submit,
+submit_many, macros, replay, intruder and so on) so that limits hold no
+matter how many of them are running at once.
+
+Each host gets a token bucket (see submitter.HostRateLimiter) and a limit on
+how many of its requests can be in flight at once. Limits can be overridden
+for hosts matching a glob such as ``*.target.org``. The time requests spend
+waiting for the governor is recorded for each host.
+"""
+
+import asyncio
+import threading
+import time
+
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from fnmatch import fnmatch
+
+from .submitter import HostRateLimiter
+
+ThrottleStats = namedtuple("ThrottleStats", ["host", "requests", "delayed", "mean_wait",
+                                             "max_wait", "waiting", "in_flight"])
+
+class _WaitStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.delayed = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def record(self, waited):
+        self.requests += 1
+        if waited > 0:
+            self.delayed += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+class SubmitGovernor:
+    """
+    Per-host rate and concurrency limits. ``rate`` is requests per second to
+    each host, ``burst`` how many can be sent at once after being idle and
+    ``concurrency`` how many can be in flight to each host at once. 0 means
+    no limit. ``hosts`` maps host globs to dicts with any of those keys to
+    override them for matching hosts.
+    """
+
+    match_cache_size = 1024
+
+    def __init__(self, rate=0, burst=1, concurrency=0, hosts=None):
+        self._cond = threading.Condition()
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.concurrency = concurrency
+        self._hosts = {}
+        self._default = HostRateLimiter(rate, self.burst)
+        self._limiters = {}
+        self._matches = OrderedDict() # host -> glob it matches, most recent last
+        self._in_flight = Counter()
+        self._waiting = Counter()
+        self._stats = {}
+        for pattern, info in (hosts or {}).items():
+            self._hosts[pattern.lower()] = dict(info)
+        with self._cond:
+            self._apply()
+
+    @property
+    def enabled(self):
+        return bool(self.rate or self.concurrency or self._hosts)
+
+    def _apply(self):
+        # called with the lock held after the limits change
+        self._default.set_rate(self.rate, self.burst)
+        for pattern in list(self._limiters):
+            if pattern not in self._hosts:
+                del self._limiters[pattern]
+        for pattern, info in self._hosts.items():
+            lim = self._limiters.setdefault(pattern, HostRateLimiter())
+            lim.set_rate(info.get("rate", self.rate), max(info.get("burst", self.burst), 1))
+        self._matches.clear()
+        self._cond.notify_all()
+
+    def set_limits(self, rate=None, burst=None, concurrency=None, host=None):
+        """
+        Change the default limits or, if host is given, the limits for hosts
+        matching that glob. Limits that aren't given are left as they are.
+        """
+        with self._cond:
+            if host is None:
+                if rate is not None:
+                    self.rate = rate
+                if burst is not None:
+                    self.burst = max(burst, 1)
+                if concurrency is not None:
+                    self.concurrency = concurrency
+            else:
+                info = self._hosts.setdefault(host.lower(), {})
+                for k, v in (("rate", rate), ("burst", burst), ("concurrency", concurrency)):
+                    if v is not None:
+                        info[k] = v
+            self._apply()
+
+    def remove_host(self, host):
+        """
+        Remove the limits for a host glob. Returns False if it had none
+        """
+        with self._cond:
+            if self._hosts.pop(host.lower(), None) is None:
+                return False
+            self._apply()
+            return True
+
+    def host_limits(self):
+        """
+        Returns a dict of host glob -> (rate, burst, concurrency) for each override
+        """
+        with self._cond:
+            return {p: (i.get("rate", self.rate), i.get("burst", self.burst),
+                        i.get("concurrency", self.concurrency))
+                    for p, i in self._hosts.items()}
+
+    def _match(self, host):
+        if host in self._matches:
+            self._matches.move_to_end(host)
+            return self._matches[host]
+        pattern = None
+        if host in self._hosts:
+            pattern = host
+        else:
+            for p in self._hosts:
+                if fnmatch(host, p):
+                    pattern = p
+                    break
+        self._matches[host] = pattern
+        while len(self._matches) > self.match_cache_size:
+            self._matches.popitem(last=False)
+        return pattern
+
+    def _try(self, host):
+        # Take a slot and a token for host. Returns 0 if they were taken,
+        # otherwise how long to wait before trying again or None to wait for
+        # a request to finish. Called with the lock held
+        pattern = self._match(host)
+        if pattern is None:
+            limiter, concurrency = self._default, self.concurrency
+        else:
+            limiter = self._limiters[pattern]
+            concurrency = self._hosts[pattern].get("concurrency", self.concurrency)
+        if concurrency and self._in_flight[host] >= concurrency:
+            return None
+        wait = limiter.take(host)
+        if wait > 0:
+            return wait
+        self._in_flight[host] += 1
+        return 0
+
+    def _record(self, host, waited):
+        with self._cond:
+            self._waiting[host] -= 1
+            if waited is not None:
+                self._stats.setdefault(host, _WaitStats()).record(waited)
+
+    def acquire(self, host, stop=None):
+        """
+        Wait until a request can be sent to host. Returns the number of
+        seconds spent waiting or None if ``stop`` (a threading.Event) was set
+        while waiting. Every successful acquire must be followed by release().
+        """
+        host = host.lower()
+        start = time.time()
+        waited = None
+        delayed = False
+        with self._cond:
+            self._waiting[host] += 1
+            try:
+                while True:
+                    wait = self._try(host)
+                    if wait == 0:
+                        waited = time.time() - start if delayed else 0
+                        break
+                    delayed = True
+                    if stop is not None:
+                        if stop.is_set():
+                            break
+                        wait = min(wait or 0.1, 0.1)
+                    self._cond.wait(wait)
+            finally:
+                self._record(host, waited)
+        return waited
+
+    async def acquire_async(self, host):
+        """
+        acquire() for coroutines. Waits without blocking the event loop.
+        """
+        host = host.lower()
+        start = time.time()
+        with self._cond:
+            self._waiting[host] += 1
+        waited = None
+        delayed = False
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try(host)
+                if wait == 0:
+                    waited = time.time() - start if delayed else 0
+                    return waited
+                delayed = True
+                await asyncio.sleep(wait or 0.01)
+        finally:
+            self._record(host, waited)
+
+    def release(self, host):
+        host = host.lower()
+        with self._cond:
+            self._in_flight[host] -= 1
+            if self._in_flight[host] <= 0:
+                del self._in_flight[host]
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, host):
+        """
+        Hold a slot for a request to host for the body of a with statement
+        """
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    def stats(self):
+        """
+        Returns a list of ThrottleStats for each host that requests were sent
+        to, the hosts that spent the most time waiting first
+        """
+        with self._cond:
+            hosts = set(self._stats) | set(h for h, n in self._waiting.items() if n > 0)
+            ret = []
+            for host in hosts:
+                s = self._stats.get(host, _WaitStats())
+                mean = s.total_wait / s.requests if s.requests else 0
+                ret.append(ThrottleStats(host, s.requests, s.delayed, mean, s.max_wait,
+                                         self._waiting[host], self._in_flight[host]))
+        ret.sort(key=lambda s: (s.mean_wait * s.requests, s.requests), reverse=True)
+        return ret
+
+    def reset_stats(self):
+        with self._cond:
+            self._stats = {}
+
+def governor_from_config(info):
+    return SubmitGovernor(rate=info.get("rate", 0),
+                          burst=info.get("burst", 1),
+                          concurrency=info.get("concurrency", 0),
+                          hosts=info.get("hosts"))
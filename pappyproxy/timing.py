@@ -0,0 +1,277 @@
+"""
+Timing analysis for side channel testing. A set of request variants (such as
+a login with a valid and an invalid username) is sent many times and the
+response times of each variant are compared with a baseline to find the ones
+whose response time differs.
+
+Variants are sent one at a time over a single keep-alive connection with
+sender.HTTPSender and timed with a monotonic high resolution clock from when
+the request is written to when the response is read, so the measurements
+don't include a round trip to the proxy or reconnecting after the server
+closes the connection.
+Each round sends every variant once in a random order so that drift in the
+server's response time over the run (and the effect of one variant on the
+next) is spread evenly over the variants.
+
+Response times are skewed and full of outliers, so variants are compared
+with robust statistics: the median, a trimmed mean, a Mann-Whitney U test
+and the box test (whether a low percentile range of one variant's times is
+entirely below the other's). Uses NumPy for the statistics if it is
+installed.
+"""
+
+import asyncio
+import math
+import random
+import time
+
+from collections import Counter, namedtuple
+
+from .sender import HTTPSender, SendError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class TimingError(Exception):
+    pass
+
+TimingComparison = namedtuple("TimingComparison", ["name", "count", "errors", "median", "trimmed_mean",
+                                                   "iqr", "diff", "p_value", "box", "significant"])
+
+def _samples(values):
+    if numpy is not None:
+        return numpy.sort(numpy.asarray(values, dtype=numpy.float64))
+    return sorted(values)
+
+def percentile(samples, pct):
+    """
+    A percentile of sorted samples with linear interpolation between the
+    closest ranks (the same as numpy.percentile)
+    """
+    if len(samples) == 0:
+        return None
+    if numpy is not None:
+        return float(numpy.percentile(samples, pct))
+    pos = (len(samples) - 1) * pct / 100.0
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(samples) - 1)
+    return samples[lo] + (samples[hi] - samples[lo]) * (pos - lo)
+
+def median(samples):
+    return percentile(samples, 50)
+
+def trimmed_mean(samples, trim=0.1):
+    """
+    The mean of sorted samples after removing ``trim`` of the values from each end
+    """
+    n = len(samples)
+    if n == 0:
+        return None
+    cut = int(n * trim)
+    kept = samples[cut:n-cut] if n - 2 * cut > 0 else samples
+    if numpy is not None:
+        return float(numpy.mean(kept))
+    return sum(kept) / len(kept)
+
+def _ranks(values):
+    # average ranks (starting at 1) of values with ties sharing their mean
+    # rank and the tie correction term sum(t^3 - t)
+    if numpy is not None:
+        _, inverse, counts = numpy.unique(values, return_inverse=True, return_counts=True)
+        avg = numpy.cumsum(counts) - (counts - 1) / 2.0
+        return avg[inverse], float(numpy.sum(counts.astype(numpy.float64) ** 3 - counts))
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    ranks = [0] * len(values)
+    ties = 0
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j+1]] == values[order[i]]:
+            j += 1
+        rank = (i + j) / 2.0 + 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = rank
+        t = j - i + 1
+        ties += t ** 3 - t
+        i = j + 1
+    return ranks, ties
+
+def mann_whitney(a, b):
+    """
+    A two sided Mann-Whitney U test using the normal approximation with tie
+    and continuity corrections. Returns (U for a, p value).
+    """
+    n1, n2 = len(a), len(b)
+    if n1 == 0 or n2 == 0:
+        raise TimingError("both samples need at least one value")
+    if numpy is not None:
+        values = numpy.concatenate([numpy.asarray(a), numpy.asarray(b)])
+    else:
+        values = list(a) + list(b)
+    ranks, ties = _ranks(values)
+    r1 = float(ranks[:n1].sum()) if numpy is not None else sum(ranks[:n1])
+    u = r1 - n1 * (n1 + 1) / 2.0
+    n = n1 + n2
+    var = n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1) if n > 1 else 1))
+    if var <= 0:
+        return u, 1.0
+    z = (abs(u - n1 * n2 / 2.0) - 0.5) / math.sqrt(var)
+    return u, min(1.0, math.erfc(max(z, 0) / math.sqrt(2)))
+
+def box_test(a, b, low=5, high=10):
+    """
+    Compare the [low, high] percentile ranges of two sorted samples. Returns
+    -1 if a's range is entirely below b's, 1 if it is entirely above it and 0
+    if they overlap.
+    """
+    a_lo, a_hi = percentile(a, low), percentile(a, high)
+    b_lo, b_hi = percentile(b, low), percentile(b, high)
+    if a_hi < b_lo:
+        return -1
+    if b_hi < a_lo:
+        return 1
+    return 0
+
+class VariantTiming:
+    """
+    The response times of one variant in seconds. ``samples`` is a sorted
+    NumPy array if NumPy is installed and a sorted list otherwise.
+    """
+
+    def __init__(self, name, req):
+        self.name = name
+        self.req = req
+        self.values = []
+        self.errors = 0
+        self.statuses = Counter()
+        self._samples = None
+
+    def add(self, seconds, status):
+        self.values.append(seconds)
+        self.statuses[status] += 1
+        self._samples = None
+
+    @property
+    def samples(self):
+        if self._samples is None:
+            self._samples = _samples(self.values)
+        return self._samples
+
+    @property
+    def count(self):
+        return len(self.values)
+
+class TimingResult:
+    """
+    The measurements for each variant. The first variant is the baseline by
+    default.
+    """
+
+    def __init__(self, variants):
+        self.variants = variants
+        self.rounds = 0
+        self.seconds = 0
+
+    def compare(self, baseline=0, alpha=0.01, trim=0.1, box=(5, 10)):
+        """
+        Compare each variant with the baseline variant. A variant is
+        significant if the Mann-Whitney p value is below alpha divided by the
+        number of comparisons. Returns a TimingComparison for each variant
+        with times in seconds. The baseline has no diff, p value or box result.
+        """
+        base = self.variants[baseline].samples
+        tests = len(self.variants) - 1
+        ret = []
+        for i, v in enumerate(self.variants):
+            s = v.samples
+            med = median(s)
+            iqr = percentile(s, 75) - percentile(s, 25) if len(s) else None
+            diff, p, boxed, significant = None, None, None, False
+            if i != baseline and len(s) and len(base):
+                diff = med - median(base)
+                _, p = mann_whitney(s, base)
+                boxed = box_test(s, base, box[0], box[1])
+                significant = p < alpha / max(tests, 1)
+            ret.append(TimingComparison(v.name, len(s), v.errors, med, trimmed_mean(s, trim),
+                                        iqr, diff, p, boxed, significant))
+        return ret
+
+async def _measure(client, variants, rounds, warmup, sender, rng, progress, result):
+    governor = None
+    if client is not None and client.governor.enabled:
+        governor = client.governor
+    order = list(range(len(variants)))
+    try:
+        for r in range(warmup + rounds):
+            rng.shuffle(order)
+            for i in order:
+                v = variants[i]
+                req = v.req.copy()
+                if governor is not None:
+                    await governor.acquire_async(req.dest_host)
+                try:
+                    elapsed = await sender.send_timed(req)
+                except SendError:
+                    if r >= warmup:
+                        v.errors += 1
+                    continue
+                finally:
+                    if governor is not None:
+                        governor.release(req.dest_host)
+                if r >= warmup:
+                    v.add(elapsed, req.response.status_code)
+            if r >= warmup:
+                result.rounds += 1
+                if progress is not None:
+                    progress(result)
+    finally:
+        await sender.close()
+
+def measure_timing(client, variants, rounds=100, warmup=5, seed=None, progress=None, **sender_args):
+    """
+    Time a list of (name, request) variants. Every round sends each variant
+    once in a random order and the first ``warmup`` rounds aren't recorded.
+    progress is called with the TimingResult after each round. Other keyword
+    arguments are passed to sender.HTTPSender. Returns a TimingResult.
+    """
+    if len(variants) < 2:
+        raise TimingError("at least two variants are needed")
+    if rounds < 1:
+        raise TimingError("at least one round is needed")
+    sender_args.setdefault("max_per_host", 1)
+    sender_args.setdefault("retries", 0)
+    try:
+        sender = HTTPSender(**sender_args)
+    except SendError as e:
+        raise TimingError(str(e))
+    result = TimingResult([VariantTiming(name, req) for name, req in variants])
+    rng = random.Random(seed)
+    loop = asyncio.new_event_loop()
+    start = time.time()
+    try:
+        loop.run_until_complete(_measure(client, result.variants, rounds, warmup, sender,
+                                         rng, progress, result))
+    finally:
+        loop.close()
+    result.seconds = time.time() - start
+    return result
+
+def replacement_variants(name, req, find, replacements):
+    """
+    Make variants of a request by replacing ``find`` in the full request
+    with each replacement. The original request is the first variant.
+    """
+    from .proxy import parse_request
+    raw = req.full_message()
+    find = find.encode() if isinstance(find, str) else find
+    if find not in raw:
+        raise TimingError("%s is not in the request" % find.decode(errors="replace"))
+    ret = [(name, req)]
+    for r in replacements:
+        rb = r.encode() if isinstance(r, str) else r
+        ret.append(("%s %s" % (name, r if isinstance(r, str) else r.decode(errors="replace")),
+                    parse_request(raw.replace(find, rb), dest_host=req.dest_host,
+                                  dest_port=req.dest_port, use_tls=req.use_tls)))
+    return ret
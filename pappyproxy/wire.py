@@ -0,0 +1,356 @@
+"""
+Incremental parsers for HTTP/1.x messages and websocket frames. Data can be
+fed to a parser in chunks of any size as it comes off of a socket or out of a
+packet capture and completed messages are returned as soon as they are
+available.
+"""
+
+import struct
+
+from collections import deque, namedtuple
+
+from .proxy import HTTPRequest, HTTPResponse, Headers, WSMessage, parse_req_sline, parse_rsp_sline
+
+class HTTPParseError(Exception):
+    pass
+
+# headers is a list of (key, value) string pairs
+ParsedMessage = namedtuple("ParsedMessage", ["start_line", "headers", "body"])
+
+MAX_HEADER_SIZE = 64*1024
+
+def header_value(headers, key, default=None):
+    key = key.lower()
+    for k, v in headers:
+        if k.lower() == key:
+            return v
+    return default
+
+def _no_body_status(status_code):
+    return status_code in (204, 304)
+
+class MessageParser:
+    """
+    Parses a stream of HTTP/1.x requests or responses. Response parsers need
+    to be told the method of each request with expect() so that responses to
+    HEAD requests are parsed correctly.
+    """
+
+    def __init__(self, is_response=False):
+        self.is_response = is_response
+        self.buf = bytearray()
+        self.methods = deque()
+        self.upgraded = False
+        self._reset()
+
+    def _reset(self):
+        self.state = "head"
+        self.start_line = None
+        self.headers = None
+        self.body = bytearray()
+        self.remaining = 0
+
+    def expect(self, method):
+        self.methods.append(method)
+
+    def take_buffer(self):
+        # Get whatever data is left after the parser stopped (ie after an upgrade)
+        data = bytes(self.buf)
+        self.buf = bytearray()
+        return data
+
+    @property
+    def idle(self):
+        return self.state == "head" and len(self.buf) == 0
+
+    def feed(self, data):
+        """
+        Add data to the stream and return a list of completed ParsedMessages
+        """
+        self.buf += data
+        completed = []
+        while not self.upgraded:
+            msg = self._step()
+            if msg is None:
+                break
+            completed.append(msg)
+        return completed
+
+    def close(self):
+        """
+        The stream was closed. Returns a list with the message whose body is
+        delimited by the end of the stream if there is one.
+        """
+        if self.state == "close":
+            self.body += self.buf
+            self.buf = bytearray()
+            return [self._finish()]
+        return []
+
+    def _finish(self):
+        msg = ParsedMessage(self.start_line, self.headers, bytes(self.body))
+        self._reset()
+        return msg
+
+    def _parse_head(self):
+        end = self.buf.find(b"\r\n\r\n")
+        sep_len = 4
+        if end < 0:
+            end = self.buf.find(b"\n\n")
+            sep_len = 2
+        if end < 0:
+            if len(self.buf) > MAX_HEADER_SIZE:
+                raise HTTPParseError("headers too large")
+            # skip blank lines between messages
+            while self.buf[:2] == b"\r\n":
+                del self.buf[:2]
+            return False
+        head = bytes(self.buf[:end])
+        del self.buf[:end+sep_len]
+        lines = head.replace(b"\r\n", b"\n").split(b"\n")
+        while lines and lines[0] == b"":
+            lines = lines[1:]
+        if not lines:
+            return False
+        self.start_line = lines[0]
+        self.headers = []
+        for l in lines[1:]:
+            if b":" not in l:
+                raise HTTPParseError("malformed header: %r" % l)
+            k, v = l.split(b":", 1)
+            self.headers.append((k.decode(errors="replace").strip(),
+                                 v.decode(errors="replace").strip()))
+        return True
+
+    def _body_mode(self):
+        # Returns (mode, length) for the body of the current message
+        if self.is_response:
+            try:
+                status_code = parse_rsp_sline(self.start_line).status_code
+            except (ValueError, IndexError):
+                raise HTTPParseError("malformed status line: %r" % self.start_line)
+            if 100 <= status_code < 200:
+                # interim responses don't answer the request, except for an
+                # upgrade after which the stream is no longer HTTP
+                if status_code == 101:
+                    self.upgraded = True
+                    if self.methods:
+                        self.methods.popleft()
+                return ("none", 0)
+            method = self.methods.popleft() if self.methods else "GET"
+            if method == "HEAD" or _no_body_status(status_code):
+                return ("none", 0)
+        te = header_value(self.headers, "transfer-encoding", "")
+        if "chunked" in te.lower():
+            return ("chunked", 0)
+        cl = header_value(self.headers, "content-length")
+        if cl is not None:
+            try:
+                return ("length", int(cl))
+            except ValueError:
+                raise HTTPParseError("invalid content-length: %s" % cl)
+        if self.is_response:
+            return ("close", 0)
+        return ("none", 0)
+
+    def _step(self):
+        if self.state == "head":
+            if not self._parse_head():
+                return None
+            mode, length = self._body_mode()
+            if mode == "none":
+                return self._finish()
+            elif mode == "length":
+                self.state = "length"
+                self.remaining = length
+            elif mode == "chunked":
+                self.state = "chunk_size"
+            else:
+                self.state = "close"
+
+        if self.state == "length":
+            n = min(self.remaining, len(self.buf))
+            self.body += self.buf[:n]
+            del self.buf[:n]
+            self.remaining -= n
+            if self.remaining == 0:
+                return self._finish()
+            return None
+
+        if self.state == "close":
+            self.body += self.buf
+            self.buf = bytearray()
+            return None
+
+        while True:
+            if self.state == "chunk_size":
+                end = self.buf.find(b"\n")
+                if end < 0:
+                    return None
+                line = bytes(self.buf[:end]).strip()
+                del self.buf[:end+1]
+                try:
+                    self.remaining = int(line.split(b";", 1)[0], 16)
+                except ValueError:
+                    raise HTTPParseError("invalid chunk size: %r" % line)
+                if self.remaining == 0:
+                    self.state = "trailer"
+                else:
+                    self.state = "chunk_data"
+            elif self.state == "chunk_data":
+                n = min(self.remaining, len(self.buf))
+                self.body += self.buf[:n]
+                del self.buf[:n]
+                self.remaining -= n
+                if self.remaining > 0:
+                    return None
+                self.state = "chunk_end"
+            elif self.state == "chunk_end":
+                end = self.buf.find(b"\n")
+                if end < 0:
+                    return None
+                del self.buf[:end+1]
+                self.state = "chunk_size"
+            elif self.state == "trailer":
+                end = self.buf.find(b"\n")
+                if end < 0:
+                    return None
+                line = bytes(self.buf[:end]).strip()
+                del self.buf[:end+1]
+                if line == b"":
+                    return self._finish()
+
+def _parsed_headers(parsed):
+    headers = Headers()
+    for k, v in parsed.headers:
+        if k.lower() not in ("content-length", "transfer-encoding"):
+            headers.add(k, v)
+    return headers.dict()
+
+def request_from_parsed(parsed, dest_host="", dest_port=80, use_tls=False):
+    """
+    Create an HTTPRequest from a ParsedMessage. The body has already been
+    de-chunked, so Transfer-Encoding is removed and Content-Length is set to
+    the length of the body.
+    """
+    try:
+        sline = parse_req_sline(parsed.start_line)
+    except Exception:
+        raise HTTPParseError("malformed request line: %r" % parsed.start_line)
+    return HTTPRequest(
+        method=sline.method,
+        path=sline.path,
+        proto_major=sline.proto_major,
+        proto_minor=sline.proto_minor,
+        headers=_parsed_headers(parsed),
+        body=parsed.body,
+        dest_host=dest_host,
+        dest_port=dest_port,
+        use_tls=use_tls,
+    )
+
+def response_from_parsed(parsed):
+    try:
+        sline = parse_rsp_sline(parsed.start_line)
+    except Exception:
+        raise HTTPParseError("malformed status line: %r" % parsed.start_line)
+    return HTTPResponse(
+        status_code=sline.status_code,
+        reason=sline.reason,
+        proto_major=sline.proto_major,
+        proto_minor=sline.proto_minor,
+        headers=_parsed_headers(parsed),
+        body=parsed.body,
+    )
+
+def is_upgrade_response(parsed):
+    try:
+        return parse_rsp_sline(parsed.start_line).status_code == 101
+    except Exception:
+        return False
+
+#############
+## Websockets
+
+class WSFrameParser:
+    """
+    Parses websocket frames in one direction and returns complete data
+    messages. Fragmented messages are reassembled and control frames are
+    ignored. Compressed messages are returned as-is.
+    """
+
+    def __init__(self, to_server):
+        self.to_server = to_server
+        self.buf = bytearray()
+        self.fragments = bytearray()
+        self.fragment_binary = False
+        self.closed = False
+
+    def feed(self, data):
+        """
+        Returns a list of WSMessages
+        """
+        self.buf += data
+        messages = []
+        while not self.closed:
+            frame = self._parse_frame()
+            if frame is None:
+                break
+            fin, opcode, payload = frame
+            if opcode == 0x8:
+                self.closed = True
+            elif opcode in (0x1, 0x2):
+                self.fragments = bytearray(payload)
+                self.fragment_binary = (opcode == 0x2)
+                if fin:
+                    messages.append(self._message())
+            elif opcode == 0x0:
+                self.fragments += payload
+                if fin:
+                    messages.append(self._message())
+        return messages
+
+    def _message(self):
+        msg = WSMessage(is_binary=self.fragment_binary, message=bytes(self.fragments),
+                        to_server=self.to_server)
+        self.fragments = bytearray()
+        return msg
+
+    def _parse_frame(self):
+        if len(self.buf) < 2:
+            return None
+        b1, b2 = self.buf[0], self.buf[1]
+        fin = bool(b1 & 0x80)
+        opcode = b1 & 0x0f
+        masked = bool(b2 & 0x80)
+        length = b2 & 0x7f
+        pos = 2
+        if length == 126:
+            if len(self.buf) < 4:
+                return None
+            length = struct.unpack("!H", self.buf[2:4])[0]
+            pos = 4
+        elif length == 127:
+            if len(self.buf) < 10:
+                return None
+            length = struct.unpack("!Q", self.buf[2:10])[0]
+            pos = 10
+        mask = None
+        if masked:
+            if len(self.buf) < pos + 4:
+                return None
+            mask = bytes(self.buf[pos:pos+4])
+            pos += 4
+        if len(self.buf) < pos + length:
+            return None
+        payload = bytes(self.buf[pos:pos+length])
+        del self.buf[:pos+length]
+        if mask is not None:
+            payload = unmask(payload, mask)
+        return (fin, opcode, payload)
+
+def unmask(payload, mask):
+    # xor the payload with the mask 4 bytes at a time using ints
+    n = len(payload)
+    key = int.from_bytes((mask * (n // 4 + 1))[:n], 'big')
+    return (int.from_bytes(payload, 'big') ^ key).to_bytes(n, 'big')